@@ -0,0 +1,98 @@
+"""  Runs a powerwall-rl command, eg. python -m powerwallrl collect. Run a command
+  with --help for its options.
+
+  Only the chosen command's module is imported, so hourly cron jobs don't pay
+  for torch, stable baselines or matplotlib. import-times reports how long each
+  command takes to import in a fresh interpreter.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import importlib
+import subprocess
+import sys
+import time
+
+# Command name -> (module, help).
+COMMANDS = {
+  'setup': ('powerwallrl.commands.setup',
+            'Create the databases, log in to Tesla and backfill the history.'),
+  'collect': ('powerwallrl.commands.collect',
+              'Collect weather and Powerwall data for every site.'),
+  'poll-gateway': ('powerwallrl.commands.poll_gateway',
+                   'Poll every site\'s Powerwall gateway until stopped.'),
+  'change-battery': ('powerwallrl.commands.change_battery',
+                     'Set every site\'s backup reserve for this hour.'),
+  'train': ('powerwallrl.commands.train', 'Train the battery model.'),
+  'train-es': ('powerwallrl.commands.train_es',
+               'Train the battery model with evolution strategies.'),
+  'backtest': ('powerwallrl.commands.backtest',
+               'Backtest the model over the collected history.'),
+  'results': ('powerwallrl.commands.results',
+              'Report the regret of the last checkpoints by month.'),
+  'journal': ('powerwallrl.commands.journal',
+              'Report what production decisions earned and their drift.'),
+  'sweep': ('powerwallrl.commands.sweep', 'Sweep PPO hyperparameters.'),
+  'compare-plans': ('powerwallrl.commands.compare_plans',
+                    'Price every power plan against the collected history.'),
+  'sizing': ('powerwallrl.commands.sizing',
+             'Sweep battery sizes and power plans over the collected history.'),
+  'fake-api': ('powerwallrl.commands.fake_api',
+               'Serve a local stand in for the Tesla and OpenWeatherMap APIs.'),
+}
+
+
+def import_seconds(module, repeats=3):
+  """ Best wall time to import module in a fresh interpreter, or None if it
+    can't be imported here.
+  """
+  best = None
+  for _ in range(repeats):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', 'import ' + module],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    if result.returncode:
+      return None
+    best = seconds if best is None else min(best, seconds)
+  return best
+
+
+def import_times():
+  from tabulate import tabulate
+  baseline = import_seconds('powerwallrl')
+  rows = []
+  for name, (module, _) in COMMANDS.items():
+    seconds = import_seconds(module)
+    rows.append([name, "failed" if seconds is None else
+                 "%0.0f" % ((seconds - baseline) * 1000)])
+  print(tabulate(rows, headers=["Command", "Import ms"]))
+  print("Beyond %0.0fms to start the interpreter." % (baseline * 1000))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog='python -m powerwallrl', description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  commands = parser.add_subparsers(dest='command', metavar='command',
+                                   required=True)
+  for name, (_, help) in COMMANDS.items():
+    # Options are parsed by the command itself.
+    commands.add_parser(name, help=help, add_help=False)
+  commands.add_parser('import-times',
+                      help='How long each command takes to import.')
+  args, rest = parser.parse_known_args()
+
+  if args.command == 'import-times':
+    import_times()
+    return
+  sys.argv = ['%s %s' % (parser.prog, args.command)] + rest
+  importlib.import_module(COMMANDS[args.command][0]).main()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,8 @@
+"""
+Offline analysis of the collected history, eg. pricing power plans and battery
+configurations without training a model.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
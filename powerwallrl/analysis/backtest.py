@@ -0,0 +1,286 @@
+""" This module backtests a battery policy over every day of the history at once.
+
+Each day starts from the same battery charge, so days don't depend on each other
+and can be simulated side by side. Every hour of the day builds one batch of
+observations, one per day, makes a single batched policy call, then steps every
+day's battery with the vectorized kernel, in substeps if the dataset was loaded
+with them. A policy acting every action_hours holds its targets in between, as
+the environment does. Rewards match HomePowerEnv evaluated without the backup
+and battery left rewards.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import copy
+import logging
+import numpy as np
+
+from tabulate import tabulate
+
+from powerwallrl.data.episodes import EPISODE_HOURS
+from powerwallrl.data.episodes import dayhour_to_datetime
+from powerwallrl.gym.dataset import BATTERY_POWER
+from powerwallrl.gym.dataset import CLOUDS
+from powerwallrl.gym.dataset import DAY_OF_WEEK
+from powerwallrl.gym.dataset import DAYHOUR
+from powerwallrl.gym.dataset import GRID_COST
+from powerwallrl.gym.dataset import GRID_POWER
+from powerwallrl.gym.dataset import HOUR_OF_DAY
+from powerwallrl.gym.dataset import SUN_ALTITUDE
+from powerwallrl.gym.dataset import SUN_AZIMUTH
+from powerwallrl.gym.dataset import TEMP
+from powerwallrl.gym.dataset import UVI
+from powerwallrl.gym.kernel import battery_step
+from powerwallrl.gym.kernel import battery_substeps
+
+logger = logging.getLogger(__name__)
+
+# Flattened HomePowerEnv observation, in the sorted key order FlattenObservation
+# uses, as (dataset column, space dtype). None is the battery charge.
+OBSERVATION_LAYOUT = (
+  (None, np.uint8),
+  (CLOUDS, np.uint8),
+  (DAY_OF_WEEK, np.uint8),
+  (GRID_COST, np.float16),
+  (HOUR_OF_DAY, np.uint8),
+  (SUN_ALTITUDE, np.float16),
+  (SUN_AZIMUTH, np.float16),
+  (TEMP, np.float16),
+  (UVI, np.float16),
+)
+
+# Battery wear in the reward, per Wh discharged. See HomePowerEnv.step.
+WEAR_PER_WH = 0.115 / 1000.0
+
+
+def observations(forecast, charge):
+  """ Flattened observations for a batch of days.
+
+    forecast is (days, 24, columns) of the next 24 episode rows and charge is
+    each day's battery percent. Values go through the same dtypes as the
+    environment's observation space.
+  """
+  parts = []
+  for column, dtype in OBSERVATION_LAYOUT:
+    if column is None:
+      values = np.asarray(charge).reshape(-1, 1)
+    else:
+      values = forecast[:, :, column]
+    parts.append(values.astype(dtype).astype(np.float16))
+  return np.concatenate(parts, axis=1)
+
+
+def model_policy(model, deterministic=True):
+  """ A backtest policy from a stable baselines model. """
+  def policy(obs):
+    actions, _ = model.predict(obs, deterministic=deterministic)
+    return actions
+  return policy
+
+
+def action_to_target(actions):
+  """ Backup reserve percent for each action, as HomePowerEnv.step does. """
+  return np.clip(np.round(np.asarray(actions)[:, 0] * 50 + 50), 0, 100)
+
+
+class Backtester(object):
+
+  def __init__(self, dataset, plan, battery, tz, battery_charge=30,
+               action_hours=1):
+    """ dataset is an EpisodeDataset, every midnight window is one day.
+
+      The policy is asked for targets every action_hours, from midnight.
+    """
+    if 24 % action_hours:
+      raise Exception("action_hours must divide a day evenly.")
+    self.dataset = dataset.daily()
+    self.plan = plan
+    self.battery = battery
+    self.tz = tz
+    self.battery_charge = battery_charge
+    self.action_hours = action_hours
+
+    self.days = np.array(self.dataset.windows, dtype=np.int64)
+    starts = np.array([dataset.row_index[w] for w in self.days],
+                      dtype=np.int64).reshape(-1, 1)
+    # (days, 48, columns) episode rows for every day.
+    self.rows = dataset.rows[starts + np.arange(EPISODE_HOURS)]
+    shortfall = (self.rows[:, :24, BATTERY_POWER] +
+                 self.rows[:, :24, GRID_POWER])
+    self.shortfall = shortfall
+    # (days, 24, substeps) shortfall Wh when the dataset has sub-hourly data.
+    self.substeps = (None if dataset.substeps is None else
+                     dataset.substeps[starts + np.arange(24)])
+    datetimes = [
+      dayhour_to_datetime(dayhour, tz)
+      for dayhour in self.rows[:, :24, DAYHOUR].ravel()
+    ]
+    # Cents per Wh, as HomePowerEnv.grid_usage and grid_feedback.
+    self.usage = plan.usage_array(datetimes).reshape(shortfall.shape) / 1000.0
+    self.feedback = (plan.feedback_array(datetimes).reshape(shortfall.shape) /
+                     1000.0)
+
+  def __len__(self):
+    return len(self.days)
+
+  def select(self, indices):
+    """ A backtester of just the days at indices, sharing nothing mutable. """
+    selected = copy.copy(self)
+    selected.days = self.days[indices]
+    selected.rows = self.rows[indices]
+    selected.shortfall = self.shortfall[indices]
+    if self.substeps is not None:
+      selected.substeps = self.substeps[indices]
+    selected.usage = self.usage[indices]
+    selected.feedback = self.feedback[indices]
+    return selected
+
+  def cost(self, shortfall):
+    """ Grid cost of each hour, negative when paid for feedback.
+
+      With substeps shortfall is (days, 24, substeps) and each substep is priced
+      separately.
+    """
+    usage, feedback = self.usage, self.feedback
+    if shortfall.ndim == 3:
+      usage, feedback = usage[..., None], feedback[..., None]
+      return np.where(shortfall > 0, shortfall * usage,
+                      shortfall * feedback).sum(axis=2)
+    return np.where(shortfall > 0, shortfall * usage, shortfall * feedback)
+
+  def run(self, policy):
+    """ Simulate every day under policy.
+
+      policy maps a (days, observation) batch to (days, 1) actions in -1 to 1,
+      or (days, 24) schedules of them, see model_policy().
+    """
+    n_days = len(self)
+    charge = np.full(n_days, self.battery_charge, dtype=np.float64)
+    charge_left = np.full(n_days, 100.0)
+    targets = np.empty((n_days, 24))
+    charges = np.empty((n_days, 25))
+    battery_wh = np.empty((n_days, 24))
+    after = np.empty((n_days, 24))
+    charges[:, 0] = charge
+    if self.substeps is not None:
+      after = np.empty(self.substeps.shape)
+      battery_wh = np.empty(self.substeps.shape)
+    schedule = None
+    for hour in range(24):
+      if schedule is None and hour % self.action_hours:
+        targets[:, hour] = targets[:, hour - 1]
+      elif schedule is None:
+        actions = np.asarray(
+          policy(observations(self.rows[:, hour:hour + 24], charge)))
+        # A schedule policy sets every hour's target from the first hour.
+        if actions.shape[1] == 24:
+          schedule = actions
+          targets[:] = np.clip(np.round(schedule * 50 + 50), 0, 100)
+        else:
+          targets[:, hour] = action_to_target(actions)
+      if self.substeps is None:
+        charge, charge_left, after[:, hour], battery_wh[:, hour] = (
+          battery_step(charge, charge_left, targets[:, hour],
+                       self.shortfall[:, hour], self.battery.capacity,
+                       self.battery.discharge_limit,
+                       self.battery.charge_limit))
+      else:
+        charge, charge_left, after[:, hour], battery_wh[:, hour] = (
+          battery_substeps(charge, charge_left, targets[:, hour],
+                           self.substeps[:, hour], self.battery.capacity,
+                           self.battery.discharge_limit,
+                           self.battery.charge_limit))
+      charges[:, hour + 1] = charge
+
+    before = self.shortfall if self.substeps is None else self.substeps
+    no_battery_cost = self.cost(before).sum(axis=1)
+    battery_cost = self.cost(after).sum(axis=1)
+    wear = np.maximum(battery_wh, 0).reshape(n_days, -1).sum(
+      axis=1) * WEAR_PER_WH
+    if self.substeps is not None:
+      after = after.sum(axis=2)
+      battery_wh = battery_wh.sum(axis=2)
+    return BacktestResult(self.rows[:, :24, DAYHOUR].astype(np.int64),
+                          no_battery_cost, battery_cost, wear, targets,
+                          charges, battery_wh, after)
+
+  def recorded(self):
+    """ The outcome of what the home's battery actually did each day.
+
+      Costs are priced hourly from the recorded grid power even with substeps,
+      and the targets and charges, which weren't recorded, are NaN.
+    """
+    n_days = len(self)
+    battery_wh = self.rows[:, :24, BATTERY_POWER]
+    after = self.rows[:, :24, GRID_POWER]
+    wear = np.maximum(battery_wh, 0).sum(axis=1) * WEAR_PER_WH
+    return BacktestResult(self.rows[:, :24, DAYHOUR].astype(np.int64),
+                          self.cost(self.shortfall).sum(axis=1),
+                          self.cost(after).sum(axis=1), wear,
+                          np.full((n_days, 24), np.nan),
+                          np.full((n_days, 25), np.nan), battery_wh, after)
+
+
+class BacktestResult(object):
+  """ Per day costs in cents and hourly traces of a backtest. """
+
+  def __init__(self, dayhours, no_battery_cost, battery_cost, wear, targets,
+               charges, battery_wh, shortfall):
+    # (days, 24) dayhour of each simulated hour.
+    self.dayhours = dayhours
+    self.days = dayhours[:, 0]
+    self.no_battery_cost = no_battery_cost
+    self.battery_cost = battery_cost
+    self.savings = no_battery_cost - battery_cost
+    # The evaluation reward HomePowerEnv gives each day.
+    self.reward = self.savings - wear
+    # (days, 24) backup reserve targets set each hour.
+    self.targets = targets
+    # (days, 25) battery percent at the start of each hour and end of the day.
+    self.charges = charges
+    # (days, 24) battery Wh, positive discharging.
+    self.battery_wh = battery_wh
+    # (days, 24) grid Wh after the battery, negative exporting.
+    self.shortfall = shortfall
+
+  def __len__(self):
+    return len(self.days)
+
+  def mean_reward(self):
+    return float(np.mean(self.reward)) if len(self) else 0.0
+
+  def monthly(self):
+    """ (month, days, no battery $, battery $, savings $) rows. """
+    months = self.days // 10000
+    rows = []
+    for month in np.unique(months):
+      selected = months == month
+      rows.append((int(month), int(selected.sum()),
+                   self.no_battery_cost[selected].sum() / 100.0,
+                   self.battery_cost[selected].sum() / 100.0,
+                   self.savings[selected].sum() / 100.0))
+    return rows
+
+  def report(self):
+    rows = self.monthly()
+    rows.append(('Total', len(self), self.no_battery_cost.sum() / 100.0,
+                 self.battery_cost.sum() / 100.0, self.savings.sum() / 100.0))
+    return tabulate([[
+      month, days, "%0.2f" % no_battery, "%0.2f" % battery, "%0.2f" % savings
+    ] for month, days, no_battery, battery, savings in rows],
+                    headers=["Month", "Days", "No Battery $", "Battery $",
+                             "Savings $"])
+
+  def traces(self):
+    """ One row per day hour, for saving the action traces. """
+    for i in range(len(self)):
+      for hour in range(24):
+        yield {
+          'dayhour': int(self.dayhours[i, hour]),
+          'target': int(self.targets[i, hour]),
+          'charge': int(self.charges[i, hour]),
+          'battery_wh': float(self.battery_wh[i, hour]),
+          'grid_wh': float(self.shortfall[i, hour]),
+        }
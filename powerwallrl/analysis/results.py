@@ -0,0 +1,272 @@
+""" This module keeps every day's backtest outcome so they can be queried later
+without re-running the environment.
+
+Each row is one day of one site, keyed by the model version that chose the
+actions, the data version of the history it ran on, the day and the policy, eg.
+'model' for a checkpoint or 'recorded' for what the home's battery actually
+did. A row holds the day's cost with and without the battery, its savings and
+reward, and its 24 backup reserve targets packed into bytes. A backtest's days
+are written in one transaction.
+
+A model version is a hash of the policy's parameters, so the same checkpoint
+gets the same version whether it is evaluated while training or loaded later.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import hashlib
+import logging
+import numpy as np
+import sqlite3
+import time
+
+from tabulate import tabulate
+
+from powerwallrl.data.episodes import EpisodeWindowIndex
+from powerwallrl.data.version import DataVersion
+
+logger = logging.getLogger(__name__)
+
+# The model version of results no model chose, eg. the recorded battery use.
+NO_MODEL = ''
+
+
+def model_version(model):
+  """ A short hash of a stable baselines model's policy parameters. """
+  digest = hashlib.sha1()
+  for name, tensor in sorted(model.policy.state_dict().items()):
+    digest.update(name.encode())
+    digest.update(tensor.detach().cpu().numpy().tobytes())
+  return digest.hexdigest()[:12]
+
+
+def dataset_version(config):
+  """ The data version of the history a site's episodes are loaded from. """
+  con = sqlite3.connect(config.database_location)
+  try:
+    data_version = DataVersion(con)
+    data_version.setup()
+    return data_version.version(EpisodeWindowIndex.TABLES)
+  finally:
+    con.close()
+
+
+def pack_targets(targets):
+  """ A day's 24 backup reserve targets as bytes, None if they're unknown. """
+  if np.isnan(targets).any():
+    return None
+  return np.asarray(targets, dtype=np.uint8).tobytes()
+
+
+def unpack_targets(blob):
+  if blob is None:
+    return np.full(24, np.nan)
+  return np.frombuffer(blob, dtype=np.uint8).astype(np.float64)
+
+
+class ResultsStore(object):
+
+  def __init__(self, database):
+    self.con = database
+
+  def setup(self):
+    """ Idempotent setup function for creating the SQL tables. """
+    cur = self.con.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS result (
+                model_version TEXT NOT NULL,
+                dataset_version INTEGER NOT NULL,
+                site TEXT NOT NULL,
+                policy TEXT NOT NULL,
+                day INTEGER NOT NULL,
+                no_battery_cost REAL NOT NULL,
+                battery_cost REAL NOT NULL,
+                savings REAL NOT NULL,
+                reward REAL NOT NULL,
+                targets BLOB,
+                PRIMARY KEY (model_version, dataset_version, site, policy,
+                             day)) WITHOUT ROWID;''')
+    # Comparing a policy's results with another's on the same days.
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS result_day
+                ON result(site, dataset_version, policy, day, savings);''')
+    # The most any model or policy has saved each day, recomputed for the
+    # recorded days as results are recorded so regret needn't search every
+    # result. A replaced result can lower a day's best.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS result_best (
+                site TEXT NOT NULL,
+                dataset_version INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                savings REAL NOT NULL,
+                PRIMARY KEY (site, dataset_version, day)) WITHOUT ROWID;''')
+    # One row per recorded backtest, to find the latest without the results.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS evaluation (
+                model_version TEXT NOT NULL,
+                site TEXT NOT NULL,
+                policy TEXT NOT NULL,
+                dataset_version INTEGER NOT NULL,
+                days INTEGER NOT NULL,
+                PRIMARY KEY (model_version, site, policy,
+                             dataset_version)) WITHOUT ROWID;''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS checkpoint (
+                model_version TEXT PRIMARY KEY,
+                created INTEGER NOT NULL,
+                location TEXT);''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS checkpoint_created
+                ON checkpoint(created);''')
+    self.con.commit()
+
+  def add_checkpoint(self, version, location=None, commit=True):
+    """ Remember when a model version was first seen, which orders them. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' INSERT OR IGNORE INTO checkpoint(model_version, created, location)
+          VALUES(?, ?, ?) ''', (version, int(time.time()), location))
+    if commit:
+      self.con.commit()
+
+  def record(self, result, model_version, dataset_version, policy='model',
+             site=None, location=None):
+    """ Save every day of a BacktestResult, replacing earlier runs of the same
+      key.
+    """
+    site = site or ''
+    rows = [(model_version, dataset_version, site, policy, int(result.days[i]),
+             float(result.no_battery_cost[i]), float(result.battery_cost[i]),
+             float(result.savings[i]), float(result.reward[i]),
+             pack_targets(result.targets[i]))
+            for i in range(len(result))]
+    cur = self.con.cursor()
+    try:
+      if model_version != NO_MODEL:
+        self.add_checkpoint(model_version, location, commit=False)
+      cur.executemany(
+        ''' INSERT OR REPLACE INTO result(model_version, dataset_version,
+              site, policy, day, no_battery_cost, battery_cost, savings,
+              reward, targets)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ''', rows)
+      cur.execute(
+        ''' INSERT OR REPLACE INTO evaluation(model_version, site, policy,
+              dataset_version, days)
+            VALUES(?, ?, ?, ?, ?) ''',
+        (model_version, site, policy, dataset_version, len(rows)))
+      if rows:
+        cur.execute(
+          ''' INSERT OR REPLACE INTO result_best(site, dataset_version, day,
+                savings)
+              SELECT site, dataset_version, day, MAX(savings) FROM result
+              WHERE site = ? AND dataset_version = ? AND day BETWEEN ? AND ?
+              GROUP BY day ''',
+          (site, dataset_version, int(result.days.min()),
+           int(result.days.max())))
+      self.con.commit()
+    except Exception:
+      self.con.rollback()
+      raise
+    logger.info("Recorded %d days of %s results for model %s.", len(rows),
+                policy, model_version or "none")
+    return len(rows)
+
+  def checkpoints(self, last=10):
+    """ The last model versions seen, newest first. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT model_version FROM checkpoint
+          ORDER BY created DESC, rowid DESC LIMIT ? ''', (last,))
+    return [row[0] for row in cur.fetchall()]
+
+  def days(self, model_version, dataset_version, policy='model', site=None):
+    """ (day, no battery cents, battery cents, savings cents, targets) rows. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT day, no_battery_cost, battery_cost, savings, targets
+          FROM result
+          WHERE model_version = ? AND dataset_version = ? AND site = ?
+            AND policy = ?
+          ORDER BY day ''',
+      (model_version, dataset_version, site or '', policy))
+    return [(day, no_battery, battery, savings, unpack_targets(targets))
+            for day, no_battery, battery, savings, targets in cur.fetchall()]
+
+  def monthly(self, model_versions, policy='model'):
+    """ (model version, month, days, savings $) rows across every site, each on
+      the latest data version the model was evaluated on.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' WITH latest AS (
+            SELECT model_version, site, MAX(dataset_version) AS dataset_version
+            FROM evaluation
+            WHERE policy = ? AND model_version IN (%s)
+            GROUP BY model_version, site)
+          SELECT model_version, day / 10000, COUNT(*), SUM(savings) / 100.0
+          FROM latest
+          JOIN result USING (model_version, site, dataset_version)
+          WHERE result.policy = ?
+          GROUP BY model_version, day / 10000
+          ORDER BY model_version, day / 10000 ''' %
+      ','.join('?' * len(model_versions)),
+      (policy,) + tuple(model_versions) + (policy,))
+    return cur.fetchall()
+
+  def regret_by_month(self, last=10, policy='model', baseline=None):
+    """ (model version, month, days, regret $) rows for the last checkpoints,
+      each on the latest data version it was evaluated on.
+
+      A day's regret is how much more the baseline policy saved that day, on
+      the same site and data version, by the latest model evaluated under the
+      baseline policy there. Without a baseline it is measured against
+      the most any model or policy has been recorded saving that day.
+    """
+    versions = self.checkpoints(last)
+    if not versions:
+      return []
+    if baseline is None:
+      best = ''' result_best best '''
+      params = ()
+    else:
+      # Only the baseline's latest evaluated model on each site and data
+      # version, so each day is compared once. SQLite takes the bare
+      # model_version from the row with the latest checkpoint.
+      best = ''' (SELECT site, dataset_version, day, savings
+                  FROM result
+                  JOIN (SELECT site, dataset_version, model_version,
+                               MAX(COALESCE(checkpoint.created, 0))
+                        FROM evaluation
+                        LEFT JOIN checkpoint USING (model_version)
+                        WHERE policy = ?
+                        GROUP BY site, dataset_version)
+                  USING (site, dataset_version, model_version)
+                  WHERE policy = ?) best '''
+      params = (baseline, baseline)
+    cur = self.con.cursor()
+    cur.execute(
+      ''' WITH latest AS (
+            SELECT model_version, site, MAX(dataset_version) AS dataset_version
+            FROM evaluation
+            WHERE policy = ? AND model_version IN (%s)
+            GROUP BY model_version, site)
+          SELECT result.model_version, result.day / 10000, COUNT(*),
+                 SUM(best.savings - result.savings) / 100.0
+          FROM latest
+          JOIN result USING (model_version, site, dataset_version)
+          JOIN %s USING (site, dataset_version, day)
+          WHERE result.policy = ?
+          GROUP BY result.model_version, result.day / 10000 ''' %
+      (','.join('?' * len(versions)), best),
+      (policy,) + tuple(versions) + params + (policy,))
+    order = {version: i for i, version in enumerate(versions)}
+    return sorted(cur.fetchall(), key=lambda row: (order[row[0]], row[1]))
+
+  def regret_report(self, last=10, policy='model', baseline=None):
+    return tabulate([[
+      version, month, days, "%0.2f" % regret
+    ] for version, month, days, regret in self.regret_by_month(
+      last, policy, baseline)],
+                    headers=["Model", "Month", "Days", "Regret $"])
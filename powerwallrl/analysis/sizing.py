@@ -0,0 +1,129 @@
+""" This module answers what-if questions about the battery, eg. whether a
+second Powerwall, a larger one or a different power plan would pay off, from a
+site's recorded history and without training a model.
+
+Every battery configuration, backup reserve and plan in a grid is evaluated
+with the self consumption heuristic of the tariff comparison. The history is
+stepped hour by hour once, with every configuration stepped together as arrays
+through the battery kernel, and each configuration's grid flows are then priced
+under every plan in a single matrix product.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import itertools
+import logging
+import numpy as np
+
+from tabulate import tabulate
+
+from powerwallrl.analysis.tariffs import HOURS_PER_YEAR
+from powerwallrl.analysis.tariffs import price
+from powerwallrl.analysis.tariffs import registered_plans
+from powerwallrl.analysis.tariffs import simulate
+from powerwallrl.gym.battery import Battery
+
+logger = logging.getLogger(__name__)
+
+
+def battery_grid(counts=(1,), capacities=(13500,), discharge_rates=(5000,),
+                 charge_rates=(3300,)):
+  """ A Battery for every combination of the given options. """
+  return [
+    Battery(capacity=capacity, discharge_rate=discharge_rate,
+            charge_rate=charge_rate, count=count)
+    for count, capacity, discharge_rate, charge_rate in itertools.product(
+      counts, capacities, discharge_rates, charge_rates)
+  ]
+
+
+class SizingSweep(object):
+
+  def __init__(self, history, batteries, reserves=(20,), plans=None,
+               battery_price=None):
+    """ battery_price is the installed $ of one battery, for payback years. """
+    self.history = history
+    self.batteries = batteries
+    self.reserves = reserves
+    self.plans = plans or registered_plans()
+    self.battery_price = battery_price
+
+  def __len__(self):
+    return len(self.batteries) * len(self.reserves) * len(self.plans)
+
+  def sweep(self):
+    """ Yearly costs in dollars for every configuration and plan, cheapest
+      first.
+    """
+    if not len(self.history):
+      raise Exception("No power history to size batteries against.")
+
+    shortfalls = np.concatenate([
+      self.history.shortfall[None, :],
+      simulate(self.history, self.batteries, self.reserves)
+    ])
+    names = list(self.plans)
+    years = self.history.hours / HOURS_PER_YEAR
+    # (1 + configurations, plans), the first row without a battery.
+    yearly = price(shortfalls, [self.plans[name] for name in names],
+                   self.history.datetimes) / 100.0 / years
+
+    results = []
+    configs = itertools.product(self.batteries, self.reserves)
+    for i, (battery, reserve) in enumerate(configs):
+      for j, name in enumerate(names):
+        savings = yearly[0, j] - yearly[i + 1, j]
+        payback = None
+        if self.battery_price is not None and savings > 0:
+          payback = self.battery_price * battery.count / savings
+        results.append({
+          'plan': name,
+          'count': battery.count,
+          'capacity': battery.unit_capacity,
+          'discharge_rate': battery.unit_discharge_rate,
+          'charge_rate': battery.unit_charge_rate,
+          'reserve': reserve,
+          'no_battery_yearly': yearly[0, j],
+          'battery_yearly': yearly[i + 1, j],
+          'savings_yearly': savings,
+          'payback_years': payback,
+        })
+    return sorted(results, key=lambda r: r['battery_yearly'])
+
+  def curves(self, results=None):
+    """ Yearly cost against battery count, per plan and battery model.
+
+      Returns {(plan, capacity, discharge rate, charge rate, reserve): [(count,
+      yearly $), ...]}.
+    """
+    curves = {}
+    for r in results or self.sweep():
+      key = (r['plan'], r['capacity'], r['discharge_rate'], r['charge_rate'],
+             r['reserve'])
+      curves.setdefault(key, []).append((r['count'], r['battery_yearly']))
+    return {key: sorted(points) for key, points in curves.items()}
+
+  def report(self, top=20, results=None):
+    results = results or self.sweep()
+    return ("%d battery and plan combinations priced from %s to %s\n" % (
+      len(results),
+      self.history.datetimes[0].strftime('%Y-%m-%d %H:00'),
+      self.history.datetimes[-1].strftime('%Y-%m-%d %H:00')) + tabulate(
+        [[
+          r['plan'],
+          r['count'],
+          "%d" % r['capacity'],
+          "%d/%d" % (r['discharge_rate'], r['charge_rate']),
+          "%d%%" % r['reserve'],
+          "%0.2f" % r['no_battery_yearly'],
+          "%0.2f" % r['battery_yearly'],
+          "%0.2f" % r['savings_yearly'],
+          "-" if r['payback_years'] is None else
+          "%0.1f" % r['payback_years'],
+        ] for r in results[:top]],
+        headers=[
+          "Plan", "Batteries", "Wh Each", "W Out/In", "Reserve",
+          "No Battery $/yr", "Battery $/yr", "Saves $/yr", "Payback Years"
+        ]))
@@ -0,0 +1,141 @@
+""" This module prices every registered power plan against the same stretch of
+recorded home usage and solar, so a retail plan can be chosen for a site without
+training a model against each one.
+
+The home's grid flows are simulated once per scenario, with no battery and with
+a fixed self consumption battery heuristic, since neither depends on the plan.
+Every plan is then priced against every scenario in a single matrix product.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import itertools
+import logging
+import numpy as np
+
+from tabulate import tabulate
+
+import powerwallrl.powerplans
+import powerwallrl.powerplans.powerplan
+from powerwallrl.gym.battery import Battery
+from powerwallrl.gym.kernel import battery_step
+
+logger = logging.getLogger(__name__)
+
+HOURS_PER_YEAR = 365.25 * 24
+
+
+def registered_plans():
+  """ An instance of every registered plan that prices usage and feedback. """
+  return {
+    name: cls()
+    for name, cls in sorted(powerwallrl.powerplans.registry.items())
+    if cls.is_complete()
+  }
+
+
+def simulate(history, batteries, reserves, battery_charge=50):
+  """ (configurations, hours) grid shortfall Wh under self consumption.
+
+    Each battery and reserve percent is a batteries x reserves configuration,
+    in that order, all stepped together as arrays through the battery kernel.
+    See self_consumption().
+  """
+  configs = list(itertools.product(batteries, reserves))
+  capacity = np.array([battery.capacity for battery, _ in configs])
+  discharge_limit = np.array(
+    [battery.discharge_limit for battery, _ in configs])
+  charge_limit = np.array([battery.charge_limit for battery, _ in configs])
+  reserve = np.array([reserve for _, reserve in configs], dtype=np.float64)
+
+  shortfall = history.shortfall
+  after = np.empty((len(configs), len(history)))
+  charge = np.full(len(configs), battery_charge, dtype=np.float64)
+  charge_left = np.full(len(configs), 100.0)
+  for i, dt in enumerate(history.datetimes):
+    # The charge allowance resets daily, like it does every episode.
+    if dt.hour == 0:
+      charge_left[:] = 100
+    charge, charge_left, after[:, i], _ = battery_step(
+      charge, charge_left, reserve, shortfall[i], capacity, discharge_limit,
+      charge_limit)
+  return after
+
+
+def self_consumption(history, battery, reserve_percent=20, battery_charge=50):
+  """ Grid shortfall per hour with the battery left in self powered mode.
+
+    The backup reserve stays at reserve_percent, so the battery soaks up excess
+    solar and covers the home until it reaches the reserve, same as the
+    HomePowerEnv battery rules with a constant action.
+  """
+  return simulate(history, [battery], [reserve_percent], battery_charge)[0]
+
+
+def price(shortfalls, plans, datetimes):
+  """ Grid cost in cents of each shortfall series under each plan.
+
+    shortfalls is (scenarios, hours) of Wh, returns (scenarios, plans).
+  """
+  usage = np.stack([plan.usage_array(datetimes) for plan in plans])
+  feedback = np.stack([plan.feedback_array(datetimes) for plan in plans])
+  imports = np.maximum(shortfalls, 0)
+  exports = np.maximum(shortfalls * -1, 0)
+  # Plans are in cents per kWh and flows are in Wh.
+  return (imports @ usage.T - exports @ feedback.T) / 1000.0
+
+
+class TariffComparison(object):
+
+  def __init__(self, history, battery=None, reserve_percent=20, plans=None):
+    self.history = history
+    self.battery = battery or Battery()
+    self.reserve_percent = reserve_percent
+    self.plans = plans or registered_plans()
+
+  def compare(self):
+    """ Costs in dollars per plan, cheapest with a battery first. """
+    if not len(self.history):
+      raise Exception("No power history to compare plans against.")
+
+    shortfalls = np.stack([
+      self.history.shortfall,
+      self_consumption(self.history, self.battery, self.reserve_percent)
+    ])
+    names = list(self.plans)
+    costs = price(shortfalls, [self.plans[name] for name in names],
+                  self.history.datetimes) / 100.0
+    years = self.history.hours / HOURS_PER_YEAR
+
+    results = []
+    for i, name in enumerate(names):
+      results.append({
+        'plan': name,
+        'no_battery': costs[0, i],
+        'battery': costs[1, i],
+        'savings': costs[0, i] - costs[1, i],
+        'no_battery_yearly': costs[0, i] / years,
+        'battery_yearly': costs[1, i] / years,
+      })
+    return sorted(results, key=lambda r: r['battery'])
+
+  def report(self):
+    results = self.compare()
+    return ("Plans priced from %s to %s, battery reserve %d%%\n" % (
+      self.history.datetimes[0].strftime('%Y-%m-%d %H:00'),
+      self.history.datetimes[-1].strftime('%Y-%m-%d %H:00'),
+      self.reserve_percent) + tabulate(
+        [[
+          r['plan'],
+          "%0.2f" % r['no_battery'],
+          "%0.2f" % r['battery'],
+          "%0.2f" % r['savings'],
+          "%0.2f" % r['no_battery_yearly'],
+          "%0.2f" % r['battery_yearly'],
+        ] for r in results],
+        headers=[
+          "Plan", "No Battery $", "Battery $", "Battery Saves $",
+          "No Battery $/yr", "Battery $/yr"
+        ]))
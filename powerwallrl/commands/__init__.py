@@ -0,0 +1,10 @@
+"""
+The powerwall-rl commands, run with python -m powerwallrl <command>.
+
+Each command is its own module so that only the command being run is imported,
+along with just the dependencies it needs.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
@@ -0,0 +1,91 @@
+"""  This script backtests the trained model over every day of the collected
+  history and prints its monthly savings against having no battery. Every day's
+  outcome, and that of the recorded battery use, is kept in the results store.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+# To remove GDK errors so that this can run headless, without importing
+# matplotlib until something needs it.
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import argparse
+import csv
+import dateutil.tz
+import logging
+import sqlite3
+import sys
+
+from powerwallrl.analysis.backtest import Backtester
+from powerwallrl.analysis.backtest import model_policy
+from powerwallrl.analysis.results import NO_MODEL
+from powerwallrl.analysis.results import ResultsStore
+from powerwallrl.analysis.results import dataset_version
+from powerwallrl.analysis.results import model_version
+from powerwallrl.gym.dataset import load_dataset
+from powerwallrl.settings import PowerwallRLConfig
+
+from stable_baselines3 import PPO
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--battery-charge', type=int, default=30,
+                      help='Battery percent every day starts from.')
+  parser.add_argument('--substeps', type=int, default=None,
+                      help='Simulate each hour in this many steps from the 5 '
+                      'minute data, eg. 12.')
+  parser.add_argument('--action-hours', type=int, default=1,
+                      help='Hours the model holds each action for, as it was '
+                      'trained with.')
+  parser.add_argument('--traces', default=None,
+                      help='CSV file to save every hour\'s actions to.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  model = PPO.load(config.model_location)
+  version = model_version(model)
+  results = ResultsStore(sqlite3.connect(config.results_location))
+  results.setup()
+
+  for site in config.sites:
+    backtester = Backtester(load_dataset(site, site.grid_plan,
+                                         substeps=args.substeps),
+                            site.grid_plan, site.battery,
+                            dateutil.tz.gettz(site.local_timezone),
+                            args.battery_charge, args.action_hours)
+    result = backtester.run(model_policy(model))
+    logger.info("Backtest for %s:\n%s", site.site_id or "home",
+                result.report())
+    data_version = dataset_version(site)
+    results.record(result, version, data_version, site=site.site_id,
+                   location=config.model_location)
+    results.record(backtester.recorded(), NO_MODEL, data_version,
+                   policy='recorded', site=site.site_id)
+
+    if args.traces:
+      path = (args.traces if site.site_id is None else
+              "%s.%s" % (args.traces, site.site_id))
+      with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=[
+          'dayhour', 'target', 'charge', 'battery_wh', 'grid_wh'])
+        writer.writeheader()
+        writer.writerows(result.traces())
+      logger.info("Saved action traces to %s", path)
+
+
+if __name__ == "__main__":
+  main()
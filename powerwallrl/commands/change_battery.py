@@ -0,0 +1,62 @@
+"""  This script will use the collected weather and power data to create a most
+  rewarding model for setting the battery state.
+
+  Every configured site has its backup reserve set for the current hour from
+  its cached schedule, which is recomputed when the forecast changes. --mpc
+  plans the schedule by optimizing over the forecast instead, without a model.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+# To remove GDK errors so that this can run headless, without importing
+# matplotlib until something needs it.
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import argparse
+import logging
+import sys
+
+from powerwallrl.control.fleet import FleetController
+from powerwallrl.settings import PowerwallRLConfig
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--account-concurrency', type=int, default=4,
+                      help='Tesla calls in flight per account.')
+  parser.add_argument('--timeout', type=float, default=15.0,
+                      help='Seconds before a Tesla call is given up on.')
+  parser.add_argument('--mpc', action='store_true',
+                      help='Plan reserves with the model predictive '
+                      'controller rather than the trained model.')
+  parser.add_argument('--analogs', action='store_true',
+                      help='With --mpc, forecast load and solar from '
+                      'historical analogs of the weather forecast.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  controller = FleetController(config.sites,
+                               account_concurrency=args.account_concurrency,
+                               timeout=args.timeout, mpc=args.mpc,
+                               analogs=args.analogs)
+  controller.run()
+  logger.info("\n" + controller.report())
+
+  logger.debug("Action taken.")
+
+
+if __name__ == "__main__":
+  main()
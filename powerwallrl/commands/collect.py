@@ -0,0 +1,69 @@
+"""  This script will create the necessary databases for data collection and
+trigger an initial backfill of the database given the available data.
+
+Unfortunately I don't know of any free/good historical API for weather, so you
+can only really wait for enough weather data to train.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import logging
+import sys
+import time
+
+from powerwallrl.data.metrics import metrics
+from powerwallrl.data.scheduler import IngestionScheduler
+from powerwallrl.settings import PowerwallRLConfig
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--weather-calls-per-minute', type=int, default=60,
+                      help='OpenWeatherMap calls allowed per minute.')
+  parser.add_argument('--tesla-calls-per-minute', type=int, default=30,
+                      help='Tesla history calls allowed per minute per account.')
+  parser.add_argument('--account-concurrency', type=int, default=4,
+                      help='Tesla calls in flight per account.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  root = logging.getLogger()
+  root.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  root.addHandler(handler)
+
+  config = PowerwallRLConfig()
+
+  # Written at the start too, so an overlapping or stalled run shows up as a
+  # start time without a matching finish.
+  start = time.time()
+  metrics.set('powerwallrl_collect_start_timestamp_seconds', start)
+  metrics.set('powerwallrl_collect_in_progress', 1)
+  metrics.write_textfile(config.metrics_location)
+  try:
+    scheduler = IngestionScheduler(
+      config.sites,
+      weather_calls_per_minute=args.weather_calls_per_minute,
+      tesla_calls_per_minute=args.tesla_calls_per_minute,
+      account_concurrency=args.account_concurrency)
+    sites = scheduler.run()
+    root.info("\n" + scheduler.report())
+    if all(site.status == 'ok' for site in sites):
+      metrics.set('powerwallrl_collect_success_timestamp_seconds', time.time())
+  finally:
+    metrics.set('powerwallrl_collect_in_progress', 0)
+    metrics.set('powerwallrl_collect_duration_seconds', time.time() - start)
+    metrics.write_textfile(config.metrics_location)
+
+  root.debug("All done.")
+
+
+if __name__ == "__main__":
+  main()
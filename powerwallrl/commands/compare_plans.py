@@ -0,0 +1,49 @@
+"""  This script prices every registered power plan against the collected usage
+  and solar history, with and without the battery, and prints them ranked.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import logging
+import sqlite3
+import sys
+
+from powerwallrl.analysis.tariffs import TariffComparison
+from powerwallrl.data.history import load_history
+from powerwallrl.settings import PowerwallRLConfig
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--start', type=int, default=None,
+                      help='First day to price, YYYYMMDD.')
+  parser.add_argument('--end', type=int, default=None,
+                      help='Last day to price, YYYYMMDD.')
+  parser.add_argument('--reserve', type=int, default=20,
+                      help='Backup reserve percent for the battery heuristic.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  db = sqlite3.connect(config.database_location)
+  history = load_history(db, config.local_timezone,
+                         args.start and args.start * 100,
+                         args.end and args.end * 100 + 23)
+  comparison = TariffComparison(history, config.battery, args.reserve)
+  logger.info("\n" + comparison.report())
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,73 @@
+"""  This script serves a local stand in for the Tesla and OpenWeatherMap APIs,
+  and the Powerwall gateway, for benchmarking and load testing data collection
+  and battery control offline. Point the config at it with:
+
+    tesla_api_url = http://127.0.0.1:8642/
+    openweathermap_url = http://127.0.0.1:8642/data/2.5/onecall
+    gateway_url = http://127.0.0.1:8642/
+
+  Request counts by endpoint and status are served at /stats.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import logging
+import sys
+
+from powerwallrl.data.fake_api import FakeApi
+from powerwallrl.data.fake_api import FakeApiServer
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8642)
+  parser.add_argument('--energy-site-ids', type=int, nargs='+', default=[1],
+                      help='Energy sites on every Tesla account.')
+  parser.add_argument('--latency', type=float, default=0.0,
+                      help='Seconds every response is delayed.')
+  parser.add_argument('--jitter', type=float, default=0.0,
+                      help='Up to this many more seconds of random delay.')
+  parser.add_argument('--throttle-rate', type=float, default=0.0,
+                      help='Fraction of requests answered with a 429.')
+  parser.add_argument('--error-rate', type=float, default=0.0,
+                      help='Fraction of requests answered with a 503.')
+  parser.add_argument('--calls-per-minute', type=int, default=None,
+                      help='Requests per endpoint per minute before 429s.')
+  parser.add_argument('--recordings', default=None,
+                      help='Directory of recorded <endpoint>.json responses.')
+  parser.add_argument('--seed', type=int, default=None,
+                      help='Seed for reproducible latency and faults.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  api = FakeApi(args.energy_site_ids, latency=args.latency, jitter=args.jitter,
+                throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                calls_per_minute=args.calls_per_minute,
+                recordings=args.recordings, seed=args.seed)
+  server = FakeApiServer(api, args.host, args.port)
+  logger.info("Serving the fake Tesla and OpenWeatherMap APIs at %s",
+              server.url)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == "__main__":
+  main()
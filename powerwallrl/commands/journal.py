@@ -0,0 +1,48 @@
+"""  This script reports what every site's production decisions earned over the
+  last days, against the best schedule in hindsight, and whether the captured
+  savings are drifting. Outcomes are settled from any newly arrived power data
+  first.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import logging
+import sqlite3
+import sys
+
+from powerwallrl.control.journal import DecisionJournal
+from powerwallrl.settings import PowerwallRLConfig
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--last', type=int, default=14,
+                      help='How many of the latest settled days to report.')
+  parser.add_argument('--hours', action='store_true',
+                      help='Also report each hour of the day\'s savings.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see the report.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  for site in config.sites:
+    journal = DecisionJournal(sqlite3.connect(site.database_location), site)
+    journal.update()
+    logger.info("\n%s\n%s", site.site_id or 'home', journal.report(args.last))
+    if args.hours:
+      logger.info("\n" + journal.hourly_report())
+
+
+if __name__ == "__main__":
+  main()
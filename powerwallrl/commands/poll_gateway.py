@@ -0,0 +1,81 @@
+"""  This script polls the Powerwall gateway of every site with a gateway_url
+  every few seconds, keeping the latest samples and writing each completed
+  hour to the powerwall table. Run it as a service, it polls until stopped.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import logging
+import sqlite3
+import sys
+import threading
+
+from powerwallrl.data.gateway import GatewayClient
+from powerwallrl.data.gateway import GatewayPoller
+from powerwallrl.data.gateway import GatewayStore
+from powerwallrl.settings import PowerwallRLConfig
+
+
+def poll_site(site, poller_ready, duration, interval):
+  """ Poll one site's gateway, on this thread's own database connection. """
+  store = GatewayStore(sqlite3.connect(site.database_location),
+                       site.local_timezone, site.gateway_buffer_size)
+  store.setup()
+  poller = GatewayPoller(GatewayClient(site.gateway_url,
+                                       site.gateway_password),
+                         store, interval or site.gateway_interval,
+                         site.site_id or 'home')
+  poller_ready(poller)
+  poller.run(duration)
+  logging.getLogger().info("Polled %d samples for %s, %d failed.",
+                           poller.samples, poller.name, poller.errors)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--interval', type=float, default=None,
+                      help='Seconds between polls, over gateway_interval.')
+  parser.add_argument('--duration', type=float, default=None,
+                      help='Stop after this many seconds.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  sites = [site for site in config.sites if site.gateway_url]
+  if not sites:
+    raise Exception("No site has a gateway_url to poll.")
+
+  pollers = []
+  threads = [
+    threading.Thread(target=poll_site,
+                     args=(site, pollers.append, args.duration, args.interval),
+                     daemon=True) for site in sites
+  ]
+  for thread in threads:
+    thread.start()
+  try:
+    for thread in threads:
+      # A timeout keeps the main thread responsive to Ctrl-C.
+      while thread.is_alive():
+        thread.join(1.0)
+  except KeyboardInterrupt:
+    for poller in pollers:
+      poller.stop()
+    for thread in threads:
+      thread.join()
+
+
+if __name__ == "__main__":
+  main()
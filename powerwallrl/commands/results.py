@@ -0,0 +1,51 @@
+"""  This script reports the regret of the last model checkpoints by month, from
+  the results store that training and backtesting fill, without re-running the
+  environment.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import logging
+import sqlite3
+import sys
+import time
+
+from powerwallrl.analysis.results import ResultsStore
+from powerwallrl.settings import PowerwallRLConfig
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--last', type=int, default=10,
+                      help='How many of the latest checkpoints to report.')
+  parser.add_argument('--policy', default='model',
+                      help='The policy to report the regret of.')
+  parser.add_argument('--baseline', default=None,
+                      help='Measure regret against this policy, eg. recorded, '
+                      'rather than the best result recorded for each day.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see the report.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  results = ResultsStore(sqlite3.connect(config.results_location))
+  results.setup()
+  start = time.perf_counter()
+  report = results.regret_report(args.last, args.policy, args.baseline)
+  logger.info("\n" + report)
+  logger.info("Queried in %0.1fms.", (time.perf_counter() - start) * 1000)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,98 @@
+"""  This script will create the necessary databases for data collection and
+trigger an initial backfill of the database given the available data.
+
+Unfortunately I don't know of any free/good historical API for weather, so you
+can only really wait for enough weather data to train.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import os
+import sqlite3
+import logging
+import sys
+import teslapy
+import time
+
+from powerwallrl.data.analogs import AnalogIndex
+from powerwallrl.data.episodes import EpisodeWindowIndex
+from powerwallrl.data.weather import WeatherData
+from powerwallrl.data.tesla import TeslaPowerwallData
+from powerwallrl.data.tesla import tesla_client
+from powerwallrl.settings import PowerwallRLConfig
+
+def custom_auth(url):
+    # Only a browser login needs the GUI toolkit.
+    import webview
+    result = ['']
+    window = webview.create_window('Login', url)
+    def on_loaded():
+        result[0] = window.get_current_url()
+        if 'void/callback' in result[0].split('?')[0]:
+            window.destroy()
+    window.loaded += on_loaded
+    webview.start()
+    return result[0]
+
+def main():
+  # Log INFO level message to stdout for the user to see progress.
+  root = logging.getLogger()
+  root.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  root.addHandler(handler)
+
+  config = PowerwallRLConfig()
+
+  for site in config.sites:
+    root.info("Setting up and backfilling data to database: %s",
+              site.database_location)
+
+    # Weather Data.
+    os.makedirs(os.path.dirname(site.database_location), exist_ok=True)
+    db = sqlite3.connect(site.database_location)
+    weather = WeatherData(site.openweathermap_api_key, site.latitude,
+                          site.longitude, db, site.local_timezone,
+                          site.openweathermap_url)
+    root.info("Setting up weather data database tables.")
+    weather.setup()
+    root.info("Collecting weather data.")
+    weather.save_weather_data()
+
+    tesla = tesla_client(site.tesla_username, site.tesla_cache_file,
+                         site.tesla_api_url)
+    if not tesla.authorized:
+      # Setup Tesla API authentication
+      with teslapy.Tesla(email=site.tesla_username, cache_file=site.tesla_cache_file) as tesla:
+        print('Use browser to login. Page Not Found will be shown at success.')
+        print('Open this URL: ' + tesla.authorization_url())
+        tesla.fetch_token(authorization_response=input(
+            'Enter URL after authentication to cache authorization token '
+            'locally: '))
+
+    # Power Data.
+    powerwall = TeslaPowerwallData(site.tesla_username, db,
+                                   site.local_timezone,
+                                   site.tesla_cache_file,
+                                   site.energy_site_id,
+                                   api_url=site.tesla_api_url)
+    root.info("Setting up powerwall data database tables.")
+    powerwall.setup()
+    root.info("Backfilling powerwall data. (Depending on how long installation "
+              "date was ago, this might take quite sometime.)")
+    powerwall.backfill_data()
+
+    root.info("Building episode window index.")
+    EpisodeWindowIndex(db, site.local_timezone).update()
+    root.info("Building analog forecast index.")
+    AnalogIndex(db).update()
+
+  root.info("All setup! Now setup regular data collection.")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,97 @@
+"""  This script sweeps battery counts, sizes, rates, backup reserves and power
+  plans over the collected history and prints the cheapest by yearly cost, to
+  see whether another battery or a different plan would pay off.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import argparse
+import csv
+import logging
+import sqlite3
+import sys
+import time
+
+from powerwallrl.analysis.sizing import SizingSweep
+from powerwallrl.analysis.sizing import battery_grid
+from powerwallrl.analysis.tariffs import registered_plans
+from powerwallrl.data.history import load_history
+from powerwallrl.settings import PowerwallRLConfig
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--start', type=int, default=None,
+                      help='First day to price, YYYYMMDD.')
+  parser.add_argument('--end', type=int, default=None,
+                      help='Last day to price, YYYYMMDD.')
+  parser.add_argument('--counts', type=int, nargs='+', default=[1, 2, 3],
+                      help='Numbers of batteries to try.')
+  parser.add_argument('--capacities', type=float, nargs='+', default=None,
+                      help='Usable Wh of one battery to try, defaults to the '
+                      'configured battery\'s.')
+  parser.add_argument('--discharge-rates', type=float, nargs='+',
+                      default=None,
+                      help='Most W one battery discharges to try.')
+  parser.add_argument('--charge-rates', type=float, nargs='+', default=None,
+                      help='Most W one battery charges to try.')
+  parser.add_argument('--reserves', type=int, nargs='+', default=[20],
+                      help='Backup reserve percents for the battery heuristic.')
+  parser.add_argument('--plans', nargs='+', default=None,
+                      help='Power plans to try, defaults to every plan.')
+  parser.add_argument('--battery-price', type=float, default=None,
+                      help='Installed $ of one battery, to show payback years.')
+  parser.add_argument('--top', type=int, default=20,
+                      help='How many of the cheapest results to print.')
+  parser.add_argument('--csv', default=None,
+                      help='CSV file to save every result to.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  battery = config.battery
+  plans = registered_plans()
+  if args.plans:
+    missing = set(args.plans) - set(plans)
+    if missing:
+      raise Exception("Unknown power plans: %s" % ', '.join(sorted(missing)))
+    plans = {name: plans[name] for name in args.plans}
+  batteries = battery_grid(
+    args.counts, args.capacities or [battery.unit_capacity],
+    args.discharge_rates or [battery.unit_discharge_rate],
+    args.charge_rates or [battery.unit_charge_rate])
+
+  db = sqlite3.connect(config.database_location)
+  history = load_history(db, config.local_timezone,
+                         args.start and args.start * 100,
+                         args.end and args.end * 100 + 23)
+  sweep = SizingSweep(history, batteries, args.reserves, plans,
+                      args.battery_price)
+  start = time.perf_counter()
+  results = sweep.sweep()
+  logger.info("Swept %d battery and plan combinations over %d hours in "
+              "%0.2fs.",
+              len(results), len(history), time.perf_counter() - start)
+  logger.info("\n" + sweep.report(args.top, results))
+
+  if args.csv:
+    with open(args.csv, 'w', newline='') as f:
+      writer = csv.DictWriter(f, fieldnames=list(results[0]))
+      writer.writeheader()
+      writer.writerows(results)
+    logger.info("Saved every result to %s", args.csv)
+
+
+if __name__ == "__main__":
+  main()
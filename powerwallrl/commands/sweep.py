@@ -0,0 +1,63 @@
+"""  This script sweeps PPO hyperparameters for the home over the collected data
+  and saves the ranked trials next to the model, where train_model.py picks up
+  the best settings.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+# To remove GDK errors so that this can run headless, without importing
+# matplotlib until something needs it.
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import argparse
+import logging
+import sys
+
+from powerwallrl.gym.dataset import load_dataset
+from powerwallrl.settings import PowerwallRLConfig
+from powerwallrl.train.sweep import SweepRunner
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--trials', type=int, default=32)
+  parser.add_argument('--cores-per-trial', type=int, default=2)
+  parser.add_argument('--timesteps', type=int, default=50000,
+                      help='Training timesteps per trial per fold.')
+  parser.add_argument('--folds', type=int, default=3)
+  parser.add_argument('--budget-hours', type=float, default=None,
+                      help='Stop starting new trials after this many hours.')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  dataset = load_dataset(config, config.grid_plan)
+
+  sweep = SweepRunner(dataset,
+                      n_trials=args.trials,
+                      cores_per_trial=args.cores_per_trial,
+                      timesteps=args.timesteps,
+                      n_folds=args.folds,
+                      budget_hours=args.budget_hours,
+                      seed=args.seed)
+  sweep.run()
+  logger.info("\n" + sweep.report())
+  sweep.save(config.sweep_location)
+  logger.info("Saved sweep results to %s", config.sweep_location)
+
+
+if __name__ == "__main__":
+  main()
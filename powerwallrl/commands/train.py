@@ -0,0 +1,288 @@
+"""  This script will use the collected weather and power data to create a most
+  rewarding model for setting the battery state.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+# To remove GDK errors so that this can run headless, without importing
+# matplotlib until something needs it.
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import argparse
+import dateutil.tz
+import logging
+import multiprocessing
+import numpy as np
+import sqlite3
+import sys
+import time
+import torch
+
+from functools import partial
+from powerwallrl.analysis.backtest import Backtester
+from powerwallrl.analysis.backtest import model_policy
+from powerwallrl.analysis.results import ResultsStore
+from powerwallrl.analysis.results import dataset_version
+from powerwallrl.analysis.results import model_version
+from powerwallrl.gym.dataset import load_dataset
+from powerwallrl.gym.dataset import load_fleet_dataset
+from powerwallrl.gym.powerwall import MakePowerwallEnv
+from powerwallrl.gym.prefetch import DEFAULT_MAX_BYTES
+from powerwallrl.settings import PowerwallRLConfig
+from powerwallrl.train.autotune import Autotuner
+from powerwallrl.train.autotune import load_tuning
+from powerwallrl.train.autotune import make_vec_env
+from powerwallrl.train.autotune import save_tuning
+from powerwallrl.train.pretrain import pretrain
+from powerwallrl.train.sweep import load_best_hyperparameters
+
+from tabulate import tabulate
+
+from stable_baselines3 import PPO
+from stable_baselines3.common.callbacks import BaseCallback
+
+
+def _MakePowerwallEnv(profile=False, substeps=1, action_hours=1,
+                      schedule=False, prefetch=0,
+                      prefetch_max_bytes=DEFAULT_MAX_BYTES):
+  config = PowerwallRLConfig()
+  return MakePowerwallEnv(config, config.grid_plan, debug=False,
+                          profile=profile, substeps=substeps,
+                          action_hours=action_hours, schedule=schedule,
+                          prefetch=prefetch,
+                          prefetch_max_bytes=prefetch_max_bytes)
+
+
+def _MakeFleetEnv(fleet, profile=False, substeps=1, action_hours=1,
+                  schedule=False):
+  config = fleet.sites[0].config
+  return MakePowerwallEnv(config, config.grid_plan, debug=False, fleet=fleet,
+                          profile=profile, substeps=substeps,
+                          action_hours=action_hours, schedule=schedule)
+
+
+class ProfilingCallback(BaseCallback):
+  """ Logs where training wall time goes every log_interval rollouts.
+
+    Rollouts are time spent stepping the environments and the time between
+    rollouts is the PPO update. Within a rollout each worker reports its own
+    step and reset time, the rest is the FlattenObservation wrapper,
+    SubprocVecEnv IPC and policy inference.
+  """
+
+  def __init__(self, log_interval=1):
+    super().__init__()
+    self.log_interval = log_interval
+    self.rollouts = 0
+    self.rollout_start = None
+    self.rollout_end = None
+    self.rollout_time = 0.0
+    self.learner_time = 0.0
+
+  def _on_training_start(self):
+    self.training_env.env_method('enable_profiling')
+    self.rollout_end = None
+
+  def _on_rollout_start(self):
+    now = time.perf_counter()
+    if self.rollout_end is not None:
+      self.learner_time += now - self.rollout_end
+    self.rollout_start = now
+
+  def _on_step(self):
+    return True
+
+  def _on_rollout_end(self):
+    self.rollout_end = time.perf_counter()
+    self.rollout_time += self.rollout_end - self.rollout_start
+    self.rollouts += 1
+    if self.rollouts % self.log_interval == 0:
+      self.report()
+
+  def report(self):
+    stats = self.training_env.env_method('profile_stats')
+    percent = lambda seconds: "%0.1f%%" % (seconds / self.rollout_time * 100)
+    rows = []
+    resets = []
+    env_times = []
+    for worker, worker_stats in enumerate(stats):
+      totals = worker_stats['totals']
+      env_time = totals.get('step', 0.0) + totals.get('reset', 0.0)
+      env_times.append(env_time)
+      resets.extend(worker_stats['samples'].get('reset', []))
+      rows.append([
+        worker,
+        "%0.0f" % (worker_stats['counts'].get('step', 0) / self.rollout_time),
+        percent(env_time),
+        percent(totals.get('get_data', 0.0)),
+        percent(totals.get('sql', 0.0)),
+        percent(totals.get('features', 0.0)),
+        percent(totals.get('fill_data', 0.0)),
+      ])
+
+    total = self.rollout_time + self.learner_time
+    reset_ms = (np.percentile(resets, [50, 95, 99]) * 1000
+                if resets else [0, 0, 0])
+    self.logger.record('profile/env_fraction', self.rollout_time / total)
+    self.logger.record('profile/learner_fraction', self.learner_time / total)
+    logging.getLogger().info(
+      "\nEnvironment %0.1fs (%0.1f%%), learner %0.1fs (%0.1f%%), overhead "
+      "outside the slowest worker's env %0.1f%% of rollouts.\n"
+      "Reset latency ms p50 %0.2f, p95 %0.2f, p99 %0.2f\n" % (
+        self.rollout_time, self.rollout_time / total * 100,
+        self.learner_time, self.learner_time / total * 100,
+        (self.rollout_time - max(env_times)) / self.rollout_time * 100,
+        reset_ms[0], reset_ms[1], reset_ms[2]) +
+      tabulate(rows, headers=["Worker", "Steps/s", "Env", "Get Data", "SQL",
+                              "Features", "Fill Data"]))
+    self.rollout_time = 0.0
+    self.learner_time = 0.0
+
+
+def evaluate_sites(model, config, results=None, substeps=1, action_hours=1):
+  """ Mean reward per day over the entire history, averaged over sites.
+
+    Days are simulated in substeps with the model acting every action_hours,
+    as it was trained. Every day's outcome is recorded in results, a
+    ResultsStore, if given.
+  """
+  logger = logging.getLogger()
+  version = model_version(model)
+  rewards = []
+  for site in config.sites:
+    # Use the entire history as a way to know the real average cost saving.
+    dataset = load_dataset(site, site.grid_plan,
+                           substeps=substeps if substeps > 1 else None)
+    backtester = Backtester(dataset, site.grid_plan, site.battery,
+                            dateutil.tz.gettz(site.local_timezone),
+                            action_hours=action_hours)
+    result = backtester.run(model_policy(model))
+    logger.info("Mean reward for %s over %d days: %s",
+                site.site_id or "home", len(result), result.mean_reward())
+    rewards.append(result.mean_reward())
+    if results is not None:
+      results.record(result, version, dataset_version(site),
+                     site=site.site_id, location=config.model_location)
+  return float(np.mean(rewards))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--profile', action='store_true',
+                      help='Log where training time goes every rollout.')
+  parser.add_argument('--substeps', type=int, default=1,
+                      help='Simulate each hour in this many steps from the 5 '
+                      'minute data, eg. 12.')
+  parser.add_argument('--action-hours', type=int, default=1,
+                      help='Hours between the agent\'s actions.')
+  parser.add_argument('--schedule', action='store_true',
+                      help='Act once a day with a 24 hour reserve schedule.')
+  parser.add_argument('--prefetch', type=int, default=0,
+                      help='Prepare this many episodes ahead in the background '
+                      'of each env worker, for a single home.')
+  parser.add_argument('--prefetch-memory', type=float, default=8,
+                      help='MB each env worker may hold prefetched.')
+  parser.add_argument('--autotune', action='store_true',
+                      help='Measure this machine to pick the env workers, '
+                      'torch threads and PPO batch sizes, reusing a previous '
+                      'measurement of this machine.')
+  parser.add_argument('--retune', action='store_true',
+                      help='Autotune even if this machine was measured.')
+  parser.add_argument('--pretrain-epochs', type=int, default=0,
+                      help='Warm start a new model by cloning the recorded '
+                      'battery use for this many epochs.')
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  start_method = None
+  if len(config.sites) > 1:
+    # One shared policy over every site. Load the fleet once and let the
+    # workers share it through fork where we can.
+    fleet = load_fleet_dataset(
+      config, substeps=args.substeps if args.substeps > 1 else None)
+    logger.info("Training across %d sites from %d episode windows.",
+                len(fleet.sites), len(fleet))
+    start_method = ('fork' if 'fork' in multiprocessing.get_all_start_methods()
+                    else None)
+    make_env = partial(_MakeFleetEnv, fleet, args.profile, args.substeps,
+                       args.action_hours, args.schedule)
+  else:
+    make_env = partial(_MakePowerwallEnv, args.profile, args.substeps,
+                       args.action_hours, args.schedule, args.prefetch,
+                       int(args.prefetch_memory * 1024 * 1024))
+
+  # Use the best settings from the sweep command if it has been run.
+  hyperparameters = load_best_hyperparameters(config.sweep_location)
+  if hyperparameters:
+    logger.info("Using swept hyperparameters: %s", hyperparameters)
+
+  tuning = None
+  if args.autotune:
+    tuning = None if args.retune else load_tuning(config.autotune_location)
+    if tuning is None:
+      tuning = Autotuner(make_env, hyperparameters, start_method).tune()
+      save_tuning(config.autotune_location, tuning)
+    logger.info("Training with %d %s env workers, %d torch threads, n_steps "
+                "%d and batch size %d for %0.0f samples/s.", tuning['workers'],
+                tuning['vec_env'], tuning['torch_threads'], tuning['n_steps'],
+                tuning['batch_size'], tuning['samples_per_second'])
+    torch.set_num_threads(tuning['torch_threads'])
+    hyperparameters.update(n_steps=tuning['n_steps'],
+                           batch_size=tuning['batch_size'])
+    env = make_vec_env(make_env, tuning['vec_env'], tuning['workers'],
+                       start_method)
+  else:
+    env = make_vec_env(make_env, 'subproc', multiprocessing.cpu_count(),
+                       start_method)
+  model = PPO('MlpPolicy', env, **hyperparameters)
+
+  if (os.path.exists(config.model_location + ".zip")):
+    logger.info("Loading previous model to resume learning. %s",
+                config.model_location)
+    logger.info("rm %s.zip before training if you want to start afresh",
+                config.model_location)
+    model.set_parameters(config.model_location)
+  elif args.pretrain_epochs:
+    pretrain(model, config.sites, epochs=args.pretrain_epochs,
+             schedule=args.schedule, substeps=args.substeps,
+             action_hours=args.action_hours)
+
+  results = ResultsStore(sqlite3.connect(config.results_location))
+  results.setup()
+  mean_reward = evaluate_sites(model, config, results, args.substeps,
+                               args.action_hours)
+  logger.info("Mean reward before training start: %s", mean_reward)
+
+  i = 0
+  while i < 10:
+    i += 1
+    model.learn(total_timesteps=100000,
+                callback=ProfilingCallback() if args.profile else None)
+
+    mean_reward = evaluate_sites(model, config, results, args.substeps,
+                                 args.action_hours)
+    model.save(config.model_location)
+    if i == 10:
+      logger.info("Final mean reward: %s", mean_reward)
+    else:
+      logger.info("Current mean reward: %s", mean_reward)
+
+
+  del model
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,114 @@
+"""  This script trains the battery model with evolution strategies instead of
+  PPO, backtesting perturbations of the policy over batches of historical days
+  on every core. The model is saved where train_model.py saves it and is used
+  the same way.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+# To remove GDK errors so that this can run headless, without importing
+# matplotlib until something needs it.
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import argparse
+import dateutil.tz
+import logging
+import sqlite3
+import sys
+
+from functools import partial
+from powerwallrl.analysis.backtest import Backtester
+from powerwallrl.analysis.results import ResultsStore
+from powerwallrl.commands.train import evaluate_sites
+from powerwallrl.gym.dataset import load_dataset
+from powerwallrl.gym.powerwall import MakePowerwallEnv
+from powerwallrl.settings import PowerwallRLConfig
+from powerwallrl.train.es import EsTrainer
+from powerwallrl.train.sweep import load_best_hyperparameters
+
+from stable_baselines3 import PPO
+from stable_baselines3.common.vec_env import DummyVecEnv
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--generations', type=int, default=200)
+  parser.add_argument('--population', type=int, default=32,
+                      help='Antithetic perturbation pairs per generation.')
+  parser.add_argument('--sigma', type=float, default=0.02,
+                      help='Standard deviation of the parameter noise.')
+  parser.add_argument('--learning-rate', type=float, default=0.01)
+  parser.add_argument('--days', type=int, default=64,
+                      help='Historical days each perturbation is scored on.')
+  parser.add_argument('--workers', type=int, default=None,
+                      help='Worker processes, defaults to every core.')
+  parser.add_argument('--schedule', action='store_true',
+                      help='Act once a day with a 24 hour reserve schedule.')
+  parser.add_argument('--save-every', type=int, default=20,
+                      help='Evaluate and save the model every this many '
+                      'generations.')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  # Log INFO level message to stdout for the user to see progress.
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setLevel(logging.INFO)
+  formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  handler.setFormatter(formatter)
+  logger.addHandler(handler)
+
+  config = PowerwallRLConfig()
+  backtesters = [
+    Backtester(load_dataset(site, site.grid_plan), site.grid_plan,
+               site.battery, dateutil.tz.gettz(site.local_timezone))
+    for site in config.sites
+  ]
+  logger.info("Evolving over %d days of %d sites.",
+              sum(len(b) for b in backtesters), len(backtesters))
+
+  # The environment only gives the model its spaces, ES never steps it.
+  env = DummyVecEnv([
+    partial(MakePowerwallEnv, config, config.grid_plan, debug=False,
+            schedule=args.schedule)
+  ])
+  model = PPO('MlpPolicy', env, device='cpu', seed=args.seed,
+              **load_best_hyperparameters(config.sweep_location))
+  if (os.path.exists(config.model_location + ".zip")):
+    logger.info("Loading previous model to resume learning. %s",
+                config.model_location)
+    logger.info("rm %s.zip before training if you want to start afresh",
+                config.model_location)
+    model.set_parameters(config.model_location)
+
+  results = ResultsStore(sqlite3.connect(config.results_location))
+  results.setup()
+  mean_reward = evaluate_sites(model, config, results)
+  logger.info("Mean reward before training start: %s", mean_reward)
+
+  def checkpoint(generation, trainer):
+    # The last generation is saved below.
+    if ((generation + 1) % args.save_every == 0 and
+        generation + 1 < args.generations):
+      trainer.update_model()
+      logger.info("Current mean reward: %s",
+                  evaluate_sites(model, config, results))
+      model.save(config.model_location)
+
+  trainer = EsTrainer(model, backtesters, population=args.population,
+                      sigma=args.sigma, learning_rate=args.learning_rate,
+                      days_per_generation=args.days, workers=args.workers,
+                      seed=args.seed)
+  trainer.train(args.generations, callback=checkpoint)
+
+  logger.info("Final mean reward: %s", evaluate_sites(model, config, results))
+  model.save(config.model_location)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,7 @@
+"""
+Production control of the home battery from a trained model.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
@@ -0,0 +1,296 @@
+""" This module sets the backup reserve of every configured site in one run.
+
+Tesla's client blocks, so its calls run in a thread pool driven by asyncio. Each
+Tesla account gets its own limit on calls in flight and every call has a
+timeout, so one slow account or site can't hold up the rest of the fleet.
+
+Models are loaded once per run, and only when a schedule is due. Every site due
+a new schedule has its forecast observation built, then each model makes one
+batched prediction for all of its sites. With mpc sites are instead planned by
+the MpcController, which needs no trained model.
+
+Every site's decision is journalled in its database, see DecisionJournal.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import asyncio
+import dateutil.tz
+import logging
+import math
+import numpy as np
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from tabulate import tabulate
+
+from powerwallrl.control.journal import DecisionJournal
+from powerwallrl.control.schedule import ScheduleStore
+from powerwallrl.control.schedule import actions_to_schedule
+from powerwallrl.control.schedule import forecast_observation
+from powerwallrl.data.gateway import gateway_state
+from powerwallrl.data.metrics import metrics
+from powerwallrl.data.tesla import select_battery
+from powerwallrl.data.tesla import tesla_client
+from powerwallrl.data.version import DataVersion
+
+logger = logging.getLogger(__name__)
+
+
+class SiteRun(object):
+  """ One site's progress through a controller run. """
+
+  def __init__(self, config):
+    self.config = config
+    self.name = config.site_id or 'home'
+    self.battery = None
+    self.charge = None
+    self.reserve = None
+    self.target = None
+    self.status = 'pending'
+    # The site's database, once it's been opened to decide.
+    self.db = None
+    # Set when a new schedule is computed this run.
+    self.model_version = None
+    self.observation = None
+
+
+class FleetController(object):
+
+  def __init__(self, sites, account_concurrency=4, timeout=15.0,
+               max_workers=64, load_model=None, mpc=False, analogs=False):
+    self.sites = [SiteRun(site) for site in sites]
+    self.account_concurrency = account_concurrency
+    self.timeout = timeout
+    self.max_workers = max_workers
+    self.load_model = load_model
+    self.mpc = mpc
+    self.analogs = analogs
+    self.models = {}
+    self.model_versions = {}
+
+  def run(self):
+    """ Decide and apply every site's reserve, returns the SiteRuns. """
+    start = time.perf_counter()
+    asyncio.run(self.run_async())
+    logger.info("Fleet run of %d sites took %0.1fs.", len(self.sites),
+                time.perf_counter() - start)
+    return self.sites
+
+  async def run_async(self):
+    self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+    try:
+      accounts = {}
+      for site in self.sites:
+        accounts.setdefault(site.config.tesla_username, []).append(site)
+      self.limits = {
+        username: asyncio.Semaphore(self.account_concurrency)
+        for username in accounts
+      }
+      await asyncio.gather(*[
+        self.connect(username, sites) for username, sites in accounts.items()
+      ])
+      await asyncio.gather(*[
+        self.read(site) for site in self.sites if site.battery is not None
+      ])
+      self.decide([site for site in self.sites if site.charge is not None])
+      await asyncio.gather(*[
+        self.apply(site) for site in self.sites if site.target is not None
+      ])
+      self.journal([site for site in self.sites if site.db is not None])
+    finally:
+      # Timed out calls may still be running, don't wait for them.
+      self.executor.shutdown(wait=False)
+
+  async def call(self, username, endpoint, fn, *args):
+    """ A blocking Tesla call, within the account's limit and the timeout. """
+    async with self.limits[username]:
+      loop = asyncio.get_running_loop()
+      return await asyncio.wait_for(
+        loop.run_in_executor(self.executor,
+                             partial(metrics.request, endpoint, fn, *args)),
+        self.timeout)
+
+  async def connect(self, username, sites):
+    """ Log in to a Tesla account once and find each of its sites' battery. """
+    config = sites[0].config
+    try:
+      tesla_api = tesla_client(username, config.tesla_cache_file,
+                               config.tesla_api_url)
+      await self.call(username, 'fetch_token', tesla_api.fetch_token)
+      batteries = await self.call(username, 'battery_list',
+                                  tesla_api.battery_list)
+      for site in sites:
+        site.battery = select_battery(batteries, site.config.energy_site_id)
+    except Exception as e:
+      logger.error("Couldn't connect to Tesla account %s: %r", username, e)
+      for site in sites:
+        if site.battery is None:
+          site.status = 'connect failed'
+
+  async def read(self, site):
+    username = site.config.tesla_username
+    try:
+      # A site polling its gateway already knows its current charge.
+      gateway = gateway_state(site.config)
+      if gateway is not None:
+        site_info = await self.call(username, 'site_info',
+                                    site.battery.get_site_info)
+        site.charge = math.floor(gateway['percentage'])
+      else:
+        site_data, site_info = await asyncio.gather(
+          self.call(username, 'site_data', site.battery.get_site_data),
+          self.call(username, 'site_info', site.battery.get_site_info))
+        site.charge = math.floor(site_data['percentage_charged'])
+      site.reserve = math.floor(site_info['backup_reserve_percent'])
+    except Exception as e:
+      logger.error("Couldn't read battery for %s: %r", site.name, e)
+      site.status = 'read failed'
+
+  def decide(self, sites):
+    """ Schedule sites from the latest forecast where needed, then look up
+      every site's reserve for this hour.
+    """
+    due = {}
+    ready = []
+    for site in sites:
+      try:
+        db = sqlite3.connect(site.config.database_location)
+        site.schedules = ScheduleStore(db)
+        site.schedules.setup()
+        now = datetime.now(tz=dateutil.tz.gettz(site.config.local_timezone))
+        site.now = now
+        site.dayhour = int(now.strftime("%Y%m%d%H"))
+        site.forecast_version = DataVersion(db).version(['weather_last'])
+        current = site.schedules.is_current(site.dayhour,
+                                            site.forecast_version)
+      except Exception as e:
+        logger.error("Couldn't open the schedules for %s: %r", site.name, e)
+        site.status = 'decide failed'
+        continue
+      site.db = db
+      ready.append(site)
+      if not current:
+        due.setdefault(site.config.model_location, []).append(site)
+
+    for model_location, model_sites in due.items():
+      if self.mpc:
+        self.schedule_mpc(model_sites)
+      else:
+        self.schedule(model_location, model_sites)
+
+    for site in ready:
+      try:
+        site.target = site.schedules.lookup(site.dayhour)
+      except Exception as e:
+        logger.error("Couldn't look up the schedule for %s: %r", site.name, e)
+        site.status = 'decide failed'
+        continue
+      if site.target is None:
+        site.status = 'no schedule'
+        logger.warning("No backup reserve scheduled for %s this hour, leaving "
+                       "it at %d%%", site.name, site.reserve)
+
+  def schedule(self, model_location, sites):
+    """ One batched prediction for every site sharing a model. """
+    try:
+      if model_location not in self.models:
+        load_model = self.load_model
+        if load_model is None:
+          # Torch is only imported in hours a site needs a new schedule.
+          from stable_baselines3 import PPO
+          load_model = PPO.load
+        self.models[model_location] = load_model(model_location)
+      model = self.models[model_location]
+    except Exception as e:
+      logger.error("Couldn't load model %s, using cached schedules: %r",
+                   model_location, e)
+      return
+
+    observations = []
+    ready = []
+    for site in sites:
+      try:
+        obs, dayhours = forecast_observation(site.config, site.now,
+                                             site.charge, site.config.battery)
+        observations.append(obs)
+        ready.append((site, dayhours))
+      except Exception as e:
+        logger.error("Couldn't build the forecast for %s, using its cached "
+                     "schedule: %r", site.name, e)
+    if not ready:
+      return
+
+    actions, _states = model.predict(np.stack(observations),
+                                     deterministic=True)
+    if model_location not in self.model_versions:
+      from powerwallrl.analysis.results import model_version
+      self.model_versions[model_location] = model_version(model)
+    for (site, dayhours), action, obs in zip(ready, actions, observations):
+      site.model_version = self.model_versions[model_location]
+      site.observation = obs
+      site.schedules.save(actions_to_schedule(action, dayhours),
+                          site.forecast_version)
+
+  def schedule_mpc(self, sites):
+    """ Plan each site's reserve by optimizing over its forecast. """
+    # Only imported in hours a site needs a new schedule.
+    from powerwallrl.control.mpc import MpcController
+    for site in sites:
+      try:
+        controller = MpcController(site.config, site.db,
+                                   analogs=self.analogs)
+        schedule = controller.schedule(site.now, site.charge)
+      except Exception as e:
+        logger.error("Couldn't plan %s, using its cached schedule: %r",
+                     site.name, e)
+        continue
+      site.schedules.save(schedule, site.forecast_version)
+
+  async def apply(self, site):
+    if site.target == site.reserve:
+      site.status = 'unchanged'
+      return
+    try:
+      await self.call(site.config.tesla_username, 'set_backup_reserve',
+                      site.battery.set_backup_reserve_percent, site.target)
+      site.status = 'set'
+    except Exception as e:
+      logger.error("Couldn't set backup reserve for %s: %r", site.name, e)
+      site.status = 'set failed'
+
+  @property
+  def policy(self):
+    """ What chose the reserves, as journalled. """
+    if not self.mpc:
+      return 'model'
+    return 'mpc-analogs' if self.analogs else 'mpc'
+
+  def journal(self, sites):
+    """ Journal each site's decision and settle the outcomes of earlier ones
+      whose power data has arrived.
+    """
+    for site in sites:
+      try:
+        journal = DecisionJournal(site.db, site.config)
+        journal.setup()
+        journal.record(site.dayhour, self.policy,
+                       site.model_version or
+                       journal.last_model_version(self.policy),
+                       site.charge, site.reserve, site.target, site.status,
+                       site.observation)
+        journal.update()
+      except Exception as e:
+        logger.error("Couldn't journal the decision for %s: %r", site.name, e)
+
+  def report(self):
+    return tabulate([[
+      site.name, site.charge, site.reserve, site.target, site.status
+    ] for site in self.sites],
+                    headers=["Site", "Charge %", "Reserve %", "Target %",
+                             "Status"])
@@ -0,0 +1,437 @@
+""" This module journals every hourly backup reserve decision made in
+production and what it went on to earn.
+
+Each decision row holds the hour, the policy and model version that chose it,
+the battery charge and reserve it saw, the target it set, whether setting it
+worked and, for a model, the observation it acted on as float16 bytes.
+
+Once an hour's powerwall row arrives, its outcome is priced with the site's
+power plan: the grid cost the home actually paid, what it would have paid with
+no battery, and the battery wear. Once a day has an outcome for each of its
+local hours, 23 or 24 on daylight savings changes, it is also priced against an
+oracle, the cheapest reserve schedule for the day's actual load and solar from
+the day's first charge, solved as the MpcController does with perfect
+foresight. Like the episode window index, outcomes are only
+recomputed from the earliest hour ingestion touched since the last update.
+
+Drift is tracked over completed days as fast and slow exponentially weighted
+means of the daily savings and of the fraction of the oracle's savings
+captured, plus a one sided CUSUM of the capture falling below its slow mean.
+Each hour of the day also has fast and slow means of its own savings, so a
+drift confined to, say, the evening peak shows up before it moves the daily
+totals. Each day and hour updates them once in constant time, however long the
+journal. Days and outcomes are flagged once they're folded in, so a day that
+settles late, after later days, is still folded in, and later corrections to
+its hours only change its outcome rows.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import logging
+import numpy as np
+import time
+
+from datetime import timedelta
+from tabulate import tabulate
+
+from powerwallrl.data.episodes import dayhour_to_datetime
+from powerwallrl.data.episodes import dayhour_to_hour
+from powerwallrl.data.episodes import hour_to_dayhour
+from powerwallrl.data.version import DataVersion
+
+logger = logging.getLogger(__name__)
+
+# Battery wear in cents per Wh discharged, the backtester's, kept here so
+# ingestion doesn't import the gym.
+WEAR_PER_WH = 0.115 / 1000.0
+# Days for the fast and slow means to weigh the latest day by half.
+FAST_HALF_LIFE = 7
+SLOW_HALF_LIFE = 30
+# Capture falling below its slow mean by more than the slack a day adds to the
+# CUSUM, which alarms past the threshold.
+CUSUM_SLACK = 0.05
+CUSUM_THRESHOLD = 1.0
+
+
+def decay(half_life):
+  return 0.5**(1.0 / half_life)
+
+
+class DecisionJournal(object):
+  # A write to the powerwall table may settle or change outcomes.
+  TABLES = ('powerwall',)
+
+  def __init__(self, database, config=None):
+    """ config is the site's, needed to price outcomes in update(). """
+    self.con = database
+    self.config = config
+    self.data_version = DataVersion(database)
+
+  def setup(self):
+    """ Idempotent setup function for creating the SQL tables. """
+    self.data_version.setup()
+    cur = self.con.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS decision (
+                dayhour INTEGER PRIMARY KEY,
+                decided_at INTEGER NOT NULL,
+                policy TEXT NOT NULL,
+                model_version TEXT,
+                charge INTEGER,
+                reserve INTEGER,
+                target INTEGER,
+                status TEXT,
+                observation BLOB);''')
+    # Cents each hour and day, costs are negative when paid for feedback.
+    # folded is set once the row is in the drift metrics.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS decision_outcome (
+                dayhour INTEGER PRIMARY KEY,
+                no_battery_cost REAL NOT NULL,
+                battery_cost REAL NOT NULL,
+                wear REAL NOT NULL,
+                folded INTEGER NOT NULL DEFAULT 0);''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS decision_day (
+                day INTEGER PRIMARY KEY,
+                no_battery_cost REAL NOT NULL,
+                battery_cost REAL NOT NULL,
+                wear REAL NOT NULL,
+                oracle_cost REAL NOT NULL,
+                oracle_wear REAL NOT NULL,
+                folded INTEGER NOT NULL DEFAULT 0);''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS decision_drift (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER NOT NULL,
+                last_day INTEGER NOT NULL,
+                days INTEGER NOT NULL,
+                savings_fast REAL NOT NULL,
+                savings_slow REAL NOT NULL,
+                capture_fast REAL NOT NULL,
+                capture_slow REAL NOT NULL,
+                cusum REAL NOT NULL,
+                alarms INTEGER NOT NULL);''')
+    cur.execute(
+      ''' INSERT OR IGNORE INTO decision_drift
+          VALUES(0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0) ''')
+    # Each local hour of the day's savings means.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS decision_drift_hour (
+                hour INTEGER PRIMARY KEY,
+                hours INTEGER NOT NULL,
+                savings_fast REAL NOT NULL,
+                savings_slow REAL NOT NULL);''')
+    cur.executemany(
+      ''' INSERT OR IGNORE INTO decision_drift_hour VALUES(?, 0, 0.0, 0.0) ''',
+      [(hour,) for hour in range(24)])
+    # Journals from before the folded flags. Their days were folded in order
+    # up to last_day, their outcomes weren't folded by hour.
+    self.add_folded('decision_outcome')
+    if self.add_folded('decision_day'):
+      cur.execute(
+        ''' UPDATE decision_day SET folded = 1
+            WHERE day <= (SELECT last_day FROM decision_drift WHERE id = 0) ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS decision_outcome_unfolded
+                ON decision_outcome(dayhour) WHERE folded = 0;''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS decision_day_unfolded
+                ON decision_day(day) WHERE folded = 0;''')
+    self.con.commit()
+
+  def add_folded(self, table):
+    """ Add the folded column to a table made without it, returns whether it
+      was added.
+    """
+    cur = self.con.cursor()
+    cur.execute(''' PRAGMA table_info(%s) ''' % table)
+    if 'folded' in [row[1] for row in cur.fetchall()]:
+      return False
+    cur.execute(
+      ''' ALTER TABLE %s ADD COLUMN folded INTEGER NOT NULL DEFAULT 0 ''' %
+      table)
+    return True
+
+  def record(self, dayhour, policy, model_version, charge, reserve, target,
+             status, observation=None):
+    """ Journal the hour's decision, replacing any earlier one this hour. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' INSERT OR REPLACE INTO decision(dayhour, decided_at, policy,
+            model_version, charge, reserve, target, status, observation)
+          VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?) ''',
+      (dayhour, int(time.time()), policy, model_version, charge, reserve,
+       target, status,
+       None if observation is None else
+       np.asarray(observation, dtype=np.float16).tobytes()))
+    self.con.commit()
+
+  def last_model_version(self, policy):
+    """ The model version of policy's latest decision, or None. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT model_version FROM decision
+          WHERE policy = ? AND model_version IS NOT NULL
+          ORDER BY dayhour DESC LIMIT 1 ''', (policy,))
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+  def drift(self):
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT version, last_day, days, savings_fast, savings_slow,
+                 capture_fast, capture_slow, cusum, alarms
+          FROM decision_drift WHERE id = 0 ''')
+    return dict(zip(('version', 'last_day', 'days', 'savings_fast',
+                     'savings_slow', 'capture_fast', 'capture_slow', 'cusum',
+                     'alarms'), cur.fetchone()))
+
+  def update(self):
+    """ Settle the outcomes of decisions whose hours have arrived since the
+      last update, then fold newly settled hours and days into the drift
+      metrics.
+
+      Returns the number of hours settled.
+    """
+    self.setup()
+    drift = self.drift()
+    version = self.data_version.version(self.TABLES)
+    if version == drift['version']:
+      return 0
+    dirty_from = (self.data_version.dirty_from(self.TABLES, drift['version'])
+                  if drift['version'] else 0)
+
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT decision.dayhour, powerwall.battery_power,
+                 powerwall.grid_power
+          FROM decision INNER JOIN powerwall
+          ON decision.dayhour = powerwall.dayhour
+          WHERE decision.dayhour >= ?
+            AND powerwall.battery_power IS NOT NULL
+            AND powerwall.grid_power IS NOT NULL
+          ORDER BY decision.dayhour ''', (dirty_from or 0,))
+    rows = cur.fetchall()
+    if rows:
+      dayhours = [row[0] for row in rows]
+      battery_wh = np.array([row[1] for row in rows], dtype=np.float64)
+      grid_wh = np.array([row[2] for row in rows], dtype=np.float64)
+      usage, feedback = self.prices(dayhours)
+      no_battery = self.cost(battery_wh + grid_wh, usage, feedback)
+      battery = self.cost(grid_wh, usage, feedback)
+      wear = np.maximum(battery_wh, 0) * WEAR_PER_WH
+      # A corrected outcome keeps its folded flag.
+      cur.executemany(
+        ''' INSERT INTO decision_outcome(dayhour, no_battery_cost,
+              battery_cost, wear)
+            VALUES(?, ?, ?, ?)
+            ON CONFLICT(dayhour) DO UPDATE SET
+              no_battery_cost = excluded.no_battery_cost,
+              battery_cost = excluded.battery_cost, wear = excluded.wear ''',
+        zip(dayhours, no_battery.tolist(), battery.tolist(), wear.tolist()))
+      for day in sorted(set(dayhour // 100 for dayhour in dayhours)):
+        self.settle_day(day)
+
+    self.fold(drift, version)
+    self.fold_hours()
+    self.con.commit()
+    logger.info("Settled %d decision hours.", len(rows))
+    return len(rows)
+
+  def prices(self, dayhours):
+    """ Usage and feedback cents per Wh of each dayhour. """
+    tz = dateutil.tz.gettz(self.config.local_timezone)
+    datetimes = [dayhour_to_datetime(dayhour, tz) for dayhour in dayhours]
+    plan = self.config.grid_plan
+    return (plan.usage_array(datetimes) / 1000.0,
+            plan.feedback_array(datetimes) / 1000.0)
+
+  def cost(self, grid_wh, usage, feedback):
+    return np.where(grid_wh > 0, grid_wh * usage, grid_wh * feedback)
+
+  def day_dayhours(self, day):
+    """ The local dayhours of a day, in order.
+
+      A day changing daylight savings has 23 or 25 real hours, and the repeated
+      hour of a 25 hour day shares its dayhour, so it has 23 or 24 dayhours.
+    """
+    tz = dateutil.tz.gettz(self.config.local_timezone)
+    next_day = int((dayhour_to_datetime(day * 100, None) +
+                    timedelta(days=1)).strftime('%Y%m%d'))
+    return sorted(set(
+      hour_to_dayhour(hour, tz)
+      for hour in range(dayhour_to_hour(day * 100, tz),
+                        dayhour_to_hour(next_day * 100, tz))))
+
+  def settle_day(self, day):
+    """ Total a day with an outcome for every local hour and price its
+      oracle, without committing.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT COUNT(*), SUM(no_battery_cost), SUM(battery_cost), SUM(wear)
+          FROM decision_outcome WHERE dayhour >= ? AND dayhour < ? ''',
+      (day * 100, day * 100 + 24))
+    hours, no_battery, battery, wear = cur.fetchone()
+    dayhours = self.day_dayhours(day)
+    if hours < len(dayhours):
+      return
+    cur.execute(
+      ''' SELECT decision.charge, powerwall.battery_power + powerwall.grid_power
+          FROM decision INNER JOIN powerwall
+          ON decision.dayhour = powerwall.dayhour
+          WHERE decision.dayhour >= ? AND decision.dayhour < ?
+          ORDER BY decision.dayhour ''', (day * 100, day * 100 + 24))
+    rows = cur.fetchall()
+    if rows[0][0] is None:
+      return
+    oracle_cost, oracle_wear = self.oracle(
+      dayhours, rows[0][0],
+      np.array([row[1] for row in rows], dtype=np.float64))
+    # A resettled day keeps its folded flag.
+    cur.execute(
+      ''' INSERT INTO decision_day(day, no_battery_cost, battery_cost, wear,
+            oracle_cost, oracle_wear)
+          VALUES(?, ?, ?, ?, ?, ?)
+          ON CONFLICT(day) DO UPDATE SET
+            no_battery_cost = excluded.no_battery_cost,
+            battery_cost = excluded.battery_cost, wear = excluded.wear,
+            oracle_cost = excluded.oracle_cost,
+            oracle_wear = excluded.oracle_wear ''',
+      (day, no_battery, battery, wear, oracle_cost, oracle_wear))
+
+  def oracle(self, dayhours, charge, shortfall):
+    """ The grid cost and wear of the best schedule for a day's dayhours in
+      hindsight.
+    """
+    # The solver pulls in the gym's kernel, only needed once a day settles.
+    from powerwallrl.control.mpc import solve
+    from powerwallrl.gym.kernel import battery_step
+    battery = self.config.battery
+    usage, feedback = self.prices(dayhours)
+    # The day is scored on grid cost and wear alone, so the charge left at the
+    # end mustn't be worth anything to the plan either.
+    targets, _, _ = solve(shortfall, usage, feedback, battery, charge,
+                          terminal_value=0.0)
+    charge = np.float64(charge)
+    charge_left = np.float64(100)
+    cost = wear = 0.0
+    for hour in range(len(dayhours)):
+      charge, charge_left, after, battery_wh = battery_step(
+        charge, charge_left, targets[hour], shortfall[hour], battery.capacity,
+        battery.discharge_limit, battery.charge_limit)
+      cost += float(self.cost(after, usage[hour], feedback[hour]))
+      wear += max(float(battery_wh), 0.0) * WEAR_PER_WH
+    return cost, wear
+
+  def fold(self, drift, version):
+    """ Update the drift metrics with each settled day not yet folded, in
+      order, in constant time per day, without committing.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT day, no_battery_cost - battery_cost - wear,
+                 no_battery_cost - oracle_cost - oracle_wear
+          FROM decision_day WHERE folded = 0 ORDER BY day ''')
+    fast, slow = decay(FAST_HALF_LIFE), decay(SLOW_HALF_LIFE)
+    for day, savings, oracle_savings in cur.fetchall():
+      capture = savings / oracle_savings if oracle_savings > 0 else 1.0
+      capture = min(1.0, max(-1.0, capture))
+      if drift['days'] == 0:
+        drift.update(savings_fast=savings, savings_slow=savings,
+                     capture_fast=capture, capture_slow=capture)
+      else:
+        drift['cusum'] = max(0.0, drift['cusum'] + drift['capture_slow'] -
+                             capture - CUSUM_SLACK)
+        if drift['cusum'] > CUSUM_THRESHOLD:
+          logger.warning("Captured savings have drifted down to %0.0f%% of "
+                         "the oracle's by %d.", drift['capture_fast'] * 100,
+                         day)
+          drift['alarms'] += 1
+          drift['cusum'] = 0.0
+        for key, value in (('savings', savings), ('capture', capture)):
+          drift[key + '_fast'] = (fast * drift[key + '_fast'] +
+                                  (1 - fast) * value)
+          drift[key + '_slow'] = (slow * drift[key + '_slow'] +
+                                  (1 - slow) * value)
+      drift['days'] += 1
+      drift['last_day'] = max(drift['last_day'], day)
+    cur.execute(''' UPDATE decision_day SET folded = 1 WHERE folded = 0 ''')
+    drift['version'] = version
+    cur.execute(
+      ''' UPDATE decision_drift SET version = ?, last_day = ?, days = ?,
+            savings_fast = ?, savings_slow = ?, capture_fast = ?,
+            capture_slow = ?, cusum = ?, alarms = ?
+          WHERE id = 0 ''',
+      (drift['version'], drift['last_day'], drift['days'],
+       drift['savings_fast'], drift['savings_slow'], drift['capture_fast'],
+       drift['capture_slow'], drift['cusum'], drift['alarms']))
+
+  def fold_hours(self):
+    """ Update each hour of the day's savings means with the outcomes not yet
+      folded, in order, in constant time per outcome, without committing.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT hour, hours, savings_fast, savings_slow
+          FROM decision_drift_hour ''')
+    hourly = {row[0]: list(row[1:]) for row in cur.fetchall()}
+    cur.execute(
+      ''' SELECT dayhour, no_battery_cost - battery_cost - wear
+          FROM decision_outcome WHERE folded = 0 ORDER BY dayhour ''')
+    fast, slow = decay(FAST_HALF_LIFE), decay(SLOW_HALF_LIFE)
+    for dayhour, savings in cur.fetchall():
+      drift = hourly[dayhour % 100]
+      if drift[0] == 0:
+        drift[1] = drift[2] = savings
+      else:
+        drift[1] = fast * drift[1] + (1 - fast) * savings
+        drift[2] = slow * drift[2] + (1 - slow) * savings
+      drift[0] += 1
+    cur.executemany(
+      ''' UPDATE decision_drift_hour SET hours = ?, savings_fast = ?,
+            savings_slow = ?
+          WHERE hour = ? ''',
+      [(hours, savings_fast, savings_slow, hour)
+       for hour, (hours, savings_fast, savings_slow) in hourly.items()])
+    cur.execute(''' UPDATE decision_outcome SET folded = 1 WHERE folded = 0 ''')
+
+  def report(self, last=14):
+    """ The last settled days against the oracle and the drift metrics. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT day, no_battery_cost, battery_cost, wear, oracle_cost,
+                 oracle_wear
+          FROM decision_day ORDER BY day DESC LIMIT ? ''', (last,))
+    rows = cur.fetchall()[::-1]
+    drift = self.drift()
+    return tabulate([[
+      day, "%0.2f" % (no_battery / 100.0), "%0.2f" % (battery / 100.0),
+      "%0.2f" % ((no_battery - battery - wear) / 100.0),
+      "%0.2f" % ((no_battery - oracle - oracle_wear) / 100.0)
+    ] for day, no_battery, battery, wear, oracle, oracle_wear in rows],
+                    headers=["Day", "No Battery $", "Battery $", "Savings $",
+                             "Oracle Savings $"]) + (
+      "\nOver %d days, savings per day %0.2f$ lately and %0.2f$ over the "
+      "month, capturing %0.0f%% and %0.0f%% of the oracle's. %d drift "
+      "alarms." % (drift['days'], drift['savings_fast'] / 100.0,
+                   drift['savings_slow'] / 100.0,
+                   drift['capture_fast'] * 100,
+                   drift['capture_slow'] * 100, drift['alarms']))
+
+  def hourly_report(self):
+    """ Each hour of the day's savings lately and over the month. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT hour, hours, savings_fast, savings_slow
+          FROM decision_drift_hour WHERE hours > 0 ORDER BY hour ''')
+    return tabulate([[
+      hour, hours, "%0.2f" % (savings_fast / 100.0),
+      "%0.2f" % (savings_slow / 100.0)
+    ] for hour, hours, savings_fast, savings_slow in cur.fetchall()],
+                    headers=["Hour", "Days", "Savings Lately $",
+                             "Savings Over Month $"])
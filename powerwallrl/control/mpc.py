@@ -0,0 +1,185 @@
+""" This module plans the backup reserve by optimization rather than a trained
+model, so a new site, plan or battery needs no training.
+
+The home's shortfall, its load less its solar, is forecast for the next 24 to 48
+hours from its own recent history and the weather_last cloud forecast. Load is
+the mean of the same hour over the recent days and solar is the same hour's
+clear sky output, the 90th percentile of those days, dimmed by the forecast
+clouds as in Kasten and Czeplak. Alternatively it's forecast from historical
+analogs of each hour's weather and calendar, see AnalogIndex.
+
+The hours are priced with the site's power plan and the reserve trajectory that
+minimizes the grid cost plus battery wear, the backtester's reward, is solved by
+dynamic programming over the battery percent. Each hour steps every percent and
+target at once through the battery kernel, so the solve takes milliseconds.
+Energy left in the battery at the end of the horizon is valued at the last
+hour's usage price, as HomePowerEnv values it at the end of a day.
+
+The solve assumes the whole day's charge allowance is left. Only the first
+hours of the plan are used, it's solved again from the actual charge whenever
+the forecast changes.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import logging
+import numpy as np
+import sqlite3
+
+from datetime import timedelta
+
+from powerwallrl.analysis.backtest import WEAR_PER_WH
+from powerwallrl.data.analogs import AnalogIndex
+from powerwallrl.data.episodes import dayhour_to_datetime
+from powerwallrl.gym.kernel import battery_step
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HORIZON = 48
+DEFAULT_HISTORY_DAYS = 14
+# Clear sky output percentile of the recent days' same hour.
+CLEAR_SKY_PERCENTILE = 90
+PERCENTS = np.arange(101.0)
+
+
+def cloud_factor(clouds):
+  """ Fraction of clear sky solar under clouds percent cover. """
+  return 1.0 - 0.75 * (np.asarray(clouds, dtype=np.float64) / 100.0)**3.4
+
+
+def solve(shortfall, usage, feedback, battery, charge, charge_left=100.0,
+          terminal_value=None):
+  """ The cheapest backup reserve target for each hour.
+
+    shortfall is each hour's forecast Wh and usage and feedback its cents per
+    Wh. terminal_value is the cents each Wh left in the battery at the end is
+    worth, the last hour's usage price if None. Returns (targets, charges,
+    cost), the hourly targets, the battery percent at the start of each hour
+    and the end, and the total cents.
+  """
+  if terminal_value is None:
+    terminal_value = usage[-1]
+  hours = len(shortfall)
+  # (percent, target) of every start percent and target.
+  charges = PERCENTS.reshape(-1, 1)
+  targets = PERCENTS.reshape(1, -1)
+  rows = np.arange(len(PERCENTS))
+  value = -PERCENTS / 100.0 * battery.capacity * terminal_value
+  policy = np.empty((hours, len(PERCENTS)), dtype=np.int64)
+  moves = np.empty((hours, len(PERCENTS)), dtype=np.int64)
+  for hour in reversed(range(hours)):
+    after, _, grid, battery_wh = battery_step(charges, charge_left, targets,
+                                              shortfall[hour],
+                                              battery.capacity,
+                                              battery.discharge_limit,
+                                              battery.charge_limit)
+    after = np.clip(after, 0, 100).astype(np.int64)
+    cost = (np.where(grid > 0, grid * usage[hour], grid * feedback[hour]) +
+            np.maximum(battery_wh, 0) * WEAR_PER_WH + value[after])
+    policy[hour] = np.argmin(cost, axis=1)
+    moves[hour] = after[rows, policy[hour]]
+    value = cost[rows, policy[hour]]
+
+  percent = int(np.clip(np.round(charge), 0, 100))
+  total = float(value[percent])
+  path = [percent]
+  for hour in range(hours):
+    path.append(int(moves[hour, path[-1]]))
+  return (policy[np.arange(hours), path[:-1]].astype(np.float64),
+          np.array(path, dtype=np.float64), total)
+
+
+class HistoryForecaster(object):
+  """ Forecasts a home's shortfall from its recent history and the clouds. """
+
+  def __init__(self, database, tz, days=DEFAULT_HISTORY_DAYS):
+    self.con = database
+    self.tz = tz
+    self.days = days
+
+  def profiles(self, before_dayhour):
+    """ (load, clear sky solar) Wh for each hour of the day. """
+    start = dayhour_to_datetime(before_dayhour, self.tz) - timedelta(
+      days=self.days)
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT dayhour, solar_power, battery_power, grid_power
+          FROM powerwall WHERE dayhour >= ? AND dayhour < ? ''',
+      (int(start.strftime('%Y%m%d%H')), before_dayhour))
+    rows = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 4)
+    if not len(rows):
+      raise Exception("No power history before %d to forecast from." %
+                      before_dayhour)
+    hour = (rows[:, 0] % 100).astype(np.int64)
+    load = rows[:, 1] + rows[:, 2] + rows[:, 3]
+    load_profile = np.zeros(24)
+    solar_profile = np.zeros(24)
+    for h in range(24):
+      selected = hour == h
+      if selected.any():
+        load_profile[h] = load[selected].mean()
+        solar_profile[h] = np.percentile(rows[selected, 1],
+                                         CLEAR_SKY_PERCENTILE)
+    return load_profile, solar_profile
+
+  def forecast(self, weather):
+    """ Shortfall Wh of each (dayhour, temp, uvi, clouds, humidity) forecast
+      row.
+    """
+    load, solar = self.profiles(int(weather[0][0]))
+    hours = np.array([row[0] for row in weather], dtype=np.int64) % 100
+    clouds = [row[3] or 0 for row in weather]
+    return load[hours] - solar[hours] * cloud_factor(clouds)
+
+
+class MpcController(object):
+
+  def __init__(self, config, database=None, horizon=DEFAULT_HORIZON,
+               history_days=DEFAULT_HISTORY_DAYS, analogs=False):
+    """ analogs forecasts the shortfall from historical analogs, see
+      AnalogIndex, rather than the recent days' profile.
+    """
+    self.config = config
+    self.con = database or sqlite3.connect(config.database_location)
+    self.tz = dateutil.tz.gettz(config.local_timezone)
+    self.plan = config.grid_plan
+    self.battery = config.battery
+    self.horizon = horizon
+    if analogs:
+      self.forecaster = AnalogIndex(self.con)
+    else:
+      self.forecaster = HistoryForecaster(self.con, self.tz, history_days)
+
+  def forecast(self, start_datetime):
+    """ (dayhours, shortfall Wh, usage and feedback cents per Wh) over the
+      forecast hours from start_datetime.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT dayhour, temp, uvi, clouds, humidity FROM weather_last
+          WHERE dayhour >= ? ORDER BY dayhour LIMIT ? ''',
+      (int(start_datetime.strftime('%Y%m%d%H')), self.horizon))
+    rows = cur.fetchall()
+    if len(rows) < 24:
+      raise Exception("Only %d hours of forecast from %s, 24 are needed." %
+                      (len(rows), start_datetime))
+    dayhours = [int(row[0]) for row in rows]
+    datetimes = [dayhour_to_datetime(dayhour, self.tz) for dayhour in dayhours]
+    return (dayhours, self.forecaster.forecast(rows),
+            self.plan.usage_array(datetimes) / 1000.0,
+            self.plan.feedback_array(datetimes) / 1000.0)
+
+  def schedule(self, start_datetime, battery_charge):
+    """ Reserve percent for each of the next 24 forecast dayhours. """
+    dayhours, shortfall, usage, feedback = self.forecast(start_datetime)
+    targets, charges, cost = solve(shortfall, usage, feedback, self.battery,
+                                   battery_charge)
+    logger.info("Planned %d hours from %d%% for a net %0.2f$, ending at %d%%.",
+                len(dayhours), battery_charge, cost / 100.0, charges[-1])
+    return {
+      dayhour: int(target)
+      for dayhour, target in zip(dayhours[:24], targets[:24])
+    }
@@ -0,0 +1,109 @@
+""" This module keeps the day ahead backup reserve schedule for the battery.
+
+A schedule is computed from the model once per weather forecast refresh and
+cached per hour in the database. Hourly runs only need to look up their hour,
+and keep following the last schedule if the weather or the model fail.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def action_to_percent(action):
+  """ Backup reserve percent for a model action.
+
+    Because the prediction is a float, we push out the bounds to get a true 0
+    and 100 setting that are very slightly favoured.
+  """
+  return max(0, min(100, round(float(action) * 51 + 50.5)))
+
+
+def forecast_observation(config, start_datetime, battery_charge,
+                         battery=None):
+  """ The model's observation from start_datetime using the forecast.
+
+    Returns the flattened observation and the dayhours it looks ahead over.
+  """
+  # The environment pulls in gymnasium and pysolar, which an hour with a
+  # cached schedule never needs.
+  from powerwallrl.gym.powerwall import MakePowerwallPredictEnv
+  env = MakePowerwallPredictEnv(config,
+                                config.grid_plan,
+                                battery_charge=battery_charge,
+                                start_datetime=start_datetime,
+                                battery=battery)
+  obs, _info = env.reset()
+  return obs, [int(row[0]) for row in env.unwrapped.data_set[:24]]
+
+
+def actions_to_schedule(actions, dayhours):
+  """ Reserve percent per dayhour, a schedule action covers every hour. """
+  return {
+    dayhour: action_to_percent(a) for dayhour, a in zip(dayhours, actions)
+  }
+
+
+def compute_schedule(model, config, start_datetime, battery_charge,
+                     battery=None):
+  """ Reserve percent per dayhour from start_datetime using the forecast.
+
+    A schedule model gives the next 24 hours, an hourly model only the first.
+  """
+  obs, dayhours = forecast_observation(config, start_datetime, battery_charge,
+                                       battery)
+  action, _states = model.predict(obs, deterministic=True)
+  return actions_to_schedule(action, dayhours)
+
+
+class ScheduleStore(object):
+
+  def __init__(self, database):
+    self.con = database
+
+  def setup(self):
+    """ Idempotent setup function for creating the SQL tables. """
+    cur = self.con.cursor()
+    # forecast_version is the weather_last data version it was computed from.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS battery_schedule (
+                dayhour INTEGER PRIMARY KEY,
+                reserve_percent INTEGER,
+                forecast_version INTEGER,
+                computed_at INTEGER);''')
+    self.con.commit()
+
+  def save(self, schedule, forecast_version):
+    cur = self.con.cursor()
+    computed_at = int(time.time())
+    cur.executemany(
+      ''' INSERT OR REPLACE INTO
+          battery_schedule(dayhour, reserve_percent, forecast_version,
+                           computed_at)
+          VALUES(?,?,?,?) ''',
+      [(dayhour, percent, forecast_version, computed_at)
+       for dayhour, percent in schedule.items()])
+    self.con.commit()
+
+  def lookup(self, dayhour):
+    """ The scheduled reserve percent for dayhour, or None. """
+    cur = self.con.cursor()
+    cur.execute(
+      'SELECT reserve_percent FROM battery_schedule WHERE dayhour = ?',
+      (dayhour,))
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+  def is_current(self, dayhour, forecast_version):
+    """ Whether dayhour is scheduled from the latest forecast. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT 1 FROM battery_schedule
+          WHERE dayhour = ? AND forecast_version >= ? ''',
+      (dayhour, forecast_version))
+    return cur.fetchone() is not None
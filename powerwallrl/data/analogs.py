@@ -0,0 +1,195 @@
+""" This module forecasts the home's load and solar for the coming hours from
+historical analogs, the past hours whose weather and calendar most resemble
+each forecast hour.
+
+Every hour with both power and weather_last data is indexed in analog_hour as a
+feature vector of its weather, time of day, time of year and weekend, along
+with the home's load and solar that hour. Like the episode window index it is
+rebuilt incrementally, from the earliest hour touched by ingestion onwards.
+
+The features are standardized and weighted once per data version and bucketed
+by hour of day. A forecast hour is only compared against the history within an
+hour of its time of day, and predicts the distance weighted mean of its k
+nearest analogs, so a 48 hour forecast takes a few milliseconds however long
+the history.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import logging
+import math
+import numpy as np
+
+from powerwallrl.data.episodes import dayhour_to_datetime
+from powerwallrl.data.version import DataVersion
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ('temp', 'uvi', 'clouds', 'humidity', 'hour_sin', 'hour_cos',
+            'year_sin', 'year_cos', 'weekend')
+# How much each standardized feature counts towards the distance.
+WEIGHTS = np.array([1.0, 1.5, 1.5, 0.5, 1.0, 1.0, 1.0, 1.0, 0.5])
+DEFAULT_K = 10
+
+
+def features(dayhour, temp, uvi, clouds, humidity):
+  """ The feature vector of an hour and its weather, NaN where missing. """
+  dt = dayhour_to_datetime(int(dayhour), None)
+  hour = 2 * math.pi * dt.hour / 24
+  year = 2 * math.pi * dt.timetuple().tm_yday / 365.25
+  missing = lambda value: float('nan') if value is None else float(value)
+  return (missing(temp), missing(uvi), missing(clouds), missing(humidity),
+          math.sin(hour), math.cos(hour), math.sin(year), math.cos(year),
+          1.0 if dt.weekday() >= 5 else 0.0)
+
+
+class AnalogIndex(object):
+  # The tables an analog reads from, a write to either invalidates hours.
+  TABLES = ('powerwall', 'weather_last')
+
+  def __init__(self, database, k=DEFAULT_K):
+    self.con = database
+    self.k = k
+    self.data_version = DataVersion(database)
+    self.is_setup = False
+    self.cached_version = None
+
+  def setup(self):
+    """ Idempotent setup function for creating the SQL tables. """
+    self.data_version.setup()
+    cur = self.con.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS analog_hour (
+                dayhour INTEGER PRIMARY KEY, %s,
+                load REAL NOT NULL,
+                solar REAL NOT NULL);''' %
+                ', '.join('%s REAL NOT NULL' % name for name in FEATURES))
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS analog_hour_version (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER NOT NULL);''')
+    self.con.commit()
+    self.is_setup = True
+
+  def indexed_version(self):
+    cur = self.con.cursor()
+    cur.execute(''' SELECT version FROM analog_hour_version ''')
+    row = cur.fetchone()
+    return row[0] if row else None
+
+  def update(self):
+    """ Bring the index up to date with the ingested data.
+
+      Only hours written since the index was last built are recomputed.
+      Returns the data version the index now reflects.
+    """
+    if not self.is_setup:
+      self.setup()
+
+    version = self.data_version.version(self.TABLES)
+    indexed_version = self.indexed_version()
+    if indexed_version == version:
+      return version
+
+    rebuild_from = None
+    if indexed_version is not None:
+      rebuild_from = self.data_version.dirty_from(self.TABLES,
+                                                  indexed_version)
+
+    cur = self.con.cursor()
+    if rebuild_from is None:
+      logger.info("Rebuilding analog index.")
+      cur.execute(''' DELETE FROM analog_hour ''')
+      rebuild_from = 0
+    else:
+      logger.info("Updating analog index from: %d", rebuild_from)
+      cur.execute(''' DELETE FROM analog_hour WHERE dayhour >= ? ''',
+                  (rebuild_from,))
+
+    cur.execute(
+      ''' SELECT powerwall.dayhour, weather_last.temp, weather_last.uvi,
+                 weather_last.clouds, weather_last.humidity,
+                 powerwall.solar_power + powerwall.battery_power +
+                   powerwall.grid_power,
+                 powerwall.solar_power
+          FROM powerwall INNER JOIN weather_last
+          ON powerwall.dayhour = weather_last.dayhour
+          WHERE powerwall.dayhour >= ?
+            AND powerwall.solar_power IS NOT NULL
+            AND powerwall.battery_power IS NOT NULL
+            AND powerwall.grid_power IS NOT NULL
+            AND weather_last.temp IS NOT NULL
+            AND weather_last.uvi IS NOT NULL
+            AND weather_last.clouds IS NOT NULL
+            AND weather_last.humidity IS NOT NULL ''', (rebuild_from,))
+    rows = [(dayhour,) + features(dayhour, temp, uvi, clouds, humidity) +
+            (load, solar)
+            for dayhour, temp, uvi, clouds, humidity, load, solar
+            in cur.fetchall()]
+    cur.executemany(
+      ''' INSERT INTO analog_hour VALUES(%s) ''' %
+      ','.join('?' * (len(FEATURES) + 3)), rows)
+    cur.execute(
+      ''' INSERT OR REPLACE INTO analog_hour_version(id, version)
+          VALUES(0, ?) ''', (version,))
+    self.con.commit()
+    return version
+
+  def load(self):
+    """ Load the weighted features into memory if the data has changed. """
+    version = self.update()
+    if self.cached_version == version:
+      return
+    cur = self.con.cursor()
+    cur.execute(''' SELECT dayhour, %s, load, solar FROM analog_hour
+                    ORDER BY dayhour ''' % ', '.join(FEATURES))
+    rows = np.array(cur.fetchall(), dtype=np.float64).reshape(
+      -1, len(FEATURES) + 3)
+    if not len(rows):
+      raise Exception("No hours of power and weather history to find "
+                      "analogs in yet.")
+    self.dayhours = rows[:, 0].astype(np.int64)
+    x = rows[:, 1:1 + len(FEATURES)]
+    self.mean = x.mean(axis=0)
+    self.scale = WEIGHTS / np.where(x.std(axis=0) > 0, x.std(axis=0), 1.0)
+    self.x = (x - self.mean) * self.scale
+    self.targets = rows[:, -2:]
+    # Each hour of the day's candidates, the history within an hour of it.
+    hours = self.dayhours % 100
+    self.buckets = [
+      np.flatnonzero((hours == (h - 1) % 24) | (hours == h) |
+                     (hours == (h + 1) % 24)) for h in range(24)
+    ]
+    self.cached_version = version
+    logger.info("Loaded %d analog hours.", len(self.dayhours))
+
+  def predict(self, weather, before_dayhour=None):
+    """ (load, solar) Wh arrays predicted for each (dayhour, temp, uvi, clouds,
+      humidity) forecast row, from analogs before before_dayhour if given.
+    """
+    self.load()
+    query = np.array([features(*row) for row in weather], dtype=np.float64)
+    query = (query - self.mean) * self.scale
+    predictions = np.empty((len(query), 2))
+    for i, row in enumerate(weather):
+      candidates = self.buckets[int(row[0]) % 100]
+      if before_dayhour is not None:
+        candidates = candidates[self.dayhours[candidates] < before_dayhour]
+      if not len(candidates):
+        raise Exception("No analogs for %d." % row[0])
+      # A missing forecast value doesn't count towards the distance.
+      difference = np.nan_to_num(self.x[candidates] - query[i])
+      distance = np.sqrt((difference**2).sum(axis=1))
+      k = min(self.k, len(candidates))
+      nearest = np.argpartition(distance, k - 1)[:k]
+      weights = 1.0 / (distance[nearest] + 1e-3)
+      predictions[i] = (weights @ self.targets[candidates[nearest]] /
+                        weights.sum())
+    return predictions[:, 0], predictions[:, 1]
+
+  def forecast(self, weather, before_dayhour=None):
+    """ Shortfall Wh, load less solar, of each forecast row, see predict(). """
+    load, solar = self.predict(weather, before_dayhour)
+    return load - solar
@@ -0,0 +1,169 @@
+""" This module maintains an index of every start hour that has a complete,
+gap-free episode window in both the powerwall and weather_24 tables.
+
+An episode is 24 hourly steps, and the last step still observes 24 hours of
+forecast ahead, so each episode needs 48 consecutive hours of data. Sampling
+from raw row offsets lets a missing day of Tesla or weather data silently
+stretch those 48 rows over days or weeks. Sampling from this index can't.
+
+The index is rebuilt incrementally, from the earliest hour touched by ingestion
+onwards, and is stamped with the data version it was built from. Only ingestion
+and setup rebuild it, environments only read it, so training workers never
+write to the database.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import logging
+import sqlite3
+
+from datetime import datetime
+from powerwallrl.data.version import DataVersion
+
+logger = logging.getLogger(__name__)
+
+# Hours of consecutive data an episode needs.
+EPISODE_HOURS = 48
+
+
+def dayhour_to_datetime(dayhour, tz):
+  dayhour = str(dayhour)
+  return datetime(int(dayhour[0:4]),
+                  int(dayhour[4:6]),
+                  int(dayhour[6:8]),
+                  int(dayhour[8:10]),
+                  0,
+                  0,
+                  tzinfo=tz)
+
+
+def dayhour_to_hour(dayhour, tz):
+  """ Hours since the epoch for a local dayhour.
+
+    Local dayhours skip and repeat around daylight savings changes, real hours
+    don't, so contiguity is always checked on these.
+  """
+  return int(dayhour_to_datetime(dayhour, tz).timestamp()) // 3600
+
+
+def hour_to_dayhour(hour, tz):
+  return int(datetime.fromtimestamp(hour * 3600, tz).strftime('%Y%m%d%H'))
+
+
+class EpisodeWindowIndex(object):
+  # The tables an episode reads from, a write to either invalidates windows.
+  TABLES = ('powerwall', 'weather_24')
+
+  def __init__(self, database, local_timezone='Etc/UTC'):
+    self.con = database
+    self.tz = dateutil.tz.gettz(local_timezone)
+    self.data_version = DataVersion(database)
+    self.is_setup = False
+    self.cached_version = None
+    self.cached_windows = None
+
+  def setup(self):
+    """ Idempotent setup function for creating the SQL tables. """
+    self.data_version.setup()
+    cur = self.con.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS episode_window (
+                dayhour INTEGER PRIMARY KEY);''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS episode_window_version (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER NOT NULL);''')
+    self.con.commit()
+    self.is_setup = True
+
+  def indexed_version(self):
+    cur = self.con.cursor()
+    cur.execute(''' SELECT version FROM episode_window_version ''')
+    row = cur.fetchone()
+    return row[0] if row else None
+
+  def update(self):
+    """ Bring the index up to date with the ingested data.
+
+      Only windows that overlap hours written since the index was last built are
+      recomputed. Returns the data version the index now reflects.
+    """
+    if not self.is_setup:
+      self.setup()
+
+    version = self.data_version.version(self.TABLES)
+    indexed_version = self.indexed_version()
+    if indexed_version == version:
+      return version
+
+    rebuild_from = None
+    if indexed_version is not None:
+      dirty_from = self.data_version.dirty_from(self.TABLES, indexed_version)
+      if dirty_from is not None:
+        # Every window with an hour at or after dirty_from may have changed.
+        rebuild_from = hour_to_dayhour(
+          dayhour_to_hour(dirty_from, self.tz) - (EPISODE_HOURS - 1), self.tz)
+
+    cur = self.con.cursor()
+    if rebuild_from is None:
+      logger.info("Rebuilding episode window index.")
+      cur.execute(''' DELETE FROM episode_window ''')
+      rebuild_from = 0
+    else:
+      logger.info("Updating episode window index from: %d", rebuild_from)
+      cur.execute(''' DELETE FROM episode_window WHERE dayhour >= ? ''',
+                  (rebuild_from,))
+
+    cur.execute(
+      ''' SELECT powerwall.dayhour
+          FROM powerwall INNER JOIN weather_24
+          ON powerwall.dayhour = weather_24.dayhour
+          WHERE powerwall.dayhour >= ?
+            AND powerwall.solar_power IS NOT NULL
+            AND powerwall.battery_power IS NOT NULL
+            AND powerwall.grid_power IS NOT NULL
+            AND weather_24.temp IS NOT NULL
+            AND weather_24.uvi IS NOT NULL
+            AND weather_24.clouds IS NOT NULL
+          ORDER BY powerwall.dayhour ''', (rebuild_from,))
+    dayhours = [row[0] for row in cur.fetchall()]
+    hours = [dayhour_to_hour(dayhour, self.tz) for dayhour in dayhours]
+
+    # Hours are unique and ordered, so a window is gap free exactly when its
+    # last hour is EPISODE_HOURS - 1 after its first.
+    windows = [(dayhours[i],)
+               for i in range(len(hours) - EPISODE_HOURS + 1)
+               if hours[i + EPISODE_HOURS - 1] - hours[i] == EPISODE_HOURS - 1]
+    cur.executemany(''' INSERT INTO episode_window(dayhour) VALUES(?) ''',
+                    windows)
+    cur.execute(
+      ''' INSERT OR REPLACE INTO episode_window_version(id, version)
+          VALUES(0, ?) ''', (version,))
+    self.con.commit()
+    return version
+
+  def windows(self, update=False):
+    """ Sorted start dayhours of every complete episode window.
+
+      The index is only read unless update is set, ingestion and setup keep it
+      up to date.
+    """
+    if update:
+      version = self.update()
+    else:
+      try:
+        version = self.indexed_version()
+      except sqlite3.OperationalError:
+        version = None
+      if version is None:
+        raise Exception("The episode window index hasn't been built yet, "
+                        "collect data with data_collect.py first.")
+    if self.cached_version != version:
+      cur = self.con.cursor()
+      cur.execute(''' SELECT dayhour FROM episode_window ORDER BY dayhour ''')
+      self.cached_windows = [row[0] for row in cur.fetchall()]
+      self.cached_version = version
+    return self.cached_windows
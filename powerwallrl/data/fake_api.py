@@ -0,0 +1,301 @@
+""" This module serves a local stand in for the Tesla and OpenWeatherMap APIs.
+
+It answers the endpoints teslapy uses for Powerwalls, OpenWeatherMap's onecall
+and the Powerwall gateway's local meters, with synthetic data or with recorded
+responses. Latency, throttling and errors can be injected, so ingestion and
+control can be benchmarked and load tested offline. Point a config at it with
+tesla_api_url, openweathermap_url and gateway_url, see python -m powerwallrl
+fake-api.
+
+Recorded responses are JSON files named after the endpoint they replace, eg.
+calendar_history.json or onecall.json, holding the whole response body.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import collections
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+ROUTES = (
+  ('GET', re.compile(r'^/api/1/products$'), 'products'),
+  ('GET', re.compile(r'^/api/1/energy_sites/(\d+)/site_info$'), 'site_info'),
+  ('GET', re.compile(r'^/api/1/energy_sites/(\d+)/live_status$'),
+   'live_status'),
+  ('GET', re.compile(r'^/api/1/energy_sites/(\d+)/calendar_history$'),
+   'calendar_history'),
+  ('POST', re.compile(r'^/api/1/energy_sites/(\d+)/backup$'), 'backup'),
+  ('GET', re.compile(r'^/data/2.5/onecall$'), 'onecall'),
+  ('POST', re.compile(r'^/api/login/Basic$'), 'gateway_login'),
+  ('GET', re.compile(r'^/api/meters/aggregates$'), 'aggregates'),
+  ('GET', re.compile(r'^/api/system_status/soe$'), 'soe'),
+)
+
+
+def solar_watts(hour):
+  """ A clear day's solar output, peaking at 5kW at noon. """
+  return max(0.0, 5000.0 * math.sin(math.pi * (hour - 6.0) / 12.0))
+
+
+def home_watts(hour):
+  """ A home's usage, with morning and evening peaks. """
+  return (600.0 + 900.0 * math.exp(-((hour - 7.5) ** 2) / 2.0) +
+          1800.0 * math.exp(-((hour - 19.0) ** 2) / 4.0))
+
+
+class FakeApi(object):
+  """ The state and fault injection shared by every request. """
+
+  def __init__(self, energy_site_ids=(1,), latency=0.0, jitter=0.0,
+               throttle_rate=0.0, error_rate=0.0, calls_per_minute=None,
+               recordings=None, seed=None):
+    self.energy_site_ids = list(energy_site_ids)
+    self.latency = latency
+    self.jitter = jitter
+    self.throttle_rate = throttle_rate
+    self.error_rate = error_rate
+    # Per endpoint quota, beyond which requests are throttled.
+    self.calls_per_minute = calls_per_minute
+    self.recordings = {}
+    if recordings:
+      for name in os.listdir(recordings):
+        if name.endswith('.json'):
+          with open(os.path.join(recordings, name)) as f:
+            self.recordings[name[:-len('.json')]] = json.load(f)
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.calls = collections.defaultdict(collections.deque)
+    # (endpoint, status) -> requests answered.
+    self.counts = collections.Counter()
+    self.reserves = {site_id: 30 for site_id in self.energy_site_ids}
+
+  def fault(self, endpoint):
+    """ The status to fail a request with and seconds to wait before
+      answering, the status is None to answer normally.
+    """
+    with self.lock:
+      delay = self.latency + self.random.uniform(0, self.jitter)
+      if self.calls_per_minute is not None:
+        now = time.monotonic()
+        calls = self.calls[endpoint]
+        while calls and now - calls[0] >= 60:
+          calls.popleft()
+        if len(calls) >= self.calls_per_minute:
+          return 429, delay
+        calls.append(now)
+      draw = self.random.random()
+    if draw < self.throttle_rate:
+      return 429, delay
+    if draw < self.throttle_rate + self.error_rate:
+      return 503, delay
+    return None, delay
+
+  def count(self, endpoint, status):
+    with self.lock:
+      self.counts[(endpoint, status)] += 1
+
+  def stats(self):
+    with self.lock:
+      return [{'endpoint': endpoint, 'status': status, 'count': count}
+              for (endpoint, status), count in sorted(self.counts.items())]
+
+  def respond(self, endpoint, site_id, query, body):
+    """ The response body for a request. """
+    if endpoint in self.recordings:
+      return self.recordings[endpoint]
+    if endpoint == 'products':
+      return {'response': [{
+        'id': 'STE%d' % site_id,
+        'energy_site_id': site_id,
+        'resource_type': 'battery',
+        'site_name': 'Site %d' % site_id,
+      } for site_id in self.energy_site_ids]}
+    if endpoint == 'site_info':
+      return {'response': {
+        'id': 'STE%d' % site_id,
+        'backup_reserve_percent': self.reserves.get(site_id, 30),
+        'installation_date': ((datetime.now() - timedelta(days=30))
+                              .strftime('%Y-%m-%dT00:00:00-07:00')),
+      }}
+    if endpoint == 'live_status':
+      hour = datetime.now().hour
+      return {'response': {
+        'percentage_charged': self.percentage_charged(),
+        'solar_power': solar_watts(hour),
+        'load_power': home_watts(hour),
+      }}
+    if endpoint == 'calendar_history':
+      return {'response': {'time_series': self.calendar_history(query)}}
+    if endpoint == 'backup':
+      with self.lock:
+        self.reserves[site_id] = int(body.get('backup_reserve_percent', 0))
+      return {'response': {'code': 201, 'message': 'Updated'}}
+    if endpoint == 'onecall':
+      return {'hourly': self.hourly_forecast()}
+    if endpoint == 'gateway_login':
+      return {'token': 'local'}
+    if endpoint == 'aggregates':
+      return self.aggregates()
+    if endpoint == 'soe':
+      # The gateway's state of energy includes a 5% the app doesn't show.
+      return {'percentage': 5.0 + 0.95 * self.percentage_charged()}
+    raise KeyError(endpoint)
+
+  def percentage_charged(self):
+    now = datetime.now()
+    hour = now.hour + now.minute / 60.0
+    return 50.0 + 40.0 * math.sin(math.pi * hour / 24.0)
+
+  def aggregates(self):
+    """ The gateway's meters now, with the battery covering what it can. """
+    now = datetime.now()
+    hour = now.hour + now.minute / 60.0 + now.second / 3600.0
+    solar = solar_watts(hour)
+    home = home_watts(hour)
+    battery = max(-3300.0, min(5000.0, home - solar))
+    return {
+      'site': {'instant_power': home - solar - battery},
+      'battery': {'instant_power': battery},
+      'load': {'instant_power': home},
+      'solar': {'instant_power': solar},
+    }
+
+  def calendar_history(self, query):
+    """ 5 minute power for the day of start_date, solar first to the home,
+      then the battery, then the grid.
+    """
+    start = datetime.fromisoformat(query['start_date'][0])
+    start = start.replace(hour=0, minute=0, second=0)
+    series = []
+    for i in range(288):
+      timestamp = start + timedelta(minutes=5 * i)
+      hour = timestamp.hour + timestamp.minute / 60.0
+      solar = solar_watts(hour)
+      home = home_watts(hour)
+      battery = max(-3300.0, min(5000.0, home - solar))
+      series.append({
+        'timestamp': timestamp.isoformat(),
+        'solar_power': solar,
+        'battery_power': battery,
+        'grid_power': home - solar - battery,
+      })
+    return series
+
+  def hourly_forecast(self):
+    now = int(time.time()) // 3600 * 3600
+    forecast = []
+    for i in range(48):
+      hour = datetime.fromtimestamp(now + 3600 * i).hour
+      forecast.append({
+        'dt': now + 3600 * i,
+        'temp': 15.0 + 8.0 * math.sin(math.pi * (hour - 9.0) / 12.0),
+        'uvi': solar_watts(hour) / 500.0,
+        'clouds': 20,
+        'humidity': 60,
+      })
+    return forecast
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.handle_request('GET')
+
+  def do_POST(self):
+    self.handle_request('POST')
+
+  def handle_request(self, method):
+    api = self.server.api
+    url = urlparse(self.path)
+    if method == 'GET' and url.path == '/stats':
+      self.send(200, api.stats())
+      return
+    length = int(self.headers.get('Content-Length') or 0)
+    body = json.loads(self.rfile.read(length) or b'{}')
+
+    for route_method, pattern, endpoint in ROUTES:
+      match = pattern.match(url.path)
+      if route_method == method and match:
+        break
+    else:
+      self.send(404, {'error': 'not_found'})
+      return
+
+    status, delay = api.fault(endpoint)
+    time.sleep(delay)
+    if status is None:
+      site_id = int(match.group(1)) if match.groups() else None
+      status, response = 200, api.respond(endpoint, site_id,
+                                          parse_qs(url.query), body)
+    elif status == 429:
+      response = {'error': 'too_many_requests'}
+    else:
+      response = {'error': 'service_unavailable'}
+    api.count(endpoint, status)
+    self.send(status, response)
+
+  def send(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    if status == 429:
+      self.send_header('Retry-After', '1')
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class FakeApiServer(ThreadingHTTPServer):
+  """ Serves a FakeApi, use as a context manager to serve in the background.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, api, host='127.0.0.1', port=0):
+    super(FakeApiServer, self).__init__((host, port), FakeApiHandler)
+    self.api = api
+    self.thread = None
+
+  @property
+  def url(self):
+    host, port = self.server_address[:2]
+    return 'http://%s:%d/' % (host, port)
+
+  @property
+  def onecall_url(self):
+    return self.url + 'data/2.5/onecall'
+
+  @property
+  def gateway_url(self):
+    return self.url
+
+  def __enter__(self):
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.shutdown()
+    self.server_close()
@@ -0,0 +1,302 @@
+""" This module polls a Powerwall's local gateway every few seconds, for power
+data that is current rather than a day behind Tesla's calendar history.
+
+Samples go into gateway_sample, a ring buffer of a fixed number of slots that
+the newest sample overwrites the oldest of, so storage stays bounded however
+long the poller runs. Each sample is also added to its hour's running totals,
+and once the poller moves on to the next hour the hour's mean power is written
+to the powerwall table, as Wh like the calendar history. Tesla's calendar
+history replaces those hours when it is collected.
+
+The gateway answers /api/meters/aggregates with the instant power of the site
+(grid), battery, load and solar meters, positive when importing, discharging,
+using and generating, and /api/system_status/soe with the state of energy. A
+local stand in is served by powerwallrl.data.fake_api.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import logging
+import requests
+import sqlite3
+import threading
+import time
+import urllib3
+
+from datetime import datetime
+from urllib.parse import urljoin
+
+from powerwallrl.data.metrics import metrics
+from powerwallrl.data.version import DataVersion
+
+logger = logging.getLogger(__name__)
+
+# A day of samples at the default 5 second interval.
+DEFAULT_BUFFER_SIZE = 17280
+DEFAULT_INTERVAL = 5.0
+# Fewest seconds of an hour that must be sampled to write the hour.
+MIN_HOUR_COVERAGE = 1800
+# The gateway's state of energy keeps 5% back that the app doesn't show.
+GATEWAY_RESERVE_PERCENT = 5.0
+
+
+def soe_to_percent(soe):
+  """ The app's battery percent from the gateway's state of energy. """
+  return max(0.0, min(100.0, (soe - GATEWAY_RESERVE_PERCENT) /
+                      (100.0 - GATEWAY_RESERVE_PERCENT) * 100.0))
+
+
+class GatewayClient(object):
+
+  def __init__(self, url, password=None, email='', timeout=5.0):
+    self.url = url
+    self.password = password
+    self.email = email
+    self.timeout = timeout
+    self.session = requests.Session()
+    # Gateways serve a self signed certificate.
+    self.session.verify = False
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    self.logged_in = password is None
+
+  def login(self):
+    response = self.session.post(
+      urljoin(self.url, 'api/login/Basic'),
+      json={'username': 'customer', 'password': self.password,
+            'email': self.email, 'force_sm_off': False},
+      timeout=self.timeout)
+    response.raise_for_status()
+    token = response.json().get('token')
+    if token:
+      self.session.headers['Authorization'] = 'Bearer ' + token
+    self.logged_in = True
+
+  def get(self, path):
+    if not self.logged_in:
+      self.login()
+    response = self.session.get(urljoin(self.url, path), timeout=self.timeout)
+    if response.status_code in (401, 403) and self.password is not None:
+      # The session expired.
+      self.login()
+      response = self.session.get(urljoin(self.url, path),
+                                  timeout=self.timeout)
+    response.raise_for_status()
+    return response.json()
+
+  def sample(self):
+    """ The current power in W and battery percent. """
+    aggregates = self.get('api/meters/aggregates')
+    soe = self.get('api/system_status/soe')
+    return {
+      'timestamp': time.time(),
+      'solar_power': float(aggregates['solar']['instant_power']),
+      'battery_power': float(aggregates['battery']['instant_power']),
+      'grid_power': float(aggregates['site']['instant_power']),
+      'load_power': float(aggregates['load']['instant_power']),
+      'percentage': soe_to_percent(float(soe['percentage'])),
+    }
+
+
+class GatewayStore(object):
+
+  def __init__(self, database, local_timezone='Etc/UTC',
+               buffer_size=DEFAULT_BUFFER_SIZE):
+    self.con = database
+    self.tz = dateutil.tz.gettz(local_timezone)
+    self.buffer_size = buffer_size
+    self.data_version = DataVersion(database)
+    # The next sample's sequence number, its slot is this modulo buffer_size.
+    self.sequence = None
+
+  def setup(self):
+    """ Idempotent setup function for creating the SQL tables. """
+    cur = self.con.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS gateway_sample (
+                slot INTEGER PRIMARY KEY,
+                sequence INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                solar_power REAL,
+                battery_power REAL,
+                grid_power REAL,
+                load_power REAL,
+                percentage REAL);''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS gateway_sample_sequence
+                ON gateway_sample(sequence);''')
+    # Running totals of the hours not yet written to powerwall.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS gateway_hour (
+                dayhour INTEGER PRIMARY KEY,
+                seconds REAL NOT NULL,
+                solar_wh REAL NOT NULL,
+                battery_wh REAL NOT NULL,
+                grid_wh REAL NOT NULL);''')
+    # The buffer may have been made smaller since it was filled.
+    cur.execute(''' DELETE FROM gateway_sample WHERE slot >= ? ''',
+                (self.buffer_size,))
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS powerwall (dayhour INTEGER PRIMARY KEY,
+                solar_power REAL,
+                battery_power REAL,
+                grid_power REAL);''')
+    self.data_version.setup()
+    self.con.commit()
+
+  def dayhour(self, timestamp):
+    return int(datetime.fromtimestamp(timestamp, self.tz).strftime('%Y%m%d%H'))
+
+  def latest(self):
+    """ The newest sample as a dict, or None. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT sequence, timestamp, solar_power, battery_power, grid_power,
+                 load_power, percentage
+          FROM gateway_sample ORDER BY sequence DESC LIMIT 1 ''')
+    row = cur.fetchone()
+    if row is None:
+      return None
+    return dict(zip(('sequence', 'timestamp', 'solar_power', 'battery_power',
+                     'grid_power', 'load_power', 'percentage'), row))
+
+  def add(self, sample, seconds):
+    """ Store a sample that stands for the last seconds of power, writing out
+      any hours before it.
+    """
+    if self.sequence is None:
+      latest = self.latest()
+      self.sequence = 0 if latest is None else latest['sequence'] + 1
+    sequence = self.sequence
+    dayhour = self.dayhour(sample['timestamp'])
+    cur = self.con.cursor()
+    try:
+      cur.execute(
+        ''' INSERT OR REPLACE INTO gateway_sample(slot, sequence, timestamp,
+              solar_power, battery_power, grid_power, load_power, percentage)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?) ''',
+        (sequence % self.buffer_size, sequence, sample['timestamp'],
+         sample['solar_power'], sample['battery_power'], sample['grid_power'],
+         sample['load_power'], sample['percentage']))
+      hours = seconds / 3600.0
+      cur.execute(
+        ''' INSERT INTO gateway_hour(dayhour, seconds, solar_wh, battery_wh,
+              grid_wh)
+            VALUES(?, ?, ?, ?, ?)
+            ON CONFLICT(dayhour) DO UPDATE SET
+              seconds = seconds + excluded.seconds,
+              solar_wh = solar_wh + excluded.solar_wh,
+              battery_wh = battery_wh + excluded.battery_wh,
+              grid_wh = grid_wh + excluded.grid_wh ''',
+        (dayhour, seconds, sample['solar_power'] * hours,
+         sample['battery_power'] * hours, sample['grid_power'] * hours))
+      written = self.downsample(dayhour)
+      self.con.commit()
+    except Exception:
+      self.con.rollback()
+      raise
+    self.sequence += 1
+    return written
+
+  def downsample(self, before_dayhour):
+    """ Write every hour before before_dayhour to powerwall, scaled up to the
+      whole hour, without committing. Returns the hours written.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT dayhour, seconds, solar_wh, battery_wh, grid_wh
+          FROM gateway_hour WHERE dayhour < ? ''', (before_dayhour,))
+    hours = cur.fetchall()
+    rows = [(dayhour, solar / seconds * 3600, battery / seconds * 3600,
+             grid / seconds * 3600)
+            for dayhour, seconds, solar, battery, grid in hours
+            if seconds >= MIN_HOUR_COVERAGE]
+    for dayhour, seconds, _, _, _ in hours:
+      if seconds < MIN_HOUR_COVERAGE:
+        logger.info("Only %0.0fs of %d was polled, not writing it.", seconds,
+                    dayhour)
+    cur.executemany(
+      ''' INSERT OR REPLACE INTO
+          powerwall(dayhour, solar_power, battery_power, grid_power)
+          VALUES(?, ?, ?, ?) ''', rows)
+    cur.execute(''' DELETE FROM gateway_hour WHERE dayhour < ? ''',
+                (before_dayhour,))
+    if rows:
+      self.data_version.touch('powerwall', min(row[0] for row in rows))
+      metrics.inc('powerwallrl_rows_upserted_total', len(rows),
+                  table='powerwall')
+    return len(rows)
+
+
+class GatewayPoller(object):
+
+  def __init__(self, client, store, interval=DEFAULT_INTERVAL, name='home'):
+    self.client = client
+    self.store = store
+    self.interval = interval
+    self.name = name
+    self.stopped = threading.Event()
+    self.samples = 0
+    self.errors = 0
+    self.last = None
+
+  def poll(self):
+    """ Take and store one sample, returns it. """
+    # The next poll is the retry.
+    sample = metrics.request('gateway', self.client.sample, retries=0)
+    # Power is held from the previous sample, but never for longer than a
+    # couple of intervals across a gap in polling.
+    seconds = self.interval
+    if self.last is not None:
+      seconds = min(sample['timestamp'] - self.last, 2 * self.interval)
+    self.last = sample['timestamp']
+    self.store.add(sample, seconds)
+    self.samples += 1
+    metrics.set('powerwallrl_last_write_timestamp_seconds',
+                sample['timestamp'], table='gateway_sample')
+    return sample
+
+  def run(self, duration=None):
+    """ Poll every interval until stop() or for duration seconds. """
+    start = time.monotonic()
+    next_poll = start
+    while not self.stopped.is_set():
+      if duration is not None and time.monotonic() - start >= duration:
+        break
+      try:
+        self.poll()
+      except Exception as e:
+        self.errors += 1
+        self.last = None
+        logger.error("Couldn't poll the gateway for %s: %r", self.name, e)
+      next_poll += self.interval
+      # Skip polls we've fallen behind on rather than bunching them up.
+      now = time.monotonic()
+      if next_poll < now:
+        next_poll = now + self.interval
+      self.stopped.wait(next_poll - now)
+
+  def stop(self):
+    self.stopped.set()
+
+
+def gateway_state(config, max_age=120):
+  """ The site's latest gateway sample if it's newer than max_age seconds,
+    otherwise None.
+  """
+  if not config.gateway_url:
+    return None
+  con = sqlite3.connect(config.database_location)
+  try:
+    # Only read, the poller sets up and owns the buffer.
+    latest = GatewayStore(con, config.local_timezone).latest()
+  except sqlite3.OperationalError:
+    # Nothing has been polled yet.
+    latest = None
+  finally:
+    con.close()
+  if latest is None or time.time() - latest['timestamp'] > max_age:
+    return None
+  return latest
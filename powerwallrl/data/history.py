@@ -0,0 +1,65 @@
+""" This module loads the stored hourly power history into numpy arrays for the
+analysis engines, which work on the whole history at once rather than one
+episode at a time.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import numpy as np
+
+from powerwallrl.data.episodes import dayhour_to_datetime
+
+
+class PowerHistory(object):
+
+  def __init__(self, dayhours, solar, battery, grid, tz):
+    self.tz = tz
+    self.dayhours = np.asarray(dayhours, dtype=np.int64)
+    self.datetimes = [dayhour_to_datetime(d, tz) for d in self.dayhours]
+    # Mean W over each hour, which is Wh for the hour.
+    self.solar = np.asarray(solar, dtype=np.float64)
+    self.battery = np.asarray(battery, dtype=np.float64)
+    self.grid = np.asarray(grid, dtype=np.float64)
+
+  def __len__(self):
+    return len(self.dayhours)
+
+  @property
+  def usage(self):
+    """ Home usage, the battery and grid make up whatever solar didn't. """
+    return self.solar + self.battery + self.grid
+
+  @property
+  def shortfall(self):
+    """ What the home needed beyond its own solar, negative for excess. """
+    return self.battery + self.grid
+
+  @property
+  def hours(self):
+    """ The number of real hours spanned, including any gaps. """
+    if not len(self):
+      return 0
+    return int((self.datetimes[-1] - self.datetimes[0]).total_seconds() //
+               3600) + 1
+
+
+def load_history(database, local_timezone='Etc/UTC', start_dayhour=None,
+                 end_dayhour=None):
+  """ Load every complete powerwall row between the given dayhours. """
+  cur = database.cursor()
+  cur.execute(
+    ''' SELECT dayhour, solar_power, battery_power, grid_power
+        FROM powerwall
+        WHERE dayhour >= ? AND dayhour <= ?
+          AND solar_power IS NOT NULL
+          AND battery_power IS NOT NULL
+          AND grid_power IS NOT NULL
+        ORDER BY dayhour ''',
+    (start_dayhour or 0, end_dayhour or 9999999999))
+  rows = cur.fetchall()
+  columns = list(zip(*rows)) if rows else [[], [], [], []]
+  return PowerHistory(columns[0], columns[1], columns[2], columns[3],
+                      dateutil.tz.gettz(local_timezone))
@@ -0,0 +1,214 @@
+""" Structured metrics for data ingestion.
+
+Counters, gauges and histograms are kept in memory per process and written out
+in the Prometheus textfile collector format, so a node exporter can pick them up
+or they can just be read by hand after a cron run.
+
+The module level metrics registry is shared by the ingestion classes, the same
+way they share a module level logger.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import bisect
+import logging
+import os
+import requests
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+
+from powerwallrl.data.episodes import dayhour_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds for latency and transaction histograms.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REQUEST_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 2.0
+
+
+def _transient(error):
+  """ Whether a failed request is worth retrying. """
+  response = getattr(error, 'response', None)
+  if response is None:
+    # Connection errors and timeouts.
+    return True
+  return response.status_code == 429 or response.status_code >= 500
+
+
+def _key(name, labels):
+  return (name, tuple(sorted(labels.items())))
+
+
+def _format_labels(labels, extra=()):
+  labels = list(labels) + list(extra)
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                           for k, v in labels)
+
+
+class Metrics(object):
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    self.counters = {}
+    self.gauges = {}
+    # key -> [bucket counts, sum, count]
+    self.histograms = {}
+    self.help = {}
+
+  def describe(self, name, text):
+    self.help[name] = text
+
+  def inc(self, name, value=1, **labels):
+    key = _key(name, labels)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def set(self, name, value, **labels):
+    with self.lock:
+      self.gauges[_key(name, labels)] = value
+
+  def observe(self, name, value, **labels):
+    key = _key(name, labels)
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+      histogram = self.histograms[key]
+      i = bisect.bisect_left(self.buckets, value)
+      if i < len(self.buckets):
+        histogram[0][i] += 1
+      histogram[1] += value
+      histogram[2] += 1
+
+  @contextmanager
+  def time(self, name, **labels):
+    """ Observe how long the with block takes. """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start, **labels)
+
+  def request(self, endpoint, fn, *args, retries=REQUEST_RETRIES, **kwargs):
+    """ Call fn, timing it and retrying transient failures with backoff. """
+    for attempt in range(retries + 1):
+      # Only the request itself is timed, not the backoff before a retry.
+      start = time.perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      except requests.exceptions.RequestException as e:
+        self.inc('powerwallrl_request_errors_total', endpoint=endpoint)
+        if attempt == retries or not _transient(e):
+          raise
+        self.inc('powerwallrl_request_retries_total', endpoint=endpoint)
+        logger.warning("Retrying %s after: %s", endpoint, e)
+      finally:
+        self.observe('powerwallrl_request_seconds',
+                     time.perf_counter() - start, endpoint=endpoint)
+      time.sleep(RETRY_BACKOFF_SECONDS * 2**attempt)
+
+  def value(self, name, **labels):
+    """ A counter or gauge's current value, for logging and tests. """
+    key = _key(name, labels)
+    return self.counters.get(key, self.gauges.get(key))
+
+  def text(self):
+    """ Everything in the Prometheus text exposition format. """
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+      if name in typed:
+        return
+      typed.add(name)
+      if name in self.help:
+        lines.append('# HELP %s %s' % (name, self.help[name]))
+      lines.append('# TYPE %s %s' % (name, kind))
+
+    with self.lock:
+      for (name, labels), value in sorted(self.counters.items()):
+        header(name, 'counter')
+        lines.append('%s%s %r' % (name, _format_labels(labels), float(value)))
+      for (name, labels), value in sorted(self.gauges.items()):
+        header(name, 'gauge')
+        lines.append('%s%s %r' % (name, _format_labels(labels), float(value)))
+      for (name, labels), (counts, total, count) in sorted(
+          self.histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+          cumulative += bucket_count
+          lines.append('%s_bucket%s %d' % (name, _format_labels(
+            labels, [('le', repr(float(bound)))]), cumulative))
+        lines.append('%s_bucket%s %d' % (name, _format_labels(
+          labels, [('le', '+Inf')]), count))
+        lines.append('%s_sum%s %r' % (name, _format_labels(labels), total))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+  def write_textfile(self, path):
+    """ Atomically replace path, so a collector never reads half a file. """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      f.write(self.text())
+    os.replace(tmp_path, path)
+
+
+def record_freshness(metrics, database, tables, tz, **labels):
+  """ Set how far behind now the newest hour of each table is.
+
+    Forecast tables run ahead of now, so their lag is negative.
+  """
+  cur = database.cursor()
+  now = datetime.now(tz=tz)
+  for table in tables:
+    cur.execute('SELECT MAX(dayhour) FROM %s' % table)
+    newest = cur.fetchone()[0]
+    if newest is None:
+      continue
+    end_of_hour = dayhour_to_datetime(newest, tz) + timedelta(hours=1)
+    metrics.set('powerwallrl_data_lag_seconds',
+                (now - end_of_hour).total_seconds(), table=table, **labels)
+
+
+metrics = Metrics()
+metrics.describe('powerwallrl_request_seconds',
+                 'Latency of external API requests by endpoint.')
+metrics.describe('powerwallrl_request_errors_total',
+                 'Failed external API requests by endpoint.')
+metrics.describe('powerwallrl_request_retries_total',
+                 'Retried external API requests by endpoint.')
+metrics.describe('powerwallrl_rate_limit_wait_seconds_total',
+                 'Seconds spent blocked on our own API rate limits.')
+metrics.describe('powerwallrl_rows_upserted_total',
+                 'Rows inserted or replaced by table.')
+metrics.describe('powerwallrl_transaction_seconds',
+                 'Time to commit ingestion transactions by table.')
+metrics.describe('powerwallrl_data_lag_seconds',
+                 'Seconds between now and the end of the newest stored hour.')
+metrics.describe('powerwallrl_last_write_timestamp_seconds',
+                 'Unix time this run last wrote to each table.')
+metrics.describe('powerwallrl_collect_start_timestamp_seconds',
+                 'Unix time the collection run started.')
+metrics.describe('powerwallrl_collect_success_timestamp_seconds',
+                 'Unix time the collection run finished without errors.')
+metrics.describe('powerwallrl_collect_in_progress',
+                 '1 while a collection run is going.')
+metrics.describe('powerwallrl_collect_duration_seconds',
+                 'How long the collection run took.')
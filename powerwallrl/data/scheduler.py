@@ -0,0 +1,242 @@
+""" This module collects weather and Powerwall data for many sites at once.
+
+API calls run concurrently in a thread pool driven by asyncio, so a run takes
+about as long as its slowest chain of calls rather than the sum of them:
+
+  * Sites whose coordinates fall in the same forecast grid cell share a single
+    OpenWeatherMap request.
+  * Each Tesla account logs in once and has its own limit on calls in flight
+    and calls per minute. OpenWeatherMap has one limit for the whole run.
+  * Nothing is written until a site's calls are done, then each site's weather
+    and power data are written in a single transaction.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import asyncio
+import collections
+import logging
+import os
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tabulate import tabulate
+
+from powerwallrl.control.journal import DecisionJournal
+from powerwallrl.data.analogs import AnalogIndex
+from powerwallrl.data.episodes import EpisodeWindowIndex
+from powerwallrl.data.metrics import metrics
+from powerwallrl.data.metrics import record_freshness
+from powerwallrl.data.tesla import TeslaPowerwallData
+from powerwallrl.data.tesla import select_battery
+from powerwallrl.data.tesla import tesla_client
+from powerwallrl.data.weather import WeatherData
+
+logger = logging.getLogger(__name__)
+
+# Sites within the same cell of this many degrees share a forecast.
+WEATHER_GRID_DEGREES = 0.1
+
+
+def weather_cell(latitude, longitude, grid=WEATHER_GRID_DEGREES):
+  return (round(latitude / grid), round(longitude / grid))
+
+
+class AsyncRateLimiter(object):
+  """ Allows at most calls per period seconds, waiting when over. """
+
+  def __init__(self, calls, period, endpoint):
+    self.calls = calls
+    self.period = period
+    self.endpoint = endpoint
+    self.times = collections.deque()
+
+  async def wait(self):
+    while True:
+      now = time.monotonic()
+      while self.times and now - self.times[0] >= self.period:
+        self.times.popleft()
+      if len(self.times) < self.calls:
+        self.times.append(now)
+        return
+      delay = self.period - (now - self.times[0])
+      metrics.inc('powerwallrl_rate_limit_wait_seconds_total', delay,
+                  endpoint=self.endpoint)
+      await asyncio.sleep(delay)
+
+
+class SiteIngestion(object):
+  """ One site's data waiting to be written. """
+
+  def __init__(self, config):
+    self.config = config
+    self.name = config.site_id or 'home'
+    # A site added since setup gets its database on its first collection.
+    os.makedirs(os.path.dirname(config.database_location), exist_ok=True)
+    self.db = sqlite3.connect(config.database_location)
+    self.weather = WeatherData(config.openweathermap_api_key,
+                               config.latitude, config.longitude, self.db,
+                               config.local_timezone,
+                               config.openweathermap_url)
+    self.weather_data = None
+    self.powerwall = None
+    # (start of day, Tesla time series) pairs.
+    self.days = []
+    self.status = 'pending'
+    self.errors = []
+
+
+class IngestionScheduler(object):
+
+  def __init__(self, sites, weather_calls_per_minute=60,
+               tesla_calls_per_minute=30, account_concurrency=4,
+               max_workers=64):
+    self.sites = [SiteIngestion(site) for site in sites]
+    self.weather_calls_per_minute = weather_calls_per_minute
+    self.tesla_calls_per_minute = tesla_calls_per_minute
+    self.account_concurrency = account_concurrency
+    self.max_workers = max_workers
+
+  def run(self):
+    """ Collect and write every site's data, returns the SiteIngestions. """
+    start = time.perf_counter()
+    for site in self.sites:
+      # Setup is idempotent and picks up tables added since the initial setup.
+      site.weather.setup()
+    asyncio.run(self.run_async())
+    for site in self.sites:
+      try:
+        self.write(site)
+      except Exception as e:
+        logger.error("Couldn't write data for %s: %r", site.name, e)
+        site.db.rollback()
+        site.errors.append('write')
+        site.status = 'failed: ' + ', '.join(site.errors)
+    logger.info("Collected %d sites in %0.1fs.", len(self.sites),
+                time.perf_counter() - start)
+    return self.sites
+
+  async def run_async(self):
+    self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+    try:
+      cells = {}
+      accounts = {}
+      for site in self.sites:
+        cells.setdefault(
+          (site.config.openweathermap_api_key,
+           weather_cell(site.config.latitude, site.config.longitude)),
+          []).append(site)
+        accounts.setdefault(site.config.tesla_username, []).append(site)
+      self.weather_limit = AsyncRateLimiter(self.weather_calls_per_minute, 60,
+                                            'onecall')
+      logger.info("Collecting weather for %d grid cells and power for %d "
+                  "Tesla accounts.", len(cells), len(accounts))
+      await asyncio.gather(
+        *[self.collect_weather(sites) for sites in cells.values()],
+        *[self.collect_account(username, sites)
+          for username, sites in accounts.items()])
+    finally:
+      self.executor.shutdown(wait=True)
+
+  async def call(self, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor,
+                                      partial(fn, *args, **kwargs))
+
+  async def collect_weather(self, sites):
+    """ One forecast from the middle of the sites, shared by all of them. """
+    config = sites[0].config
+    cell = WeatherData(config.openweathermap_api_key,
+                       sum(s.config.latitude for s in sites) / len(sites),
+                       sum(s.config.longitude for s in sites) / len(sites),
+                       None, url=config.openweathermap_url)
+    try:
+      await self.weather_limit.wait()
+      weather_data = await self.call(cell.weather)
+    except Exception as e:
+      logger.error("Couldn't collect weather for %s: %r",
+                   ', '.join(s.name for s in sites), e)
+      for site in sites:
+        site.errors.append('weather')
+      return
+    for site in sites:
+      site.weather_data = weather_data
+
+  async def collect_account(self, username, sites):
+    """ Every day each of the account's sites needs, within its limits. """
+    config = sites[0].config
+    concurrency = asyncio.Semaphore(self.account_concurrency)
+    limit = AsyncRateLimiter(self.tesla_calls_per_minute, 60,
+                             'calendar_history')
+    try:
+      tesla_api = tesla_client(username, config.tesla_cache_file,
+                               config.tesla_api_url)
+      await self.call(metrics.request, 'fetch_token', tesla_api.fetch_token)
+      # Every site of the account is found in one listing.
+      await limit.wait()
+      batteries = await self.call(metrics.request, 'battery_list',
+                                  tesla_api.battery_list)
+    except Exception as e:
+      logger.error("Couldn't log in to Tesla account %s: %r", username, e)
+      for site in sites:
+        site.errors.append('tesla login')
+      return
+
+    async def fetch_day(site, start_of_day):
+      async with concurrency:
+        await limit.wait()
+        return start_of_day, await self.call(
+          site.powerwall.request_calendar_history_data,
+          **site.powerwall.calendar_history_args(start_of_day))
+
+    async def collect_site(site):
+      try:
+        site.powerwall = TeslaPowerwallData(
+          username, site.db, site.config.local_timezone,
+          site.config.tesla_cache_file, site.config.energy_site_id, tesla_api,
+          battery=select_battery(batteries, site.config.energy_site_id))
+        site.powerwall.setup()
+        site.days = await asyncio.gather(*[
+          fetch_day(site, start_of_day)
+          for start_of_day in site.powerwall.days_to_collect()
+        ])
+      except Exception as e:
+        logger.error("Couldn't collect power data for %s: %r", site.name, e)
+        site.errors.append('power')
+
+    await asyncio.gather(*[collect_site(site) for site in sites])
+
+  def write(self, site):
+    """ Write everything collected for a site in one transaction. """
+    first_time_key = None
+    with metrics.time('powerwallrl_transaction_seconds', table='site'):
+      if site.weather_data is not None:
+        site.weather.save_weather_data(site.weather_data, commit=False)
+      if site.powerwall is not None:
+        for start_of_day, battery_timeseries in site.days:
+          time_key = site.powerwall.store_day(start_of_day, battery_timeseries)
+          if time_key is not None and (first_time_key is None or
+                                       time_key < first_time_key):
+            first_time_key = time_key
+        site.powerwall.touch(first_time_key)
+      site.db.commit()
+
+    EpisodeWindowIndex(site.db, site.config.local_timezone).update()
+    AnalogIndex(site.db).update()
+    DecisionJournal(site.db, site.config).update()
+    labels = {} if site.config.site_id is None else {'site': site.config.site_id}
+    record_freshness(metrics, site.db,
+                     ('powerwall', 'weather_last', 'weather_24'),
+                     site.weather.tz, **labels)
+    site.status = 'failed: ' + ', '.join(site.errors) if site.errors else 'ok'
+
+  def report(self):
+    return tabulate([[
+      site.name, 'yes' if site.weather_data is not None else 'no',
+      len(site.days), site.status
+    ] for site in self.sites],
+                    headers=["Site", "Weather", "Power Days", "Status"])
@@ -1,8 +1,9 @@
 """ This module provides a class for collecting tesla powerwall api data for a
 given username.
 
-For multiple reasons this probably won't work for complex setups like
-multi-battery single site, or multi-site Tesla powerwall setups.
+Accounts with several energy sites pick the site with energy_site_id, otherwise
+the first site is used. Tesla reports power per site, so batteries in the same
+site are collected as one.
 """
 
 # Author: Daniel Williams
@@ -10,36 +11,104 @@ multi-battery single site, or multi-site Tesla powerwall setups.
 __version__ = '0.0.1'
 
 import logging
+import os
+import time
 from teslapy import Tesla
+from urllib.parse import urljoin
 from dateutil.parser import parse
 import dateutil
 import dateutil.tz
 from datetime import datetime
 from datetime import timedelta
 import sqlite3
-from ratelimit import limits, sleep_and_retry
+from ratelimit import limits, RateLimitException
 from babel.dates import format_datetime
+from powerwallrl.data.metrics import metrics
+from powerwallrl.data.version import DataVersion
 
 logger = logging.getLogger(__name__)
 
 
+class LocalTesla(Tesla):
+  """ A Tesla client for a stand in API server, see powerwallrl.data.fake_api.
+
+    The stand in doesn't check tokens, so the client starts logged in.
+  """
+
+  def __init__(self, email, api_url, **kwargs):
+    if api_url.startswith('http://'):
+      # oauthlib otherwise refuses to send the token over plain http.
+      os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    self.api_url = api_url
+    super(LocalTesla, self).__init__(email,
+                                     sso_base_url=urljoin(api_url, 'oauth2/'),
+                                     cache_loader=dict,
+                                     cache_dumper=lambda cache: None,
+                                     **kwargs)
+    self.token = {
+      'access_token': 'local',
+      'token_type': 'Bearer',
+      'expires_at': time.time() + 365 * 24 * 3600,
+    }
+
+  def request(self, method, url, serialize=True, **kwargs):
+    if not url.startswith(self.sso_base_url):
+      url = urljoin(self.api_url, url)
+    return super(LocalTesla, self).request(method, url, serialize, **kwargs)
+
+
+def tesla_client(username, cache_file=None, api_url=None):
+  """ A Tesla client, talking to api_url instead of Tesla when it's set. """
+  if api_url:
+    return LocalTesla(username, api_url)
+  return Tesla(username, verify=True, cache_file=cache_file)
+
+
+def find_battery(tesla_api, energy_site_id=None):
+  """ The account's battery for energy_site_id, or its first battery. """
+  return select_battery(tesla_api.battery_list(), energy_site_id)
+
+
+def select_battery(batteries, energy_site_id=None):
+  """ The battery for energy_site_id from an account's battery_list(). """
+  if energy_site_id is None:
+    return batteries[0]
+  for battery in batteries:
+    if int(battery['energy_site_id']) == energy_site_id:
+      return battery
+  raise Exception("No energy site %d for this Tesla account." % energy_site_id)
+
+
 class TeslaPowerwallData(object):
 
-  def __init__(self, username, database, local_timezone='Etc/UTC', cache_file=None):
+  def __init__(self, username, database, local_timezone='Etc/UTC', cache_file=None,
+               energy_site_id=None, tesla_api=None, api_url=None,
+               battery=None):
+    """ battery is the site's battery from the account's battery_list(), it's
+      looked up when not given.
+    """
     self.con = database
+    self.data_version = DataVersion(database)
     self.username = username
     self.tz = dateutil.tz.gettz(local_timezone)
-    self.tesla_api = Tesla(username, verify=True, cache_file=cache_file)
-    # TODO(): Add some error handling here.
-    # self.tesla.authorized
-    self.tesla_api.fetch_token()
-    self.battery = self.tesla_api.battery_list()[0]
+    # Sites on the same account can share a logged in client.
+    if tesla_api is None:
+      tesla_api = tesla_client(username, cache_file, api_url)
+      # TODO(): Add some error handling here.
+      # self.tesla.authorized
+      tesla_api.fetch_token()
+    self.tesla_api = tesla_api
+    if battery is None:
+      battery = metrics.request('battery_list', find_battery, self.tesla_api,
+                                energy_site_id)
+    self.battery = battery
 
   def setup(self):
     """ Idempotent setup function for creating the SQL tables. 
 
       While Tesla provides the data per 5 minute period, we average that data and
-      store it per hour to simplify everything else.
+      store it per hour to simplify everything else. The 5 minute data is kept
+      as well for sub-hourly simulation.
     """
     cur = self.con.cursor()
     # Values stored are kwh used or created for that hour.
@@ -48,11 +117,19 @@ class TeslaPowerwallData(object):
                 solar_power REAL,
                 battery_power REAL,
                 grid_power REAL);''')
+    # Mean watts over the 5 minutes starting at YYYYMMDDHHMM.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS powerwall_5min (dayminute INTEGER PRIMARY KEY,
+                solar_power REAL,
+                battery_power REAL,
+                grid_power REAL);''')
+    self.data_version.setup()
 
   def backfill_data(self):
     """ Backfill our database with the power data since installation date. """
     start_date = datetime.fromisoformat(
-            self.battery.get_site_info()['installation_date'])
+            metrics.request('site_info',
+                            self.battery.get_site_info)['installation_date'])
     start_date = datetime(start_date.year, start_date.month, start_date.day,
             tzinfo=self.tz)
     self.collect_data(start_date)
@@ -65,8 +142,24 @@ class TeslaPowerwallData(object):
       the data. Otherwise this repreents a lot of Tesla API calls and might get
       you temporarily blocked from their API.
     """
-    energy_fields = ['solar_power', 'battery_power', 'grid_power']
+    # Earliest hour written, so derived indexes only rebuild from there.
+    first_time_key = None
+    for start_of_day in self.days_to_collect(start_date):
+      battery_timeseries = self.get_calendar_history_data(
+        **self.calendar_history_args(start_of_day))
+      time_key = self.store_day(start_of_day, battery_timeseries)
+      if time_key is not None:
+        with metrics.time('powerwallrl_transaction_seconds', table='powerwall'):
+          self.con.commit()
+        if first_time_key is None or time_key < first_time_key:
+          first_time_key = time_key
+    self.touch(first_time_key)
+    self.con.commit()
 
+  def days_to_collect(self, start_date=None):
+    """ Start of each day from start_date (defaults to 7 days ago.) that needs
+      requesting from Tesla.
+    """
     week_ago = datetime.now(tz=self.tz) - timedelta(days=7)
     if start_date:
       current_date = start_date
@@ -75,13 +168,10 @@ class TeslaPowerwallData(object):
 
     yesterday = datetime.now(tz=self.tz) - timedelta(days=1)
 
-    # Used to count sql updates in a transaction as to not have crazy large sql transactions.
-    n = 0
     cur = self.con.cursor()
-
+    days = []
     while current_date < yesterday:
       current_date += timedelta(days=1)
-      hourly = {}
       cur.execute(
         ''' SELECT COUNT(*)
                       FROM powerwall
@@ -95,68 +185,112 @@ class TeslaPowerwallData(object):
           current_date < week_ago):
         continue
 
-      start_of_day = datetime(current_date.year,
-                              current_date.month,
-                              current_date.day,
-                              0,
-                              0,
-                              0,
-                              tzinfo=self.tz)
-      end_of_day = datetime(current_date.year,
-                            current_date.month,
-                            current_date.day,
-                            23,
-                            59,
-                            59,
-                            tzinfo=self.tz)
-      print("start of day: " + start_of_day.astimezone().strftime("%Y-%m-%dT%H:%M:%S+08:00"))
-      print("end of day: " + end_of_day.astimezone().strftime("%Y-%m-%dT%H:%M:%S+08:00"))
-      battery_timeseries = self.battery.get_calendar_history_data(
-        kind="power",
-        period="day",
-        start_date=start_of_day.astimezone().strftime("%Y-%m-%dT%H:%M:%S-07:00"),
-        end_date=end_of_day.astimezone().strftime("%Y-%m-%dT%H:%M:%S-07:00"),
-        timezone=self.tz)
-
-      # No telsa time series data for this day.
-      if 'time_series' not in battery_timeseries:
-        continue
+      days.append(datetime(current_date.year,
+                           current_date.month,
+                           current_date.day,
+                           0,
+                           0,
+                           0,
+                           tzinfo=self.tz))
+    return days
+
+  def calendar_history_args(self, start_of_day):
+    """ Tesla calendar history arguments for a day's power data. """
+    end_of_day = datetime(start_of_day.year,
+                          start_of_day.month,
+                          start_of_day.day,
+                          23,
+                          59,
+                          59,
+                          tzinfo=self.tz)
+    logger.debug("Requesting Tesla power data from %s to %s",
+                 start_of_day.isoformat(), end_of_day.isoformat())
+    return dict(
+      kind="power",
+      period="day",
+      start_date=start_of_day.astimezone().strftime("%Y-%m-%dT%H:%M:%S-07:00"),
+      end_date=end_of_day.astimezone().strftime("%Y-%m-%dT%H:%M:%S-07:00"),
+      timezone=self.tz)
+
+  def store_day(self, start_of_day, battery_timeseries):
+    """ Write a day of Tesla power data without committing.
+
+      Returns the day's earliest dayhour written, or None if Tesla had no data.
+    """
+    energy_fields = ['solar_power', 'battery_power', 'grid_power']
+
+    # No telsa time series data for this day.
+    if 'time_series' not in battery_timeseries:
+      return None
 
-      logger.info("Storing Tesla Powerwall power data for: %s",
-                  format_datetime(start_of_day))
+    logger.info("Storing Tesla Powerwall power data for: %s",
+                format_datetime(start_of_day))
 
-      for timestamp in battery_timeseries['time_series']:
-        time_key = parse(timestamp['timestamp']).strftime("%Y%m%d%H")
-        if time_key not in hourly:
-          hourly[time_key] = {}
-          for kind in energy_fields:
-            hourly[time_key][kind] = 0.0
+    hourly = {}
+    five_minute = []
+    for timestamp in battery_timeseries['time_series']:
+      timestamp_time = parse(timestamp['timestamp'])
+      time_key = timestamp_time.strftime("%Y%m%d%H")
+      five_minute.append((timestamp_time.strftime("%Y%m%d%H%M"),) +
+                         tuple(timestamp[kind] for kind in energy_fields))
+      if time_key not in hourly:
+        hourly[time_key] = {}
         for kind in energy_fields:
-          # Tesla returns in lots of 5 minutes. So sum 1/12 of each to
-          # determine the mean kilowatts for the hour.
-          # TODO: We really should record battery charge/discharge, grid
-          # usage/export seperately since both conditions can happen in the same
-          # hour, eg sporadic clouds.
-          hourly[time_key][kind] += timestamp[kind] / 12.0
-
-      for time_key in hourly:
-        n = n + 1
-        if n == 100:
-          self.con.commit()
-          cur = self.con.cursor()
-          n = 0
-        sql = ''' INSERT OR REPLACE INTO
-                  powerwall(dayhour, solar_power, battery_power, grid_power)
-                  VALUES(?,?,?,?) '''
-        cur.execute(
-          sql,
-          (time_key, hourly[time_key]['solar_power'],
-           hourly[time_key]['battery_power'], hourly[time_key]['grid_power']))
-        self.con.commit()
-
-    # Limit to 30 days of data retrieval every minute, you don't want Tesla
-    # blocking you from the API (sometimes the block will be 24 hours).
-    @sleep_and_retry
-    @limits(calls=30, period=60)
-    def get_calendar_history_data(self, **args):
-      return self.battery.get_calendar_history_data(args)
+          hourly[time_key][kind] = 0.0
+      for kind in energy_fields:
+        # Tesla returns in lots of 5 minutes. So sum 1/12 of each to
+        # determine the mean kilowatts for the hour.
+        # TODO: We really should record battery charge/discharge, grid
+        # usage/export seperately since both conditions can happen in the same
+        # hour, eg sporadic clouds.
+        hourly[time_key][kind] += timestamp[kind] / 12.0
+
+    if not hourly:
+      return None
+
+    cur = self.con.cursor()
+    cur.executemany(
+      ''' INSERT OR REPLACE INTO
+          powerwall(dayhour, solar_power, battery_power, grid_power)
+          VALUES(?,?,?,?) ''',
+      [(time_key, values['solar_power'], values['battery_power'],
+        values['grid_power']) for time_key, values in hourly.items()])
+    cur.executemany(
+      ''' INSERT OR REPLACE INTO
+          powerwall_5min(dayminute, solar_power, battery_power, grid_power)
+          VALUES(?,?,?,?) ''', five_minute)
+    metrics.inc('powerwallrl_rows_upserted_total', len(hourly), table='powerwall')
+    metrics.inc('powerwallrl_rows_upserted_total', len(five_minute),
+                table='powerwall_5min')
+    return min(int(time_key) for time_key in hourly)
+
+  def touch(self, first_time_key):
+    """ Mark the tables changed from first_time_key, without committing. """
+    if first_time_key is not None:
+      self.data_version.touch('powerwall', first_time_key)
+      self.data_version.touch('powerwall_5min', first_time_key)
+    metrics.set('powerwallrl_last_write_timestamp_seconds', time.time(),
+                table='powerwall')
+
+  def get_calendar_history_data(self, **kwargs):
+    """ Tesla calendar history, blocking while we are over our rate limit. """
+    while True:
+      try:
+        return self._limited_calendar_history_data(**kwargs)
+      except RateLimitException as e:
+        metrics.inc('powerwallrl_rate_limit_wait_seconds_total',
+                    e.period_remaining, endpoint='calendar_history')
+        logger.info("Tesla rate limit reached, waiting %0.1fs.",
+                    e.period_remaining)
+        time.sleep(e.period_remaining)
+
+  # Limit to 30 days of data retrieval every minute, you don't want Tesla
+  # blocking you from the API (sometimes the block will be 24 hours).
+  @limits(calls=30, period=60)
+  def _limited_calendar_history_data(self, **kwargs):
+    return self.request_calendar_history_data(**kwargs)
+
+  def request_calendar_history_data(self, **kwargs):
+    """ Tesla calendar history, for callers pacing requests themselves. """
+    return metrics.request('calendar_history',
+                           self.battery.get_calendar_history_data, **kwargs)
@@ -0,0 +1,57 @@
+""" This module keeps a log of ingestion writes so derived data, like the
+episode window index, knows when and from where it must be rebuilt.
+
+Every ingestion appends the table it wrote to and the earliest dayhour it
+touched. The id of the latest entry is the data version. A consumer remembers
+the version it was built from and only rebuilds from the earliest dayhour
+touched since then.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+
+class DataVersion(object):
+
+  def __init__(self, database):
+    self.con = database
+
+  def setup(self):
+    """ Idempotent setup function for creating the SQL tables. """
+    cur = self.con.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS data_version (
+                version INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                dirty_from INTEGER NOT NULL);''')
+
+  def touch(self, name, dayhour):
+    """ Record that table name was written to from dayhour onwards.
+
+      This doesn't commit, call it inside the same transaction as the writes.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' INSERT INTO data_version(name, dirty_from) VALUES(?, ?) ''',
+      (name, int(dayhour)))
+
+  def version(self, names):
+    """ The latest version covering any of the given tables, 0 if none. """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT COALESCE(MAX(version), 0)
+          FROM data_version
+          WHERE name IN (%s) ''' % ','.join('?' * len(names)), tuple(names))
+    return cur.fetchone()[0]
+
+  def dirty_from(self, names, since_version):
+    """ The earliest dayhour written to any of the tables after since_version.
+    """
+    cur = self.con.cursor()
+    cur.execute(
+      ''' SELECT MIN(dirty_from)
+          FROM data_version
+          WHERE version > ? AND name IN (%s) ''' % ','.join('?' * len(names)),
+      (since_version,) + tuple(names))
+    return cur.fetchone()[0]
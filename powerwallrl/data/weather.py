@@ -14,12 +14,17 @@ import os
 import sqlite3
 import requests
 import locale
+import time
 
 from datetime import datetime
 from babel.dates import format_datetime
+from powerwallrl.data.metrics import metrics
+from powerwallrl.data.version import DataVersion
 
 logger = logging.getLogger(__name__)
 
+ONECALL_URL = 'https://api.openweathermap.org/data/2.5/onecall'
+
 
 class WeatherData(object):
 
@@ -28,12 +33,15 @@ class WeatherData(object):
                latitude,
                longitude,
                database,
-               local_timezone='Etc/UTC'):
+               local_timezone='Etc/UTC',
+               url=None):
     self.con = database
+    self.data_version = DataVersion(database)
     self.api_key = api_key
     self.tz = dateutil.tz.gettz(local_timezone)
     self.latitude = latitude
     self.longitude = longitude
+    self.url = url or ONECALL_URL
 
   def setup(self):
     """Idempotent setup function for creating the SQL tables we need.
@@ -66,18 +74,26 @@ class WeatherData(object):
                                                uvi REAL,
                                                clouds INTEGER,
                                                humidity INTEGER);''')
+    self.data_version.setup()
 
   def weather(self):
-    url = ("https://api.openweathermap.org/data/2.5/onecall?lat=%s&lon=%s"
+    url = ("%s?lat=%s&lon=%s"
            "&exclude=current,minutely,alerts,daily&appid=%s&units=metric") % (
-             self.latitude, self.longitude, self.api_key)
+             self.url, self.latitude, self.longitude, self.api_key)
 
-    response = requests.get(url)
+    response = metrics.request('onecall', self._get, url)
     weather_data = json.loads(response.text)
     logging.debug("Weather data: %s", weather_data)
     return weather_data
 
-  def save_weather_data(self, weather_data=None, collection_time=None):
+  @staticmethod
+  def _get(url):
+    response = requests.get(url)
+    response.raise_for_status()
+    return response
+
+  def save_weather_data(self, weather_data=None, collection_time=None,
+                        commit=True):
     cur = self.con.cursor()
     if not weather_data:
       weather_data = self.weather()
@@ -87,21 +103,40 @@ class WeatherData(object):
     logger.info("Collecting weather data as of: %s",
                 format_datetime(collection_time))
 
+    # Earliest hour written per table, so derived indexes only rebuild from
+    # there.
+    first_dayhour = {}
+    rows = {'weather_last': 0, 'weather_24': 0, 'weather_first': 0}
+
     for hour_dict in weather_data['hourly']:
       h = datetime.fromtimestamp(hour_dict['dt'], self.tz).strftime('%Y%m%d%H')
       sql = ''' INSERT OR REPLACE INTO weather_last(dayhour,temp,uvi,clouds,humidity)
               VALUES(?,?,?,?,?) '''
       cur.execute(sql, (h, hour_dict['temp'], hour_dict['uvi'],
                         int(hour_dict['clouds']), int(hour_dict['humidity'])))
+      first_dayhour.setdefault('weather_last', h)
+      rows['weather_last'] += 1
       # Stop inserting fresh data into weather_24 once we are recieving forecasts inside of 24 hours.
       if int(collection_time.strftime('%Y%m%d%H')) < (int(h) - 23):
         sql = ''' INSERT OR REPLACE INTO weather_24(dayhour,temp,uvi,clouds,humidity)
                 VALUES(?,?,?,?,?) '''
         cur.execute(sql, (h, hour_dict['temp'], hour_dict['uvi'],
                           int(hour_dict['clouds']), int(hour_dict['humidity'])))
+        first_dayhour.setdefault('weather_24', h)
+        rows['weather_24'] += 1
       sql = ''' INSERT OR IGNORE INTO weather_first(dayhour,temp,uvi,clouds,humidity)
               VALUES(?,?,?,?,?) '''
       cur.execute(sql, (h, hour_dict['temp'], hour_dict['uvi'],
                         int(hour_dict['clouds']), int(hour_dict['humidity'])))
-    self.con.commit()
-    logger.info("Weather data commited to database.")
+      first_dayhour.setdefault('weather_first', h)
+      rows['weather_first'] += cur.rowcount
+    for table, dayhour in first_dayhour.items():
+      self.data_version.touch(table, dayhour)
+    for table, count in rows.items():
+      metrics.inc('powerwallrl_rows_upserted_total', count, table=table)
+      metrics.set('powerwallrl_last_write_timestamp_seconds', time.time(),
+                  table=table)
+    if commit:
+      with metrics.time('powerwallrl_transaction_seconds', table='weather'):
+        self.con.commit()
+      logger.info("Weather data commited to database.")
@@ -1,10 +1,20 @@
 """
 The reinformcenent learning gym libraries.
 
-Currently there is only the powerwall.
+Currently there is only the powerwall, registered with Gymnasium as
+PowerwallRL/HomePower-v0 for training and PowerwallRL/HomePowerPredict-v0 for
+the forecast, both with flattened observations. Make them with the config and
+power plan, eg. gymnasium.make('PowerwallRL/HomePower-v0', config=config,
+powerplan=config.grid_plan).
 """
 
 # Author: Daniel Williams
 
 __version__ = '0.0.1'
 
+from gymnasium.envs.registration import register
+
+register(id='PowerwallRL/HomePower-v0',
+         entry_point='powerwallrl.gym.powerwall:MakePowerwallEnv')
+register(id='PowerwallRL/HomePowerPredict-v0',
+         entry_point='powerwallrl.gym.powerwall:MakePowerwallPredictEnv')
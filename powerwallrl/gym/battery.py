@@ -0,0 +1,40 @@
+""" Home battery specification shared by the gym and the analysis engines. """
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+# Tax / inefficiency of lithium batteries, charging stores 1 / 1.1 of the energy
+# and rated throughput is derated by the same amount.
+EFFICIENCY = 1.1
+
+
+class Battery(object):
+
+  def __init__(self, capacity=13500, discharge_rate=5000, charge_rate=3300,
+               count=1):
+    # Usable Wh and maximum W of a single battery.
+    self.unit_capacity = capacity
+    self.unit_discharge_rate = discharge_rate
+    self.unit_charge_rate = charge_rate
+    self.count = count
+
+  @property
+  def capacity(self):
+    """ Total Wh across all batteries. """
+    return self.unit_capacity * self.count
+
+  @property
+  def discharge_limit(self):
+    """ Most Wh we can take out of the batteries in one hour. """
+    return self.unit_discharge_rate * self.count / EFFICIENCY
+
+  @property
+  def charge_limit(self):
+    """ Most Wh we can ask the batteries to charge in one hour. """
+    return self.unit_charge_rate * self.count / EFFICIENCY
+
+  def __repr__(self):
+    return 'Battery(capacity=%d, discharge_rate=%d, charge_rate=%d, count=%d)' % (
+      self.unit_capacity, self.unit_discharge_rate, self.unit_charge_rate,
+      self.count)
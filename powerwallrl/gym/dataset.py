@@ -0,0 +1,244 @@
+""" This module preloads every complete episode window into a single numpy array
+so many environments, or many processes forked from one loader, can sample
+episodes without touching SQLite or recomputing sun positions.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import logging
+import numpy as np
+import sqlite3
+
+from datetime import timedelta
+from pysolar.solar import get_altitude, get_azimuth
+from powerwallrl.data.episodes import EPISODE_HOURS
+from powerwallrl.data.episodes import EpisodeWindowIndex
+from powerwallrl.data.episodes import dayhour_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# Columns of an episode row.
+DAYHOUR = 0
+SOLAR_POWER = 1
+BATTERY_POWER = 2
+GRID_POWER = 3
+TEMP = 4
+UVI = 5
+CLOUDS = 6
+HUMIDITY = 7
+DAY_OF_WEEK = 8
+HOUR_OF_DAY = 9
+GRID_COST = 10
+SUN_ALTITUDE = 11
+SUN_AZIMUTH = 12
+
+# Tesla reports power every 5 minutes.
+FIVE_MINUTES_PER_HOUR = 12
+
+EPISODE_SELECT = ''' SELECT powerwall.dayhour AS dayhour,
+                            powerwall.solar_power AS solar_power,
+                            powerwall.battery_power AS battery_power,
+                            powerwall.grid_power AS grid_power,
+                            weather_24.temp AS temp,
+                            weather_24.uvi AS uvi,
+                            weather_24.clouds AS clouds,
+                            weather_24.humidity AS humidity
+                     FROM powerwall INNER JOIN weather_24
+                     ON powerwall.dayhour = weather_24.dayhour '''
+
+
+def load_substeps(database, row_index, rows, substeps):
+  """ (hours, substeps) shortfall Wh of every row from the 5 minute data.
+
+    row_index maps each row's dayhour to its position in rows. Substeps without
+    5 minute data get an even share of the hour's shortfall.
+  """
+  if substeps < 1 or FIVE_MINUTES_PER_HOUR % substeps:
+    raise Exception("%d substeps don't divide an hour into whole 5 minute "
+                    "periods." % substeps)
+  rows = np.asarray(rows, dtype=np.float64).reshape(-1, SUN_AZIMUTH + 1)
+  hourly = rows[:, BATTERY_POWER] + rows[:, GRID_POWER]
+  totals = np.zeros((len(rows), substeps))
+  counts = np.zeros_like(totals)
+  if row_index:
+    minutes = 60 // substeps
+    cur = database.cursor()
+    cur.execute(
+      ''' SELECT dayminute, battery_power + grid_power
+          FROM powerwall_5min
+          WHERE dayminute >= ? AND dayminute <= ? ''',
+      (min(row_index) * 100, max(row_index) * 100 + 59))
+    for dayminute, shortfall in cur:
+      i = row_index.get(dayminute // 100)
+      if i is None:
+        continue
+      j = dayminute % 100 // minutes
+      totals[i, j] += shortfall
+      counts[i, j] += 1
+  # Mean watts over a substep times its length in hours.
+  return np.where(counts > 0, totals / np.maximum(counts, 1) / substeps,
+                  hourly[:, None] / substeps)
+
+
+def episode_row(row, tz, powerplan, latitude, longitude):
+  """ Append the calendar, grid cost and sun position features to a row. """
+  row = list(row)
+  current_date = dayhour_to_datetime(row[DAYHOUR], tz)
+  mid_hour_time = current_date + timedelta(minutes=30)
+  row.append(current_date.weekday())
+  row.append(current_date.hour)
+  row.append(float(powerplan.usage(current_date) / 1000.0))
+  row.append(get_altitude(latitude, longitude, mid_hour_time))
+  row.append(get_azimuth(latitude, longitude, mid_hour_time))
+  return row
+
+
+class EpisodeDataset(object):
+
+  def __init__(self, rows, row_index, windows, substeps=None):
+    # (hours, columns) array of every episode row.
+    self.rows = rows
+    # Row number of each dayhour.
+    self.row_index = row_index
+    # Sorted start dayhours of the windows episodes may use.
+    self.windows = windows
+    # Optional (hours, substeps) sub-hourly shortfall Wh of every row.
+    self.substeps = substeps
+
+  def __len__(self):
+    return len(self.windows)
+
+  def window(self, start_dayhour):
+    i = self.row_index[start_dayhour]
+    return self.rows[i:i + EPISODE_HOURS]
+
+  def window_substeps(self, start_dayhour):
+    i = self.row_index[start_dayhour]
+    return self.substeps[i:i + EPISODE_HOURS]
+
+  def subset(self, start_dayhour=None, end_dayhour=None):
+    """ A dataset sharing these rows, but only windows starting in the range.
+    """
+    return EpisodeDataset(self.rows, self.row_index, [
+      w for w in self.windows
+      if (start_dayhour is None or w >= start_dayhour) and
+      (end_dayhour is None or w < end_dayhour)
+    ], self.substeps)
+
+  def daily(self):
+    """ A dataset of only the windows starting at midnight. """
+    return EpisodeDataset(self.rows, self.row_index,
+                          [w for w in self.windows if w % 100 == 0],
+                          self.substeps)
+
+
+def load_dataset(config, powerplan, database=None, substeps=None):
+  """ Load every complete episode window for the configured home.
+
+    With substeps the 5 minute data is loaded too, for sub-hourly simulation.
+  """
+  con = database or sqlite3.connect(config.database_location)
+  tz = dateutil.tz.gettz(config.local_timezone)
+  windows = EpisodeWindowIndex(con, config.local_timezone).windows()
+
+  cur = con.cursor()
+  cur.execute(EPISODE_SELECT + ''' WHERE powerwall.dayhour >= ?
+                                   ORDER BY powerwall.dayhour ''',
+              (windows[0] if windows else 0,))
+
+  # Only keep rows some window actually covers.
+  rows = []
+  row_index = {}
+  window_set = set(windows)
+  latitude, longitude = config.latitude, config.longitude
+  remaining = 0
+  for row in cur:
+    if row[DAYHOUR] in window_set:
+      remaining = EPISODE_HOURS
+    if remaining > 0:
+      remaining -= 1
+      row_index[row[DAYHOUR]] = len(rows)
+      rows.append(episode_row(row, tz, powerplan, latitude, longitude))
+
+  logger.info("Loaded %d episode windows over %d hours.", len(windows),
+              len(rows))
+  rows = np.array(rows, dtype=np.float64)
+  return EpisodeDataset(
+    rows, row_index, windows,
+    load_substeps(con, row_index, rows, substeps) if substeps else None)
+
+
+class FleetSite(object):
+  """ Everything an environment needs to simulate one site of a fleet. """
+
+  def __init__(self, config, dataset):
+    self.config = config
+    self.site_id = config.site_id
+    self.tz = dateutil.tz.gettz(config.local_timezone)
+    self.plan = config.grid_plan
+    self.battery = config.battery
+    self.dataset = dataset
+
+
+class FleetDataset(object):
+  """ Episode datasets for every site, sampled with stratification.
+
+    stratify picks how likely each window is:
+      None: Every window is equally likely, so sites with more history are
+        sampled more.
+      'site': Every site is equally likely.
+      'site_month': Every month of every site is equally likely, so neither a
+        long history nor a season dominates.
+  """
+
+  def __init__(self, sites, stratify='site'):
+    self.sites = sites
+    self.stratify = stratify
+    # (site, windows) pairs to sample a stratum from, then a window within it.
+    self.strata = []
+    for site in sites:
+      if stratify is None or stratify == 'site':
+        self.strata.append((site, site.dataset.windows))
+      elif stratify == 'site_month':
+        months = {}
+        for w in site.dataset.windows:
+          months.setdefault(w // 10000, []).append(w)
+        self.strata.extend((site, windows) for _, windows in sorted(
+          months.items()))
+      else:
+        raise Exception("Unknown stratification: %s" % stratify)
+    self.strata = [(site, windows) for site, windows in self.strata if windows]
+    if not self.strata:
+      raise Exception("No site has complete episode windows to train on yet.")
+    # Cumulative window counts for unstratified sampling.
+    self.cumulative = np.cumsum([len(windows) for _, windows in self.strata])
+
+  def __len__(self):
+    return int(self.cumulative[-1])
+
+  def sample(self, rng):
+    """ A random (site, start dayhour) pair. """
+    if self.stratify is None:
+      i = int(
+        np.searchsorted(self.cumulative, rng.integers(0, len(self)),
+                        side='right'))
+    else:
+      i = int(rng.integers(0, len(self.strata)))
+    site, windows = self.strata[i]
+    return site, windows[rng.integers(0, len(windows))]
+
+
+def load_fleet_dataset(config, stratify='site', substeps=None):
+  """ Load every complete episode window of every configured site. """
+  sites = []
+  for site_config in config.sites:
+    dataset = load_dataset(site_config, site_config.grid_plan,
+                           substeps=substeps)
+    if not len(dataset):
+      logger.warning("Site %s has no complete episode windows yet.",
+                     site_config.site_id)
+    sites.append(FleetSite(site_config, dataset))
+  return FleetDataset(sites, stratify)
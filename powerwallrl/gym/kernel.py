@@ -0,0 +1,176 @@
+""" Vectorized battery step kernel.
+
+This applies the same battery rules as HomePowerEnv.step to whole arrays of
+independent batteries at once, eg. every day of the history or every battery
+configuration in a sweep. It only moves energy, pricing is left to the caller
+so one simulation can be priced under any number of power plans.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import numpy as np
+
+from powerwallrl.gym.battery import EFFICIENCY
+
+
+def battery_step(charge, charge_left, target, shortfall, capacity,
+                 discharge_limit, charge_limit):
+  """ Step batteries through one hour.
+
+    All arguments broadcast against each other.
+
+    charge: Battery percent at the start of the hour.
+    charge_left: Percent of capacity we are still allowed to charge today.
+    target: Backup reserve percent set for the hour.
+    shortfall: Wh the home needs beyond its solar, negative for excess solar.
+    capacity, discharge_limit, charge_limit: See Battery.
+
+    Returns the charge, charge_left and shortfall after the hour along with the
+    battery Wh, positive when discharging and negative when charging.
+  """
+  charge = np.asarray(charge, dtype=np.float64)
+  charge_left = np.asarray(charge_left, dtype=np.float64)
+  target = np.asarray(target, dtype=np.float64)
+  shortfall = np.asarray(shortfall, dtype=np.float64)
+
+  # Discharge down to the target to cover the shortfall.
+  discharging = (target < charge) & (shortfall > 0)
+  discharge = np.where(
+    discharging,
+    np.minimum(np.minimum(shortfall, discharge_limit),
+               (charge - target) / 100 * capacity), 0.0)
+
+  # Charge from the grid up to the target, within today's charge allowance.
+  charging = (target > charge) & (shortfall > 0)
+  grid_charge = np.where(
+    charging,
+    np.maximum(
+      0,
+      np.minimum(
+        np.minimum(charge_limit, (target - charge) / 100 * capacity),
+        charge_left / 100 * capacity) / EFFICIENCY), 0.0)
+  grid_charge_percent = np.round(grid_charge / capacity * 100)
+
+  new_charge = (charge - np.round(discharge / capacity * 100) +
+                grid_charge_percent)
+  new_charge_left = charge_left - grid_charge_percent
+  shortfall = shortfall - discharge + grid_charge * EFFICIENCY
+  battery_wh = discharge - grid_charge
+
+  # Excess solar always goes into the battery until it's full.
+  excess = (shortfall < 0) & (new_charge < 100)
+  wh_to_full = (100 - new_charge) / 100 * capacity * EFFICIENCY
+  partial = excess & (wh_to_full > shortfall * -1)
+  full = excess & ~partial
+  partial_percent = np.round(shortfall * -1 / capacity / EFFICIENCY * 100)
+  full_percent = np.round(wh_to_full / capacity / EFFICIENCY * 100)
+
+  new_charge_left = np.where(
+    partial, new_charge_left - partial_percent,
+    np.where(full, new_charge_left - full_percent, new_charge_left))
+  new_charge = np.where(partial, new_charge + partial_percent,
+                        np.where(full, 100, new_charge))
+  battery_wh = np.where(partial, shortfall,
+                        np.where(full, wh_to_full * -1, battery_wh))
+  shortfall = np.where(partial, 0.0,
+                       np.where(full, shortfall + wh_to_full, shortfall))
+
+  return new_charge, new_charge_left, shortfall, battery_wh
+
+
+def battery_substeps(charge, charge_left, target, shortfalls, capacity,
+                     discharge_limit, charge_limit):
+  """ Step batteries through one hour split into equal substeps.
+
+    Same rules as battery_step but shortfalls has the substeps as its last
+    axis, each substep getting an equal share of the hourly rate limits.
+    Percentages aren't rounded between substeps so small flows aren't lost.
+
+    Returns the charge and charge_left after the hour, and the shortfall and
+    battery Wh of every substep.
+  """
+  shortfalls = np.asarray(shortfalls, dtype=np.float64)
+  if np.ndim(charge) == 0 and shortfalls.ndim == 1:
+    return _battery_substeps_scalar(
+      float(charge), float(charge_left), float(target), shortfalls,
+      capacity, discharge_limit, charge_limit)
+
+  n = shortfalls.shape[-1]
+  discharge_limit = discharge_limit / n
+  charge_limit = charge_limit / n
+  charge = np.asarray(charge, dtype=np.float64)
+  charge_left = np.asarray(charge_left, dtype=np.float64)
+  target = np.asarray(target, dtype=np.float64)
+  after = np.empty(np.broadcast(charge, shortfalls[..., 0]).shape + (n,))
+  battery_wh = np.empty_like(after)
+  for i in range(n):
+    shortfall = shortfalls[..., i]
+    discharge = np.where(
+      (target < charge) & (shortfall > 0),
+      np.minimum(np.minimum(shortfall, discharge_limit),
+                 (charge - target) / 100 * capacity), 0.0)
+    grid_charge = np.where(
+      (target > charge) & (shortfall > 0),
+      np.maximum(
+        0,
+        np.minimum(
+          np.minimum(charge_limit, (target - charge) / 100 * capacity),
+          charge_left / 100 * capacity) / EFFICIENCY), 0.0)
+    charge = charge + (grid_charge - discharge) / capacity * 100
+    charge_left = charge_left - grid_charge / capacity * 100
+    shortfall = shortfall - discharge + grid_charge * EFFICIENCY
+
+    # Excess solar goes into the battery until it's full.
+    solar_charge = np.where(
+      (shortfall < 0) & (charge < 100),
+      np.minimum(shortfall * -1 / EFFICIENCY, (100 - charge) / 100 * capacity),
+      0.0)
+    charge = charge + solar_charge / capacity * 100
+    charge_left = charge_left - solar_charge / capacity * 100
+    after[..., i] = shortfall + solar_charge * EFFICIENCY
+    battery_wh[..., i] = discharge - grid_charge - solar_charge * EFFICIENCY
+  return charge, charge_left, after, battery_wh
+
+
+def _battery_substeps_scalar(charge, charge_left, target, shortfalls,
+                             capacity, discharge_limit, charge_limit):
+  """ battery_substeps for a single battery with plain floats.
+
+    A lone environment would spend most of its time in numpy call overhead on
+    one element arrays, this keeps a sub-hourly step about as cheap as an
+    hourly one.
+  """
+  n = len(shortfalls)
+  discharge_limit = discharge_limit / n
+  charge_limit = charge_limit / n
+  after = np.empty(n)
+  battery_wh = np.empty(n)
+  for i, shortfall in enumerate(shortfalls.tolist()):
+    wh = 0.0
+    if shortfall > 0 and target < charge:
+      discharge = min(shortfall, discharge_limit,
+                      (charge - target) / 100 * capacity)
+      charge -= discharge / capacity * 100
+      shortfall -= discharge
+      wh = discharge
+    elif shortfall > 0 and target > charge:
+      grid_charge = max(
+        0.0,
+        min(charge_limit, (target - charge) / 100 * capacity,
+            charge_left / 100 * capacity) / EFFICIENCY)
+      charge += grid_charge / capacity * 100
+      charge_left -= grid_charge / capacity * 100
+      shortfall += grid_charge * EFFICIENCY
+      wh = -grid_charge
+    if shortfall < 0 and charge < 100:
+      solar_charge = min(shortfall * -1 / EFFICIENCY,
+                         (100 - charge) / 100 * capacity)
+      charge += solar_charge / capacity * 100
+      charge_left -= solar_charge / capacity * 100
+      shortfall += solar_charge * EFFICIENCY
+      wh -= solar_charge * EFFICIENCY
+    after[i] = shortfall
+    battery_wh[i] = wh
+  return charge, charge_left, after, battery_wh
@@ -8,6 +8,7 @@ save from your grid's usage power bill.
 
 __version__ = '0.0.1'
 
+import bisect
 import calendar
 import dateutil.tz
 import logging
@@ -18,20 +19,58 @@ from tabulate import tabulate
 
 from datetime import datetime
 from datetime import timedelta
-from gym import Env
-from gym.spaces import Dict, Box
-from gym.utils import seeding
-from gym.wrappers import FlattenObservation
+from gymnasium import Env
+from gymnasium.spaces import Dict, Box
+from gymnasium.wrappers import FlattenObservation
 from pysolar.solar import get_altitude, get_azimuth
+from powerwallrl.data.episodes import EpisodeWindowIndex
+from powerwallrl.data.episodes import dayhour_to_hour
+from powerwallrl.gym.dataset import EPISODE_SELECT
+from powerwallrl.gym.dataset import episode_row
+from powerwallrl.gym.dataset import load_substeps
+from powerwallrl.gym.kernel import battery_substeps
+from powerwallrl.gym.prefetch import DEFAULT_MAX_BYTES
+from powerwallrl.gym.prefetch import EpisodePrefetcher
+from powerwallrl.profiling import Profiler
+
+
+class EnvState(object):
+  """ Where a HomePowerEnv is within its episode, see HomePowerEnv.get_state().
+
+    The episode's rows, substeps, plan and battery are shared, never copied, so
+    a state is a handful of scalars and references however long the episode.
+  """
+  __slots__ = ('offset', 'battery_charge', 'battery_charge_left',
+               'initial_battery_charge', 'data_set', 'substep_set', 'plan',
+               'battery', 'tz')
+
+  def __init__(self, offset, battery_charge, battery_charge_left,
+               initial_battery_charge, data_set, substep_set, plan, battery,
+               tz):
+    self.offset = offset
+    self.battery_charge = battery_charge
+    self.battery_charge_left = battery_charge_left
+    self.initial_battery_charge = initial_battery_charge
+    self.data_set = data_set
+    self.substep_set = substep_set
+    self.plan = plan
+    self.battery = battery
+    self.tz = tz
 
 
 class HomePowerEnv(Env):
   def __init__(self, config, powerplan, dayhour_offset=None, debug=True,
                debug_ratio=.001, battery_charge=30,
                randomize_battery_start=True, reward_backup_percent=True,
-               reward_battery_left=True):
-    # The only action we can set is the target battery charge percentage.
-    self.action_space = Box(low=-1, high=1, shape=(1,), dtype=np.float32)
+               reward_battery_left=True, battery=None, dataset=None,
+               fleet=None, profile=False, substeps=1, action_hours=1,
+               schedule=False, prefetch=0,
+               prefetch_max_bytes=DEFAULT_MAX_BYTES):
+    # The only action we can set is the target battery charge percentage. As a
+    # schedule that's one target per hour of the day, set once per episode.
+    self.schedule = schedule
+    self.action_space = Box(low=-1, high=1, shape=(24 if schedule else 1,),
+                            dtype=np.float32)
 
     # Temperature array
     spaces = {
@@ -48,6 +87,8 @@ class HomePowerEnv(Env):
     }
     # Used to log updates and debugging information.
     self.logger = logging.getLogger()
+    # Times the hot paths when enabled, see profile_stats().
+    self.profiler = Profiler(profile)
     self.observation_space = Dict(spaces)
     self.config = config
     self.tz = dateutil.tz.gettz(self.config.local_timezone)
@@ -55,46 +96,80 @@ class HomePowerEnv(Env):
         raise Exception("No valid timezone found in configuration.")
     self.con = sqlite3.connect(self.config.database_location)
     self.plan = powerplan
+    self.episode_index = EpisodeWindowIndex(self.con,
+                                            self.config.local_timezone)
+    # Start dayhours of complete episode windows and their hours since epoch,
+    # loaded on first use.
+    self.episode_windows = None
+    self.episode_hours = None
+    # Optional preloaded EpisodeDataset to sample from instead of the database.
+    self.dataset = dataset
+    # Optional FleetDataset, each episode then simulates a sampled site.
+    self.fleet = fleet
+
+    # Simulate each hour in this many equal substeps from the 5 minute data,
+    # with the agent acting every action_hours.
+    if 24 % action_hours:
+      raise Exception("action_hours must divide a day evenly.")
+    self.substeps = substeps
+    self.action_hours = action_hours
+    self.substep_set = None
+
+    # Random episodes from the database are prepared this many ahead in the
+    # background, see EpisodePrefetcher.
+    self.prefetch = prefetch
+    self.prefetch_max_bytes = prefetch_max_bytes
+    self.prefetcher = None
 
     self.dayhour_offset = dayhour_offset
     self.debug = debug
     self.debug_ratio = debug_ratio
 
-    # Total Wh the telsa battery has.
+    # Total Wh the telsa battery has and how fast we can charge or discharge it
+    # in one hour.
     # TODO(): Get this from tesla API.
-    self.battery_capacity = 13500
-    # We can only charge or discharge 5KwH of the battery in one hour.
-    # TODO(): Add multi-battery support.
-    self.max_battery_discharge_rate_ratio = float(
-      (5000 / self.battery_capacity) / 1.1)
-    self.max_battery_charge_rate_ratio = float(
-      (3300 / self.battery_capacity) / 1.1)
+    self.set_battery(battery or self.config.battery)
 
     # Set start or randomize battery starting charge on restarts.
     self.battery_charge = battery_charge
+    self.start_battery_charge = battery_charge
     self.randomize_battery_start = randomize_battery_start
     self.reward_backup_percent = reward_backup_percent
     self.reward_battery_left = reward_battery_left
 
+    # The episode's rows, loaded by reset().
+    self.data_set = None
     self.offset = 0
     self.battery_charge_left = 100
-    self.seed()
-    self.battery_usage = []
-    self.battery_charge_list = []
-    self.battery_state = []
-    self.action_list = []
-    self.reward_list = []
-    self.after_cost_list = []
-    self.default_reward_list = []
-    self.datetime_list = []
-    self.shortfall_list = []
-    self.home_usage_list = []
-    self.orig_battery_list = []
-    self.solar_list = []
-    self.battery_left_list = []
-    self.what_to_do = []
+    self.initial_battery_charge = battery_charge
+    self.clear_day()
 
   def step(self, action):
+    if self.schedule:
+      return self.step_schedule(action)
+    if self.substeps > 1:
+      return self.step_substeps(action)
+    if self.action_hours > 1:
+      return self.step_hours(action)
+    return self.step_hour(action)
+
+  def step_schedule(self, action):
+    """ Run the whole day from a schedule of one target per hour. """
+    reward = 0.0
+    terminated = False
+    while not terminated:
+      hour_action = action[self.offset:self.offset + 1]
+      if self.substeps > 1:
+        observation, hour_reward, terminated, truncated, info = (
+          self.step_substeps(hour_action))
+      else:
+        observation, hour_reward, terminated, truncated, info = (
+          self.step_hour(hour_action))
+      reward += hour_reward
+    return observation, reward, terminated, truncated, info
+
+  def step_hour(self, action):
+    start = self.profiler.timer()
     # home_usage = battery_usage + grid + solar
     home_usage = (self.data_set[self.offset][3] +
                   self.data_set[self.offset][2] + self.data_set[self.offset][1])
@@ -239,7 +314,94 @@ class HomePowerEnv(Env):
     self.datetime_list.append(dt.hour)
     self.shortfall_list.append(int(short_fall_power))
 
-    if (self.offset == 23 and self.debug and random.random() < self.debug_ratio):
+    if self.offset == 23:
+      self.end_of_day()
+
+    self.offset = self.offset + 1
+
+    fill_start = self.profiler.timer()
+    observation = self.fill_data(self.offset)
+    self.profiler.record('fill_data', fill_start)
+    self.profiler.record('step', start)
+    return observation, reward, (self.offset == 24), False, {}
+
+  def step_hours(self, action):
+    """ Hold the action for action_hours, stepping each hour as step_hour()
+      does, so the battery rounds to whole percents each hour as in the
+      backtester.
+    """
+    reward = 0.0
+    for _ in range(self.action_hours):
+      observation, hour_reward, terminated, truncated, info = self.step_hour(
+        action)
+      reward += hour_reward
+    return observation, reward, terminated, truncated, info
+
+  def step_substeps(self, action):
+    """ Hold the action for action_hours, simulating each hour in substeps.
+
+      Same rewards as step(), but imports and exports within an hour are priced
+      separately and the battery follows the 5 minute load and solar.
+    """
+    start = self.profiler.timer()
+    action = max(0, min(100, round(action[0] * 50 + 50)))
+    reward = 0.0
+    for _ in range(self.action_hours):
+      row = self.data_set[self.offset]
+      dt = self.dayhour_to_datetime(row[0])
+      usage = self.grid_usage(dt)
+      feedback = self.grid_feedback(dt)
+      shortfalls = self.substep_set[self.offset]
+
+      self.action_list.append(action)
+      self.battery_state.append(round(self.battery_charge))
+      self.home_usage_list.append(round(row[3] + row[2] + row[1]))
+      self.orig_battery_list.append(round(row[2]))
+      self.solar_list.append(round(row[1]))
+
+      default_reward = -float(
+        np.where(shortfalls > 0, shortfalls * usage, shortfalls * feedback).sum())
+      self.battery_charge, self.battery_charge_left, after, battery_wh = (
+        battery_substeps(self.battery_charge, self.battery_charge_left, action,
+                         shortfalls, self.battery_capacity,
+                         self.battery.discharge_limit,
+                         self.battery.charge_limit))
+      self.battery_usage.append(round(float(battery_wh.sum())))
+      self.battery_left_list.append(round(self.battery_charge_left))
+      self.what_to_do.append('S')
+
+      # Battery wear, see step().
+      hour_reward = -float(np.maximum(battery_wh, 0).sum()) / 1000.0 * 0.115
+      hour_reward -= float(
+        np.where(after > 0, after * usage, after * feedback).sum())
+      self.after_cost_list.append(int(hour_reward))
+
+      if self.offset == 23 and self.reward_battery_left:
+        hour_reward += self.battery_capacity * (
+          (self.battery_charge - self.initial_battery_charge) / 100) * usage
+      hour_reward -= default_reward
+      if self.battery_charge > 65 and self.reward_backup_percent:
+        hour_reward += (15000.0 / (360.0 * 24.0))
+
+      self.default_reward_list.append(round(default_reward))
+      self.reward_list.append(int(hour_reward))
+      self.datetime_list.append(dt.hour)
+      self.shortfall_list.append(int(after.sum()))
+      reward += hour_reward
+
+      if self.offset == 23:
+        self.end_of_day()
+      self.offset = self.offset + 1
+
+    fill_start = self.profiler.timer()
+    observation = self.fill_data(self.offset)
+    self.profiler.record('fill_data', fill_start)
+    self.profiler.record('step', start)
+    return observation, reward, (self.offset == 24), False, {}
+
+  def end_of_day(self):
+    """ Log a sample of days for debugging and start the next day's lists. """
+    if (self.debug and random.random() < self.debug_ratio):
       self.logger.info("\n" +
         tabulate([
           ["Battery Percent"] + self.battery_state,
@@ -259,68 +421,149 @@ class HomePowerEnv(Env):
         "\nTotal Reward: " + str(sum(self.reward_list)) +
         "\nAfter Cost: " + str(sum(self.after_cost_list) * -1) +
         "\nDefault Cost: " + str(sum(self.default_reward_list) * -1))
-    if (self.offset == 23):
-      self.battery_state = []
-      self.battery_charge_list = []
-      self.battery_usage = []
-      self.action_list = []
-      self.reward_list = []
-      self.after_cost_list = []
-      self.default_reward_list = []
-      self.datetime_list = []
-      self.shortfall_list = []
-      self.solar_list = []
-      self.home_usage_list = []
-      self.orig_battery_list = []
-      self.battery_left_list = []
-      self.what_to_do = []
-
-    self.offset = self.offset + 1
-
-    return self.fill_data(self.offset), reward, (self.offset == 24), {}
-
-  def dayhour_to_datetime(self, dayhour):
-    dayhour = str(dayhour)
-    return datetime(int(dayhour[0:4]),
-                    int(dayhour[4:6]),
-                    int(dayhour[6:8]),
-                    int(dayhour[8:10]),
-                    0,
-                    0,
-                    tzinfo=self.tz)
+    self.clear_day()
 
-  def seed(self, seed=None):
-    self.np_random, seed = seeding.np_random(seed)
-    return [seed]
-
-  def reset(self):
+  def clear_day(self):
+    """ Start the per hour lists logged at the end of the day afresh. """
     self.battery_state = []
     self.battery_charge_list = []
     self.battery_usage = []
     self.action_list = []
     self.reward_list = []
+    self.after_cost_list = []
     self.default_reward_list = []
     self.datetime_list = []
     self.shortfall_list = []
     self.solar_list = []
     self.home_usage_list = []
     self.orig_battery_list = []
+    self.battery_left_list = []
+    self.what_to_do = []
+
+  def get_state(self):
+    """ A snapshot of the episode to branch from with set_state(). """
+    if self.data_set is None:
+      raise Exception("There's no episode to snapshot yet, reset() the "
+                      "environment first.")
+    return EnvState(self.offset, self.battery_charge, self.battery_charge_left,
+                    self.initial_battery_charge, self.data_set,
+                    self.substep_set, self.plan, self.battery, self.tz)
+
+  def set_state(self, state):
+    """ Continue the episode from a get_state() snapshot, returning its
+      observation. Stepping never changes the shared rows, so one state can be
+      restored any number of times. The per hour debugging lists restart.
+    """
+    self.offset = state.offset
+    self.battery_charge = state.battery_charge
+    self.battery_charge_left = state.battery_charge_left
+    self.initial_battery_charge = state.initial_battery_charge
+    self.data_set = state.data_set
+    self.substep_set = state.substep_set
+    self.plan = state.plan
+    if state.battery is not self.battery:
+      self.set_battery(state.battery)
+    self.tz = state.tz
+    self.clear_day()
+    return self.fill_data(self.offset)
+
+  def set_battery(self, battery):
+    self.battery = battery
+    self.battery_capacity = self.battery.capacity
+    self.max_battery_discharge_rate_ratio = float(
+      self.battery.discharge_limit / self.battery_capacity)
+    self.max_battery_charge_rate_ratio = float(
+      self.battery.charge_limit / self.battery_capacity)
+
+  def use_site(self, site):
+    """ Simulate a FleetSite's home, plan and battery from now on. """
+    self.config = site.config
+    self.tz = site.tz
+    self.plan = site.plan
+    self.set_battery(site.battery)
+    self.dataset = site.dataset
+    self.episode_windows = None
+    self.episode_hours = None
+
+  def dayhour_to_datetime(self, dayhour):
+    dayhour = str(int(dayhour))
+    return datetime(int(dayhour[0:4]),
+                    int(dayhour[4:6]),
+                    int(dayhour[6:8]),
+                    int(dayhour[8:10]),
+                    0,
+                    0,
+                    tzinfo=self.tz)
 
-    # Start with a random amount of battery.
-    if self.randomize_battery_start:
-      self.battery_charge = self.np_random.randint(0, 100)
+  def reset(self, *, seed=None, options=None):
+    """ Start a new day. options may set 'battery_charge' to start from. """
+    super().reset(seed=seed)
+    options = options or {}
+    start = self.profiler.timer()
+    self.clear_day()
+
+    # Start with a random amount of battery, otherwise every episode starts
+    # from the same charge so episodes are independent.
+    if 'battery_charge' in options:
+      self.battery_charge = options['battery_charge']
+    elif self.randomize_battery_start:
+      self.battery_charge = self.np_random.integers(0, 100)
+    else:
+      self.battery_charge = self.start_battery_charge
     self.initial_battery_charge = self.battery_charge
 
-    if self.dayhour_offset:
+    data_start = self.profiler.timer()
+    prefetched = False
+    if self.fleet is not None:
+      site, start_dayhour = self.fleet.sample(self.np_random)
+      self.use_site(site)
+      self.data_set = site.dataset.window(start_dayhour)
+    elif self.dayhour_offset is not None:
       self.data_set = self.get_data(self.dayhour_offset)
-      self.dayhour_offset += 24
+      # Continue from the window actually used, which is later than asked for
+      # if there was a gap in the data.
+      self.dayhour_offset = (dayhour_to_hour(self.data_set[0][0], self.tz) -
+                             self.episode_hours[0] + 24)
+    elif self.prefetch and self.dataset is None:
+      if self.prefetcher is None:
+        self.prefetcher = EpisodePrefetcher(
+          self.config, self.plan,
+          substeps=self.substeps if self.substeps > 1 else None,
+          depth=self.prefetch, max_bytes=self.prefetch_max_bytes,
+          seed=int(self.np_random.integers(0, 2**32)))
+      self.data_set, self.substep_set = self.prefetcher.get()
+      prefetched = True
     else:
       self.data_set = self.get_data()
+    if self.substeps > 1 and not prefetched:
+      self.substep_set = self.get_substeps(self.data_set)
+    self.profiler.record('get_data', data_start)
 
     self.offset = 0
     self.battery_charge_left = 100
 
-    return self.fill_data(0)
+    fill_start = self.profiler.timer()
+    observation = self.fill_data(0)
+    self.profiler.record('fill_data', fill_start)
+    self.profiler.record('reset', start)
+    return observation, {}
+
+  def close(self):
+    if self.prefetcher is not None:
+      self.prefetcher.close()
+      self.prefetcher = None
+    super().close()
+
+  def enable_profiling(self, enabled=True):
+    self.profiler.enabled = enabled
+    self.profiler.reset()
+
+  def profile_stats(self, reset=True):
+    """ This worker's section timings since the last call. """
+    stats = self.profiler.stats()
+    if reset:
+      self.profiler.reset()
+    return stats
 
   def fill_data(self, offset):
     inverted_data_set = list(zip(*self.data_set[offset:offset + 24]))
@@ -349,76 +592,73 @@ class HomePowerEnv(Env):
   def render(self):
     pass
 
-  def data_set_size(self):
-    if hasattr(self, 'data_set_size_count'):
-      return self.data_set_size
+  def valid_windows(self):
+    """ Start dayhours of every complete, gap free 48 hour episode window. """
+    if self.episode_windows is None:
+      if self.dataset is not None:
+        self.episode_windows = self.dataset.windows
+      else:
+        self.episode_windows = self.episode_index.windows()
+      if not self.episode_windows:
+        raise Exception("No complete 48 hour windows of power and weather "
+                        "data to train on yet.")
+      self.episode_hours = [
+        dayhour_to_hour(dayhour, self.tz) for dayhour in self.episode_windows
+      ]
+    return self.episode_windows
 
-    cur = self.con.cursor()
-    cur.execute(''' SELECT count(*)
-                    FROM powerwall INNER JOIN weather_24
-                    ON powerwall.dayhour = weather_24.dayhour ''')
-    row_count = cur.fetchall()
-    
+  def data_set_size(self):
     # We can only start a episode if we have 48 hours of data into the future,
     # the 24th hour of an episode needs 24 hours of weather forecast
     # observations into the future.
-    return row_count[0][0] - 48
+    return len(self.valid_windows())
 
   def earliest_datetime(self):
-    if hasattr(self, 'earliest_datettime_dt'):
-      return self.earliest_datettime_dt
-
-    cur = self.con.cursor()
-    cur.execute(''' SELECT powerwall.dayhour
-                    FROM powerwall INNER JOIN weather_24
-                    ON powerwall.dayhour = weather_24.dayhour
-                    ORDER BY powerwall.dayhour
-                    LIMIT 1 ''')
-
-    row_count = cur.fetchall()
-    return self.dayhour_to_datetime(row_count[0][0])
+    return self.dayhour_to_datetime(self.valid_windows()[0])
 
   def get_data(self, dayhour_offset=None):
-    if not dayhour_offset:
-      dayhour_offset = self.np_random.randint(0, self.data_set_size())
+    windows = self.valid_windows()
+    if dayhour_offset is None:
+      start_dayhour = windows[self.np_random.integers(0, len(windows))]
+    else:
+      # The first complete window at or after the offset, wrapping around once
+      # we run off the end of the history.
+      i = bisect.bisect_left(self.episode_hours,
+                             self.episode_hours[0] + dayhour_offset)
+      start_dayhour = windows[i % len(windows)]
 
-    earliest_datetime = self.earliest_datetime()
-    start_datetime = self.earliest_datetime() + timedelta(hours=dayhour_offset)
+    if self.dataset is not None:
+      return self.dataset.window(start_dayhour)
 
+    sql_start = self.profiler.timer()
     cur = self.con.cursor()
     cur.execute(
-      ''' SELECT powerwall.dayhour AS dayhour,
-                               powerwall.solar_power AS solar_power,
-                               powerwall.battery_power AS battery_power,
-                               powerwall.grid_power AS grid_power,
-                               weather_24.temp AS temp,
-                               weather_24.uvi AS uvi,
-                               weather_24.clouds AS clouds,
-                               weather_24.humidity AS humidity
-          FROM powerwall INNER JOIN weather_24
-          ON powerwall.dayhour = weather_24.dayhour
-          WHERE powerwall.dayhour > ?
-          ORDER BY powerwall.dayhour
-          LIMIT 48 ''',
-      (str(start_datetime.strftime("%Y%m%d%H")),))
-
-    data = cur.fetchall()
-    final_data = []
-    for row in data:
-      row = list(row)
-      current_date = self.dayhour_to_datetime(row[0])
-      mid_hour_time = current_date + timedelta(minutes=30)
-      row.append(current_date.weekday())
-      row.append(current_date.hour)
-      row.append(float(self.grid_usage(current_date)))
-      row.append(
-        get_altitude(self.config.latitude, self.config.longitude,
-                     mid_hour_time))
-      row.append(
-        get_azimuth(self.config.latitude, self.config.longitude,
-                    mid_hour_time))
-      final_data.append(row)
-    return final_data
+      EPISODE_SELECT + ''' WHERE powerwall.dayhour >= ?
+                           ORDER BY powerwall.dayhour
+                           LIMIT 48 ''', (start_dayhour,))
+    rows = cur.fetchall()
+    self.profiler.record('sql', sql_start)
+
+    # Mostly pysolar's sun position.
+    features_start = self.profiler.timer()
+    latitude, longitude = self.config.latitude, self.config.longitude
+    rows = [
+      episode_row(row, self.tz, self.plan, latitude, longitude) for row in rows
+    ]
+    self.profiler.record('features', features_start)
+    return rows
+
+
+  def get_substeps(self, data_set):
+    """ (hours, substeps) shortfall Wh of an episode's rows. """
+    if self.dataset is not None:
+      if (self.dataset.substeps is None or
+          self.dataset.substeps.shape[1] != self.substeps):
+        raise Exception("The dataset wasn't loaded with %d substeps." %
+                        self.substeps)
+      return self.dataset.window_substeps(int(data_set[0][0]))
+    row_index = {int(row[0]): i for i, row in enumerate(data_set)}
+    return load_substeps(self.con, row_index, data_set, self.substeps)
 
 
 class HomePowerPredictEnv(HomePowerEnv):
@@ -427,9 +667,11 @@ class HomePowerPredictEnv(HomePowerEnv):
                powerplan,
                start_datetime=None,
                battery_charge=30,
-               debug=True):
+               debug=True,
+               battery=None):
     super().__init__(config, powerplan, battery_charge=battery_charge,
-                     debug=debug, randomize_battery_start=False)
+                     debug=debug, randomize_battery_start=False,
+                     battery=battery)
 
     self.start_datetime = start_datetime
 
@@ -478,6 +720,7 @@ class HomePowerPredictEnv(HomePowerEnv):
     data = cur.fetchall()
 
     final_data = []
+    latitude, longitude = self.config.latitude, self.config.longitude
     for row in data:
       row = list(row)
       current_date = self.dayhour_to_datetime(row[0])
@@ -485,10 +728,10 @@ class HomePowerPredictEnv(HomePowerEnv):
       row.append(current_date.hour)
       row.append(float(self.grid_usage(current_date)))
       row.append(
-        get_altitude(self.config.latitude, self.config.longitude,
+        get_altitude(latitude, longitude,
                      current_date + timedelta(minutes=30)))
       row.append(
-        get_azimuth(self.config.latitude, self.config.longitude,
+        get_azimuth(latitude, longitude,
                     current_date + timedelta(minutes=30)))
       final_data.append(row)
     return final_data
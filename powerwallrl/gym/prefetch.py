@@ -0,0 +1,153 @@
+""" This module prepares upcoming episodes in the background for environments
+reading the history from SQLite rather than a preloaded dataset.
+
+An EpisodePrefetcher samples episode windows, queries their rows and computes
+the sun position features in a daemon thread, and keeps them ready in a bounded
+queue. A reset then only takes the next episode off the queue. SQLite releases
+the GIL while it reads, and a SubprocVecEnv worker spends most of its time
+waiting on the learner, which is when the thread does the pysolar work.
+Environments in SubprocVecEnv workers can't start processes of their own, as
+the workers are daemons, hence a thread.
+
+Every episode is the same size, so memory is bounded by limiting the queue to
+as many episodes as fit in max_bytes.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import logging
+import numpy as np
+import queue
+import sqlite3
+import threading
+
+from powerwallrl.data.episodes import EpisodeWindowIndex
+from powerwallrl.gym.dataset import EPISODE_SELECT
+from powerwallrl.gym.dataset import episode_row
+from powerwallrl.gym.dataset import load_substeps
+
+logger = logging.getLogger(__name__)
+
+# An episode's rows and 5 minute substeps take about 10KB, so this is several
+# hundred episodes.
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+def load_episode(con, config, powerplan, tz, start_dayhour, substeps=None):
+  """ The rows of the episode window starting at start_dayhour, and their
+    (hours, substeps) shortfall Wh if substeps is given, as HomePowerEnv
+    simulates them.
+  """
+  cur = con.cursor()
+  cur.execute(
+    EPISODE_SELECT + ''' WHERE powerwall.dayhour >= ?
+                         ORDER BY powerwall.dayhour
+                         LIMIT 48 ''', (start_dayhour,))
+  latitude, longitude = config.latitude, config.longitude
+  rows = np.array([
+    episode_row(row, tz, powerplan, latitude, longitude)
+    for row in cur.fetchall()
+  ], dtype=np.float64)
+  if substeps is None:
+    return rows, None
+  if substeps == 1:
+    return rows, np.array([[row[2] + row[3]] for row in rows])
+  row_index = {int(row[0]): i for i, row in enumerate(rows)}
+  return rows, load_substeps(con, row_index, rows, substeps)
+
+
+class EpisodePrefetcher(object):
+
+  def __init__(self, config, powerplan, substeps=None, depth=16,
+               max_bytes=DEFAULT_MAX_BYTES, seed=None):
+    """ Prefetch up to depth episodes, fewer if they'd take over max_bytes.
+
+      substeps is passed to load_episode(). The thread starts on the first
+      get().
+    """
+    if depth < 1:
+      raise Exception("The prefetch depth must be at least 1.")
+    self.config = config
+    self.powerplan = powerplan
+    self.substeps = substeps
+    self.depth = depth
+    self.max_bytes = max_bytes
+    self.rng = np.random.default_rng(seed)
+    self.tz = dateutil.tz.gettz(config.local_timezone)
+    self.queue = None
+    # Free places in the queue, set by the thread once it knows how big an
+    # episode is. The queue itself is unbounded so the sentinel always fits.
+    self.slots = None
+    self.thread = None
+    self.stopped = threading.Event()
+    self.error = None
+
+  def start(self):
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self.run, daemon=True,
+                                   name='episode-prefetch')
+    self.thread.start()
+
+  def run(self):
+    try:
+      con = sqlite3.connect(self.config.database_location)
+      index = EpisodeWindowIndex(con, self.config.local_timezone)
+      first = True
+      while not self.stopped.is_set():
+        windows = index.windows()
+        if not windows:
+          raise Exception("No complete 48 hour windows of power and weather "
+                          "data to train on yet.")
+        episode = load_episode(
+          con, self.config, self.powerplan, self.tz,
+          windows[self.rng.integers(0, len(windows))], self.substeps)
+        if first:
+          self.resize(episode)
+          first = False
+        self.put(episode)
+      con.close()
+    except Exception as e:
+      logger.exception("Episode prefetching failed.")
+      self.error = e
+      self.queue.put(None)
+
+  def resize(self, episode):
+    """ Bound the queue by depth and max_bytes, now an episode's size is known.
+    """
+    size = sum(part.nbytes for part in episode if part is not None)
+    depth = max(1, min(self.depth, self.max_bytes // max(size, 1)))
+    if depth < self.depth:
+      logger.info("Prefetching %d episodes to stay within %d bytes.", depth,
+                  self.max_bytes)
+    self.slots = threading.Semaphore(depth)
+
+  def put(self, episode):
+    while not self.stopped.is_set():
+      if self.slots.acquire(timeout=0.1):
+        self.queue.put(episode)
+        return
+
+  def get(self):
+    """ The next episode's (rows, substeps), waiting if none are ready.
+
+      Once prefetching has failed every call raises.
+    """
+    if self.thread is None:
+      self.start()
+    if self.error is None:
+      episode = self.queue.get()
+      if episode is not None:
+        self.slots.release()
+        return episode
+      # Leave the sentinel for anyone else waiting.
+      self.queue.put(None)
+    raise Exception("Episode prefetching failed: %s" % self.error)
+
+  def close(self):
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
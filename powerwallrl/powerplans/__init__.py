@@ -6,6 +6,7 @@ Grid electricity costs and feedback rewards.
 
 __version__ = '0.0.1'
 
+import numpy as np
 
 registry = {}
 
@@ -31,3 +32,26 @@ class Powerplan(metaclass=PowerplanMetaClass):
 
   def usage(self, dt):
     pass
+
+  def usage_array(self, datetimes):
+    """ usage() for a sequence of datetimes as a numpy array.
+
+      Plans can override this with a vectorized version, the default just calls
+      usage() per datetime.
+    """
+    return np.fromiter((self.usage(dt) for dt in datetimes),
+                       dtype=np.float64, count=len(datetimes))
+
+  def feedback_array(self, datetimes):
+    """ feedback() for a sequence of datetimes as a numpy array. """
+    return np.fromiter((self.feedback(dt) for dt in datetimes),
+                       dtype=np.float64, count=len(datetimes))
+
+  @classmethod
+  def is_complete(cls):
+    """ Whether the plan prices both usage and feedback.
+
+      The registry also holds the regional base classes, which don't.
+    """
+    return (cls.usage is not Powerplan.usage and
+            cls.feedback is not Powerplan.feedback)
@@ -0,0 +1,54 @@
+""" Low overhead wall time profiling for the hot paths of training.
+
+A disabled Profiler costs a couple of method calls per timed section, so the
+hooks can stay in the environment permanently and be switched on per run.
+Each environment keeps its own Profiler, which makes the totals per worker when
+environments run in SubprocVecEnv processes.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import collections
+import time
+
+
+class Profiler(object):
+
+  def __init__(self, enabled=False, max_samples=10000):
+    self.enabled = enabled
+    self.max_samples = max_samples
+    self.reset()
+
+  def reset(self):
+    self.started = time.perf_counter()
+    self.counts = collections.Counter()
+    self.totals = collections.Counter()
+    # Recent durations per section, for percentiles.
+    self.samples = {}
+
+  def timer(self):
+    """ Start timing a section, pass the result to record(). """
+    if self.enabled:
+      return time.perf_counter()
+    return None
+
+  def record(self, name, start):
+    if start is None:
+      return
+    seconds = time.perf_counter() - start
+    self.counts[name] += 1
+    self.totals[name] += seconds
+    if name not in self.samples:
+      self.samples[name] = collections.deque(maxlen=self.max_samples)
+    self.samples[name].append(seconds)
+
+  def stats(self):
+    """ Picklable totals since the last reset(). """
+    return {
+      'wall': time.perf_counter() - self.started,
+      'counts': dict(self.counts),
+      'totals': dict(self.totals),
+      'samples': {name: list(s) for name, s in self.samples.items()},
+    }
@@ -1,5 +1,9 @@
 """  This module provides settings interface for various parts of powerwall-rl
-to operate for an individual home.
+to operate for an individual home, or for each home of a fleet.
+
+A fleet is configured with a [site:<id>] section per home. Each site falls back
+to the [powerwall-rl] section for anything it doesn't set itself, except its
+database, which is always kept separate per site.
 """
 
 # Author: Daniel Williams
@@ -10,65 +14,181 @@ import configparser
 import os
 from pathlib import Path
 
-import powerwallrl.powerplans
-import powerwallrl.powerplans.default
-import powerwallrl.powerplans.powerplan
+
+# Settings a site never inherits from the shared section.
+SITE_ONLY_KEYS = ('database_location',)
 
 
 class PowerwallRLConfig(object):
 
-  def __init__(self):
-    self.config = configparser.ConfigParser()
+  def __init__(self, site_id=None, config=None):
     self.dir = os.path.join(Path.home(), '.powerwallrl')
-    self.config.read(os.path.join(self.dir, 'powerwall-rl.ini'))
+    if config is None:
+      config = configparser.ConfigParser()
+      config.read(os.path.join(self.dir, 'powerwall-rl.ini'))
+    self.config = config
+    self.site_id = site_id
+    self._section = None
+
+  @property
+  def section(self):
+    """ This site's settings, falling back to the shared settings.
+
+      Merged on first use and cached, the settings are read once per process.
+    """
+    if self._section is None:
+      section = dict(self.config['powerwall-rl'])
+      if self.site_id is not None:
+        for key in SITE_ONLY_KEYS:
+          section.pop(key, None)
+        section.update(self.config['site:' + self.site_id])
+      self._section = section
+    return self._section
+
+  @property
+  def sites(self):
+    """ A config per configured site, or just this config for a single home.
+    """
+    site_ids = [
+      name[len('site:'):]
+      for name in self.config.sections()
+      if name.startswith('site:')
+    ]
+    if not site_ids:
+      return [self]
+    return [PowerwallRLConfig(site_id, self.config) for site_id in site_ids]
+
+  @property
+  def energy_site_id(self):
+    """ Which of the Tesla account's energy sites this is, the first if unset.
+    """
+    if 'energy_site_id' in self.section:
+      return int(self.section['energy_site_id'])
+    return None
 
   @property
   def latitude(self):
-    return float(self.config['powerwall-rl']['latitude'])
+    return float(self.section['latitude'])
 
   @property
   def longitude(self):
-    return float(self.config['powerwall-rl']['longitude'])
+    return float(self.section['longitude'])
 
   @property
   def openweathermap_api_key(self):
-    return self.config['powerwall-rl']['openweathermap_api_key']
+    return self.section['openweathermap_api_key']
 
   @property
   def tesla_cache_file(self):
-    if ('tesla_cache_file' in self.config['powerwall-rl']):
+    if ('tesla_cache_file' in self.section):
       return str(
-        Path(self.config['powerwall-rl']['tesla_cache_file']).resolve())
+        Path(self.section['tesla_cache_file']).resolve())
     return os.path.join(self.dir, 'tesla_cache.json')
 
+  @property
+  def tesla_api_url(self):
+    """ A stand in for Tesla's API, eg. python -m powerwallrl fake-api, or None.
+    """
+    return self.section.get('tesla_api_url')
+
+  @property
+  def openweathermap_url(self):
+    """ A stand in for OpenWeatherMap's onecall URL, or None. """
+    return self.section.get('openweathermap_url')
+
+  @property
+  def gateway_url(self):
+    """ The Powerwall gateway on the local network, eg. https://192.168.1.20/,
+      or a stand in for it, or None to not poll it.
+    """
+    return self.section.get('gateway_url')
+
+  @property
+  def gateway_password(self):
+    """ The gateway's customer password, None for a stand in without one. """
+    return self.section.get('gateway_password')
+
+  @property
+  def gateway_interval(self):
+    """ Seconds between gateway polls. """
+    return float(self.section.get('gateway_interval', 5))
+
+  @property
+  def gateway_buffer_size(self):
+    """ How many of the latest gateway samples are kept. """
+    return int(self.section.get('gateway_buffer_size', 17280))
+
   @property
   def tesla_username(self):
-    return self.config['powerwall-rl']['tesla_username']
+    return self.section['tesla_username']
 
   @property
   def tesla_password(self):
-    return self.config['powerwall-rl']['tesla_password']
+    return self.section['tesla_password']
 
   @property
   def local_timezone(self):
-    return self.config['powerwall-rl']['local_timezone']
+    return self.section['local_timezone']
 
   @property
   def database_location(self):
-    if ('database_location' in self.config['powerwall-rl']):
+    if ('database_location' in self.section):
       return str(
-        Path(self.config['powerwall-rl']['database_location']).resolve())
+        Path(self.section['database_location']).resolve())
+    if self.site_id is not None:
+      # Created by setup and collection, reading the setting creates nothing.
+      return os.path.join(self.dir, 'sites', self.site_id, 'powerwall-rl.db')
     return os.path.join(self.dir, 'powerwall-rl.db')
 
   @property
   def model_location(self):
-    if ('database_location' in self.config['powerwall-rl']):
+    if ('model_location' in self.section):
       return str(
-        Path(self.config['powerwall-rl']['model_location']).resolve())
+        Path(self.section['model_location']).resolve())
     return os.path.join(self.dir, 'powerwall-model')
 
+  @property
+  def sweep_location(self):
+    """ Where the sweep command saves its ranked hyperparameter trials. """
+    return self.model_location + '.sweep.json'
+
+  @property
+  def autotune_location(self):
+    """ Where train_model.py saves the training setup it autotuned. """
+    return self.model_location + '.autotune.json'
+
+  @property
+  def results_location(self):
+    """ Where every backtested day's outcome is kept, see ResultsStore. """
+    if ('results_location' in self.section):
+      return str(
+        Path(self.section['results_location']).resolve())
+    return os.path.join(self.dir, 'powerwall-rl.results.db')
+
+  @property
+  def metrics_location(self):
+    """ Where data_collect.py writes its ingestion metrics. """
+    if ('metrics_location' in self.section):
+      return str(
+        Path(self.section['metrics_location']).resolve())
+    return os.path.join(self.dir, 'powerwall-rl.prom')
+
   @property
   def grid_plan(self):
-    if ('grid_plan' in self.config['powerwall-rl']):
-      return powerwallrl.powerplans.registry[self.config['powerwall-rl']['grid_plan']]()
+    # Registering the plans imports every plan module, so it's left until a
+    # plan is needed.
+    import powerwallrl.powerplans.default
+    import powerwallrl.powerplans.powerplan
+    if ('grid_plan' in self.section):
+      return powerwallrl.powerplans.registry[self.section['grid_plan']]()
     return powerwallrl.powerplans.default.Default()
+
+  @property
+  def battery(self):
+    from powerwallrl.gym.battery import Battery
+    section = self.section
+    return Battery(capacity=float(section.get('battery_capacity', 13500)),
+                   discharge_rate=float(
+                     section.get('battery_discharge_rate', 5000)),
+                   charge_rate=float(section.get('battery_charge_rate', 3300)),
+                   count=int(section.get('battery_count', 1)))
@@ -0,0 +1,7 @@
+"""
+Libraries for training and tuning the powerwall models.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
@@ -0,0 +1,215 @@
+""" This module picks how to spread PPO training over the current machine.
+
+It briefly measures the environment's steps per second for each vec env type
+and worker count, and the learner's PPO update and policy inference cost for
+each torch thread count and batch size. Rollouts and updates run one after the
+other, so the expected samples per second of a configuration is
+
+  1 / (1 / env steps per second + inference per sample + update per sample)
+
+and the fastest configuration is chosen. The rollout size per update is kept
+at about ROLLOUT_SAMPLES so the learning signal per update doesn't change with
+the worker count, and batches are kept small enough to give MIN_MINIBATCHES
+gradient steps per epoch.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import json
+import logging
+import numpy as np
+import os
+import platform
+import time
+import torch
+
+from tabulate import tabulate
+
+from stable_baselines3 import PPO
+from stable_baselines3.common.vec_env import DummyVecEnv
+from stable_baselines3.common.vec_env import SubprocVecEnv
+
+logger = logging.getLogger(__name__)
+
+# Samples collected across every worker between PPO updates.
+ROLLOUT_SAMPLES = 8192
+# Fewest gradient steps per epoch a batch size may leave.
+MIN_MINIBATCHES = 16
+BATCH_SIZES = (64, 128, 256, 512, 1024)
+# DummyVecEnv steps its environments one after the other in one process, more
+# of them only batches inference.
+MAX_DUMMY_WORKERS = 4
+
+
+def available_cores():
+  """ Cores this process may run on, which can be fewer than the machine's. """
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+def powers_of_two(limit):
+  values = []
+  value = 1
+  while value < limit:
+    values.append(value)
+    value *= 2
+  values.append(limit)
+  return values
+
+
+def machine():
+  """ What a saved tuning was measured on. """
+  return {'node': platform.node(), 'cores': available_cores(),
+          'torch': torch.__version__}
+
+
+def make_vec_env(make_env, vec_env, workers, start_method=None):
+  if vec_env == 'subproc':
+    return SubprocVecEnv([make_env] * workers, start_method=start_method)
+  return DummyVecEnv([make_env] * workers)
+
+
+class Autotuner(object):
+
+  def __init__(self, make_env, hyperparameters=None, start_method=None,
+               probe_seconds=2.0, cores=None):
+    """ make_env builds one environment, as given to the vec envs. """
+    self.make_env = make_env
+    self.hyperparameters = dict(hyperparameters or {})
+    self.start_method = start_method
+    self.probe_seconds = probe_seconds
+    self.cores = cores or available_cores()
+    # (vec env, workers) -> env steps per second.
+    self.env_rates = {}
+    # (threads, batch size) -> learner seconds per sample.
+    self.update_costs = {}
+    # (threads, workers) -> inference seconds per sample.
+    self.inference_costs = {}
+
+  def measure_env(self, vec_env, workers):
+    """ Env steps per second across every worker, with random actions. """
+    env = make_vec_env(self.make_env, vec_env, workers, self.start_method)
+    try:
+      env.reset()
+      actions = np.stack([env.action_space.sample() for _ in range(workers)])
+      steps = 0
+      start = time.perf_counter()
+      while time.perf_counter() - start < self.probe_seconds:
+        env.step(actions)
+        steps += workers
+      return steps / (time.perf_counter() - start)
+    finally:
+      env.close()
+
+  def measure_learner(self, threads):
+    """ Update cost per sample for each batch size and inference cost per
+      sample for each worker count, using threads torch threads.
+    """
+    torch.set_num_threads(threads)
+    env = DummyVecEnv([self.make_env])
+    params = {k: v for k, v in self.hyperparameters.items()
+              if k not in ('n_steps', 'batch_size')}
+    n_steps = BATCH_SIZES[-1] * 2
+    model = PPO('MlpPolicy', env, n_steps=n_steps, batch_size=BATCH_SIZES[0],
+                device='cpu', verbose=0, **params)
+    try:
+      # Fills the rollout buffer, after which train() can be repeated on it.
+      model.learn(total_timesteps=n_steps)
+      for batch_size in BATCH_SIZES:
+        model.batch_size = batch_size
+        start = time.perf_counter()
+        model.train()
+        self.update_costs[(threads, batch_size)] = (
+          (time.perf_counter() - start) / n_steps)
+
+      obs = env.observation_space.sample()
+      for workers in powers_of_two(self.cores):
+        batch = torch.as_tensor(np.stack([obs] * workers)).float()
+        calls = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+          while time.perf_counter() - start < self.probe_seconds / 4:
+            model.policy(batch)
+            calls += 1
+        self.inference_costs[(threads, workers)] = (
+          (time.perf_counter() - start) / (calls * workers))
+    finally:
+      env.close()
+
+  def measure(self):
+    for workers in powers_of_two(self.cores):
+      if workers <= MAX_DUMMY_WORKERS:
+        self.env_rates[('dummy', workers)] = self.measure_env('dummy', workers)
+      if workers > 1:
+        self.env_rates[('subproc', workers)] = self.measure_env('subproc',
+                                                                workers)
+      logger.info("Measured env rates for %d workers.", workers)
+    default_threads = torch.get_num_threads()
+    try:
+      for threads in powers_of_two(self.cores):
+        self.measure_learner(threads)
+        logger.info("Measured learner costs with %d torch threads.", threads)
+    finally:
+      torch.set_num_threads(default_threads)
+
+  def candidates(self):
+    """ Every measured configuration and its expected samples per second. """
+    results = []
+    for (vec_env, workers), env_rate in self.env_rates.items():
+      n_steps = max(64, ROLLOUT_SAMPLES // workers)
+      rollout = n_steps * workers
+      for (threads, batch_size), update_cost in self.update_costs.items():
+        if rollout // batch_size < MIN_MINIBATCHES:
+          continue
+        inference_cost = self.inference_costs[(threads, workers)]
+        seconds_per_sample = 1.0 / env_rate + inference_cost + update_cost
+        results.append({
+          'vec_env': vec_env,
+          'workers': workers,
+          'torch_threads': threads,
+          'n_steps': n_steps,
+          'batch_size': batch_size,
+          'samples_per_second': 1.0 / seconds_per_sample,
+        })
+    return sorted(results, key=lambda r: -r['samples_per_second'])
+
+  def tune(self):
+    """ Measure this machine, returns the fastest configuration. """
+    start = time.perf_counter()
+    self.measure()
+    candidates = self.candidates()
+    if not candidates:
+      raise Exception("No training configuration could be measured.")
+    best = dict(candidates[0])
+    best['machine'] = machine()
+    best['tuned_seconds'] = time.perf_counter() - start
+    logger.info("Autotuned in %0.0fs:\n%s", best['tuned_seconds'],
+                self.report(candidates))
+    return best
+
+  def report(self, candidates, top=10):
+    return tabulate([[
+      c['vec_env'], c['workers'], c['torch_threads'], c['n_steps'],
+      c['batch_size'], "%0.0f" % c['samples_per_second']
+    ] for c in candidates[:top]],
+                    headers=["Vec Env", "Workers", "Threads", "N Steps",
+                             "Batch", "Samples/s"])
+
+
+def save_tuning(path, tuning):
+  with open(path, 'w') as f:
+    json.dump(tuning, f, indent=2)
+
+
+def load_tuning(path):
+  """ A saved tuning if it was measured on this machine, otherwise None. """
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    tuning = json.load(f)
+  if tuning.get('machine') != machine():
+    return None
+  return tuning
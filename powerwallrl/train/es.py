@@ -0,0 +1,269 @@
+""" This module trains a policy with evolution strategies, a gradient free
+alternative to PPO that scales across cores.
+
+Each generation perturbs the policy's actor parameters with Gaussian noise, in
+antithetic pairs, and scores each perturbation by backtesting it over the same
+batch of historical days. The parameters move along the noise weighted by the
+centered ranks of those scores.
+
+Workers are long lived processes that each hold the backtesters and their own
+copy of the parameters. Noise is regenerated from integer seeds, so a worker is
+only ever sent seeds and the previous generation's rank weights, which it
+applies to its copy exactly as the parent does, and only sends back one return
+per perturbation. No parameters or gradients cross process boundaries, so a
+generation costs the same whatever the policy's size and throughput grows with
+the number of workers.
+
+The parameters are a stable baselines PPO policy's, so the trained model is
+saved, loaded and used to change the battery like any PPO model.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import logging
+import multiprocessing
+import numpy as np
+import os
+import time
+import torch
+
+from torch.nn.utils import parameters_to_vector
+from torch.nn.utils import vector_to_parameters
+
+logger = logging.getLogger(__name__)
+
+# How long a worker has to exit once told to stop before it's terminated.
+WORKER_EXIT_SECONDS = 10
+
+
+def actor_parameters(policy):
+  """ The parameters of a stable baselines policy that set its mean action. """
+  return (list(policy.mlp_extractor.policy_net.parameters()) +
+          list(policy.action_net.parameters()))
+
+
+def get_flat(policy):
+  with torch.no_grad():
+    return parameters_to_vector(actor_parameters(policy)).cpu().numpy().astype(
+      np.float32)
+
+
+def set_flat(policy, theta):
+  with torch.no_grad():
+    vector_to_parameters(torch.as_tensor(theta, device=policy.device),
+                         actor_parameters(policy))
+
+
+def noise(seed, size):
+  return np.random.default_rng(seed).standard_normal(size, dtype=np.float32)
+
+
+def centered_ranks(returns):
+  """ returns ranked into -0.5 to 0.5, robust to their scale and outliers. """
+  returns = np.asarray(returns)
+  ranks = np.empty(returns.size, dtype=np.float32)
+  ranks[returns.ravel().argsort()] = np.arange(returns.size)
+  ranks = ranks.reshape(returns.shape)
+  return ranks / max(1, returns.size - 1) - 0.5
+
+
+def policy_actions(policy):
+  """ A backtest policy of the deterministic, clipped mean action. """
+  def actions(obs):
+    with torch.no_grad():
+      mean = policy.get_distribution(
+        torch.as_tensor(obs, dtype=torch.float32,
+                        device=policy.device)).distribution.mean
+    return np.clip(mean.cpu().numpy(), -1, 1)
+  return actions
+
+
+class EsOptimizer(object):
+  """ Adam ascent on the flat parameters from seeds and rank weights.
+
+    The parent and every worker run one of these from the same starting
+    parameters, so they step in lockstep without exchanging parameters.
+  """
+
+  def __init__(self, theta, sigma=0.02, learning_rate=0.01, l2=0.005,
+               beta1=0.9, beta2=0.999, epsilon=1e-8):
+    self.theta = np.array(theta, dtype=np.float32)
+    self.sigma = sigma
+    self.learning_rate = learning_rate
+    self.l2 = l2
+    self.beta1 = beta1
+    self.beta2 = beta2
+    self.epsilon = epsilon
+    self.m = np.zeros_like(self.theta)
+    self.v = np.zeros_like(self.theta)
+    self.t = 0
+
+  def perturbed(self, seed):
+    """ The antithetic pair of parameters for a seed. """
+    offset = self.sigma * noise(seed, self.theta.size)
+    return self.theta + offset, self.theta - offset
+
+  def step(self, seeds, weights):
+    """ weights are each seed's positive minus negative rank. """
+    gradient = np.zeros_like(self.theta)
+    for seed, weight in zip(seeds, weights):
+      gradient += weight * noise(seed, self.theta.size)
+    gradient /= 2 * len(seeds) * self.sigma
+    gradient -= self.l2 * self.theta
+
+    self.t += 1
+    self.m = self.beta1 * self.m + (1 - self.beta1) * gradient
+    self.v = self.beta2 * self.v + (1 - self.beta2) * gradient * gradient
+    step = (self.learning_rate * np.sqrt(1 - self.beta2**self.t) /
+            (1 - self.beta1**self.t))
+    self.theta += step * self.m / (np.sqrt(self.v) + self.epsilon)
+
+
+def day_batch(backtesters, seed, n_days):
+  """ (backtester index, day indices) of a generation's days, drawn across the
+    backtesters in proportion to their days.
+  """
+  sizes = np.array([len(b) for b in backtesters])
+  rng = np.random.default_rng(seed)
+  chosen = rng.choice(sizes.sum(), min(n_days, sizes.sum()), replace=False)
+  offsets = np.concatenate([[0], np.cumsum(sizes)])
+  return [(i, np.sort(chosen[(chosen >= offsets[i]) &
+                             (chosen < offsets[i + 1])] - offsets[i]))
+          for i in range(len(backtesters))]
+
+
+def score(policy, backtesters, batch):
+  """ Mean reward per day over a batch of days. """
+  rewards = []
+  actions = policy_actions(policy)
+  for i, days in batch:
+    if len(days):
+      rewards.append(backtesters[i].select(days).run(actions).reward)
+  return float(np.mean(np.concatenate(rewards)))
+
+
+def _worker_loop(conn, policy, backtesters, optimizer, torch_threads):
+  """ Score perturbations until sent None.
+
+    Each message is (previous seeds, previous weights, seeds, day seed,
+    days) and the reply is a (seeds, 2) array of the positive and negative
+    perturbations' scores.
+  """
+  torch.set_num_threads(torch_threads)
+  try:
+    while True:
+      message = conn.recv()
+      if message is None:
+        break
+      previous_seeds, previous_weights, seeds, day_seed, n_days = message
+      if len(previous_seeds):
+        optimizer.step(previous_seeds, previous_weights)
+      batch = day_batch(backtesters, day_seed, n_days)
+      returns = np.empty((len(seeds), 2), dtype=np.float64)
+      for j, seed in enumerate(seeds):
+        for k, theta in enumerate(optimizer.perturbed(seed)):
+          set_flat(policy, theta)
+          returns[j, k] = score(policy, backtesters, batch)
+      conn.send(returns)
+  finally:
+    conn.close()
+
+
+class EsTrainer(object):
+
+  def __init__(self, model, backtesters, population=32, sigma=0.02,
+               learning_rate=0.01, days_per_generation=64, workers=None,
+               torch_threads=1, seed=0):
+    """ model is a PPO model whose policy is trained in place. population is
+      the antithetic pairs scored per generation over days_per_generation days
+      of the backtesters.
+    """
+    self.model = model
+    self.backtesters = backtesters
+    self.population = population
+    self.days_per_generation = days_per_generation
+    self.workers = workers or os.cpu_count() or 1
+    self.torch_threads = torch_threads
+    self.rng = np.random.default_rng(seed)
+    self.optimizer = EsOptimizer(get_flat(model.policy), sigma=sigma,
+                                 learning_rate=learning_rate)
+    self.history = []
+
+  def train(self, generations, callback=None):
+    """ Run generations, calling callback(generation, trainer) after each.
+
+      Returns the mean score of each generation's perturbations.
+    """
+    # Fork shares the backtesters with workers without copying them.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+      'fork' if 'fork' in methods else 'spawn')
+    n_workers = min(self.workers, self.population)
+    policy = self.model.policy
+    connections = []
+    processes = []
+    for _ in range(n_workers):
+      parent, child = context.Pipe()
+      process = context.Process(
+        target=_worker_loop,
+        args=(child, policy, self.backtesters, self.optimizer,
+              self.torch_threads),
+        daemon=True)
+      process.start()
+      child.close()
+      connections.append(parent)
+      processes.append(process)
+    logger.info("Evolving %d perturbation pairs a generation over %d days on "
+                "%d workers.", self.population, self.days_per_generation,
+                n_workers)
+
+    previous = np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+    try:
+      for generation in range(generations):
+        start = time.perf_counter()
+        seeds = self.rng.integers(0, 2**31 - 1, self.population)
+        shards = np.array_split(np.arange(self.population), n_workers)
+        day_seed = int(self.rng.integers(0, 2**31 - 1))
+        for conn, shard in zip(connections, shards):
+          conn.send((previous[0], previous[1], seeds[shard], day_seed,
+                     self.days_per_generation))
+        returns = np.concatenate([conn.recv() for conn in connections])
+
+        ranks = centered_ranks(returns)
+        weights = ranks[:, 0] - ranks[:, 1]
+        self.optimizer.step(seeds, weights)
+        # Every worker applies the whole generation's update.
+        previous = seeds, weights
+        seconds = time.perf_counter() - start
+        self.history.append(float(returns.mean()))
+        logger.info("Generation %d mean reward %0.2f, best %0.2f, %0.0f days "
+                    "simulated/s.", generation + 1, returns.mean(),
+                    returns.max(), returns.size * self.days_per_generation /
+                    seconds)
+        if callback is not None:
+          callback(generation, self)
+    finally:
+      try:
+        # A worker that died has closed its end, don't let it stop the rest
+        # shutting down.
+        for conn in connections:
+          try:
+            conn.send(None)
+          except (BrokenPipeError, OSError):
+            pass
+          finally:
+            conn.close()
+        for process in processes:
+          process.join(timeout=WORKER_EXIT_SECONDS)
+          if process.is_alive():
+            process.terminate()
+            process.join()
+      finally:
+        set_flat(policy, self.optimizer.theta)
+    return self.history
+
+  def update_model(self):
+    """ Copy the current parameters into the model's policy. """
+    set_flat(self.model.policy, self.optimizer.theta)
@@ -0,0 +1,138 @@
+""" This module warm starts a policy by cloning the home's recorded battery use.
+
+Every day of the history is replayed from the same starting charge, as in the
+backtester. Each hour's recorded battery Wh becomes the backup reserve target
+that makes the environment move that much energy, which is the charge at the
+end of the hour, and the charge carries on to the next hour through the battery
+kernel. A policy acting every action_hours is shown the target that leaves the
+recorded charge at the end of those hours, held across them. The policy network
+is then fit to those (observation, action) pairs with batched supervised
+learning before PPO starts.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import logging
+import numpy as np
+import torch
+
+from powerwallrl.analysis.backtest import Backtester
+from powerwallrl.analysis.backtest import observations
+from powerwallrl.gym.dataset import BATTERY_POWER
+from powerwallrl.gym.dataset import load_dataset
+from powerwallrl.gym.kernel import battery_step
+from powerwallrl.gym.kernel import battery_substeps
+
+logger = logging.getLogger(__name__)
+
+
+def target_to_action(target):
+  """ The action for a backup reserve percent, see action_to_target(). """
+  return ((np.asarray(target, dtype=np.float64) - 50) / 50).astype(np.float32)
+
+
+def demonstrations(config, dataset, battery_charge=30, schedule=False,
+                   action_hours=1):
+  """ Observations and the actions reproducing the recorded battery use.
+
+    Returns (observations, actions), one row per day and action_hours, or one
+    per day with 24 hour actions for a schedule. A dataset loaded with substeps
+    carries the charge through them, as the environment simulates it.
+  """
+  hold = 1 if schedule else action_hours
+  backtester = Backtester(dataset, config.grid_plan, config.battery,
+                          dateutil.tz.gettz(config.local_timezone),
+                          battery_charge, hold)
+  battery = config.battery
+  rows = backtester.rows
+  n_days = len(backtester)
+  charge = np.full(n_days, battery_charge, dtype=np.float64)
+  charge_left = np.full(n_days, 100.0)
+  obs = []
+  targets = np.empty((n_days, 24))
+  for hour in range(24):
+    if hour % hold:
+      targets[:, hour] = targets[:, hour - 1]
+    else:
+      if not schedule or hour == 0:
+        obs.append(observations(rows[:, hour:hour + 24], charge))
+      recorded = rows[:, hour:hour + hold, BATTERY_POWER].sum(axis=1)
+      targets[:, hour] = np.clip(
+        np.round(charge - recorded / battery.capacity * 100), 0, 100)
+    if backtester.substeps is None:
+      charge, charge_left, _, _ = battery_step(
+        charge, charge_left, targets[:, hour], backtester.shortfall[:, hour],
+        battery.capacity, battery.discharge_limit, battery.charge_limit)
+    else:
+      charge, charge_left, _, _ = battery_substeps(
+        charge, charge_left, targets[:, hour], backtester.substeps[:, hour],
+        battery.capacity, battery.discharge_limit, battery.charge_limit)
+
+  if schedule:
+    return obs[0], target_to_action(targets)
+  return (np.concatenate(obs),
+          target_to_action(targets[:, ::hold].T.reshape(-1, 1)))
+
+
+def clone(model, obs, actions, epochs=20, batch_size=256, learning_rate=1e-3,
+          validation_fraction=0.1, seed=0):
+  """ Fit a stable baselines policy's mean action to actions.
+
+    Returns the (training, validation) mean squared error of each epoch.
+  """
+  policy = model.policy
+  rng = np.random.default_rng(seed)
+  order = rng.permutation(len(obs))
+  n_validation = int(len(obs) * validation_fraction)
+  validation, training = order[:n_validation], order[n_validation:]
+  obs = torch.as_tensor(obs, dtype=torch.float32, device=policy.device)
+  actions = torch.as_tensor(actions, dtype=torch.float32,
+                            device=policy.device)
+  optimizer = torch.optim.Adam(policy.parameters(), lr=learning_rate)
+
+  def mean_action(batch):
+    return policy.get_distribution(obs[batch]).distribution.mean
+
+  history = []
+  policy.set_training_mode(True)
+  for epoch in range(epochs):
+    losses = []
+    for start in range(0, len(training), batch_size):
+      batch = torch.as_tensor(training[start:start + batch_size])
+      loss = torch.nn.functional.mse_loss(mean_action(batch), actions[batch])
+      optimizer.zero_grad()
+      loss.backward()
+      optimizer.step()
+      losses.append(loss.item() * len(batch))
+    training = rng.permutation(training)
+
+    with torch.no_grad():
+      validation_loss = (torch.nn.functional.mse_loss(
+        mean_action(torch.as_tensor(validation)),
+        actions[validation]).item() if n_validation else float('nan'))
+    history.append((sum(losses) / len(training), validation_loss))
+    logger.info("Behavior cloning epoch %d, training loss %0.4f, validation "
+                "loss %0.4f", epoch + 1, history[-1][0], history[-1][1])
+  policy.set_training_mode(False)
+  return history
+
+
+def pretrain(model, sites, epochs=20, schedule=False, substeps=1,
+             action_hours=1):
+  """ Clone the recorded battery use of every site into model's policy. """
+  all_obs = []
+  all_actions = []
+  for site in sites:
+    obs, actions = demonstrations(
+      site, load_dataset(site, site.grid_plan,
+                         substeps=substeps if substeps > 1 else None),
+      schedule=schedule, action_hours=action_hours)
+    all_obs.append(obs)
+    all_actions.append(actions)
+  obs = np.concatenate(all_obs)
+  actions = np.concatenate(all_actions)
+  logger.info("Behavior cloning from %d recorded decisions.", len(obs))
+  return clone(model, obs, actions, epochs=epochs)
@@ -0,0 +1,242 @@
+""" This module runs a hyperparameter sweep of PPO settings for a home.
+
+Trials run in a pool of worker processes, each with a fixed budget of cores for
+its torch threads and environments. The episode dataset is loaded once in the
+parent and handed to each worker when it starts, never per trial.
+
+Each trial is scored on rolling time based folds, training on the history up to
+a point and evaluating on the days after it, so a trial is never scored on days
+it trained on. After each fold a trial whose running score is below the median
+of the other trials at the same fold is pruned.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import time
+import torch
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from functools import partial
+from tabulate import tabulate
+
+from powerwallrl.analysis.backtest import Backtester
+from powerwallrl.analysis.backtest import model_policy
+from powerwallrl.gym.powerwall import MakePowerwallEnv
+from powerwallrl.settings import PowerwallRLConfig
+
+from stable_baselines3 import PPO
+from stable_baselines3.common.vec_env import DummyVecEnv
+
+logger = logging.getLogger(__name__)
+
+# Training windows whose 48 hours could overlap a validation day are dropped.
+PURGE_WINDOWS = 47
+
+
+def sample_hyperparameters(rng):
+  """ Sample PPO keyword arguments from the search space. """
+  n_steps = int(rng.choice([256, 512, 1024, 2048]))
+  return {
+    'learning_rate': float(10**rng.uniform(-5, -3)),
+    'n_steps': n_steps,
+    'batch_size': int(rng.choice([b for b in (32, 64, 128, 256)
+                                  if b <= n_steps])),
+    'n_epochs': int(rng.choice([5, 10, 20])),
+    'gamma': float(rng.choice([0.9, 0.95, 0.98, 0.99, 0.995])),
+    'gae_lambda': float(rng.choice([0.9, 0.95, 0.98, 1.0])),
+    'clip_range': float(rng.choice([0.1, 0.2, 0.3])),
+    'ent_coef': float(10**rng.uniform(-8, -2)),
+    'policy_kwargs': {
+      'net_arch': [int(rng.choice([32, 64, 128]))] * int(rng.choice([1, 2]))
+    },
+  }
+
+
+def time_folds(dataset, n_folds):
+  """ Rolling (train, validation) datasets, oldest validation days first.
+
+    The windows are split in time order into n_folds + 1 blocks. Fold k trains on
+    every block before block k + 1 and validates on the midnight windows of
+    block k + 1.
+  """
+  windows = dataset.windows
+  blocks = np.array_split(np.arange(len(windows)), n_folds + 1)
+  folds = []
+  for block in blocks[1:]:
+    if not len(block):
+      continue
+    first = int(block[0])
+    train_end = windows[max(0, first - PURGE_WINDOWS)]
+    val_end = windows[int(block[-1])] + 1
+    folds.append((dataset.subset(end_dayhour=train_end),
+                  dataset.subset(windows[first], val_end).daily()))
+  return folds
+
+
+def evaluate(model, config, dataset):
+  """ Mean reward per day over the dataset's midnight windows. """
+  backtester = Backtester(dataset, config.grid_plan, config.battery,
+                          dateutil.tz.gettz(config.local_timezone))
+  return backtester.run(model_policy(model)).mean_reward()
+
+
+# State each worker process is given once when it starts.
+_worker = {}
+
+
+def _init_worker(folds, reports, cores, timesteps, n_startup_trials):
+  torch.set_num_threads(cores)
+  _worker.update({
+    'config': PowerwallRLConfig(),
+    'folds': folds,
+    'reports': reports,
+    'cores': cores,
+    'timesteps': timesteps,
+    'n_startup_trials': n_startup_trials,
+  })
+
+
+def should_prune(reports, trial, fold, score, n_startup_trials):
+  """ Median pruning against the other trials' running scores at this fold. """
+  others = [s for t, f, s in list(reports) if f == fold and t != trial]
+  if len(others) < n_startup_trials:
+    return False
+  return score < float(np.median(others))
+
+
+def run_trial(trial, params, seed):
+  config = _worker['config']
+  folds = _worker['folds']
+  start = time.time()
+  scores = []
+  pruned = False
+  for fold, (train, validation) in enumerate(folds):
+    if not len(train) or not len(validation):
+      continue
+    env = DummyVecEnv([
+      partial(MakePowerwallEnv, config, config.grid_plan, debug=False,
+              dataset=train) for _ in range(_worker['cores'])
+    ])
+    model = PPO('MlpPolicy', env, seed=seed, device='cpu', verbose=0,
+                **params)
+    model.learn(total_timesteps=_worker['timesteps'])
+    scores.append(evaluate(model, config, validation))
+    env.close()
+
+    score = float(np.mean(scores))
+    _worker['reports'].append((trial, fold, score))
+    if (fold < len(folds) - 1 and
+        should_prune(_worker['reports'], trial, fold, score,
+                     _worker['n_startup_trials'])):
+      pruned = True
+      break
+
+  return {
+    'trial': trial,
+    'params': params,
+    'seed': seed,
+    'scores': scores,
+    'score': float(np.mean(scores)) if scores else float('-inf'),
+    'pruned': pruned,
+    'seconds': time.time() - start,
+  }
+
+
+class SweepRunner(object):
+
+  def __init__(self, dataset, n_trials=32, cores_per_trial=2,
+               timesteps=50000, n_folds=3, budget_hours=None,
+               n_startup_trials=4, seed=0):
+    self.dataset = dataset
+    self.n_trials = n_trials
+    self.cores_per_trial = cores_per_trial
+    self.timesteps = timesteps
+    self.n_folds = n_folds
+    self.budget_hours = budget_hours
+    self.n_startup_trials = n_startup_trials
+    self.seed = seed
+    self.results = []
+
+  def run(self):
+    """ Run trials until n_trials are done or the time budget is spent. """
+    folds = time_folds(self.dataset, self.n_folds)
+    if not folds:
+      raise Exception("Not enough history for %d folds." % self.n_folds)
+    n_parallel = max(1, (os.cpu_count() or 1) // self.cores_per_trial)
+    rng = np.random.default_rng(self.seed)
+    deadline = (time.time() + self.budget_hours * 3600
+                if self.budget_hours else None)
+    logger.info("Sweeping %d trials, %d at a time with %d cores each.",
+                self.n_trials, n_parallel, self.cores_per_trial)
+
+    # Fork shares the loaded dataset with workers without copying it.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+      'fork' if 'fork' in methods else 'spawn')
+    with context.Manager() as manager:
+      reports = manager.list()
+      with ProcessPoolExecutor(
+          max_workers=n_parallel, mp_context=context,
+          initializer=_init_worker,
+          initargs=(folds, reports, self.cores_per_trial, self.timesteps,
+                    self.n_startup_trials)) as pool:
+        running = set()
+        submitted = 0
+        while running or submitted < self.n_trials:
+          while (submitted < self.n_trials and len(running) < n_parallel and
+                 (deadline is None or time.time() < deadline)):
+            running.add(
+              pool.submit(run_trial, submitted, sample_hyperparameters(rng),
+                          self.seed + submitted))
+            submitted += 1
+          if not running:
+            logger.info("Sweep time budget spent after %d trials.", submitted)
+            break
+          done, running = wait(running, return_when=FIRST_COMPLETED)
+          for future in done:
+            result = future.result()
+            self.results.append(result)
+            logger.info("Trial %d %s with score %0.2f in %ds.",
+                        result['trial'],
+                        'pruned' if result['pruned'] else 'finished',
+                        result['score'], result['seconds'])
+    return self.ranked()
+
+  def ranked(self):
+    """ Completed trials before pruned ones, best score first. """
+    return sorted(self.results, key=lambda r: (r['pruned'], -r['score']))
+
+  def report(self):
+    return tabulate([[
+      r['trial'],
+      "%0.2f" % r['score'],
+      ' '.join("%0.2f" % s for s in r['scores']),
+      'yes' if r['pruned'] else '',
+      json.dumps(r['params'], sort_keys=True),
+    ] for r in self.ranked()],
+                    headers=["Trial", "Score", "Folds", "Pruned", "Params"])
+
+  def save(self, path):
+    """ Save every trial, best first, for train_model.py to pick up. """
+    with open(path, 'w') as f:
+      json.dump({'trials': self.ranked()}, f, indent=2)
+
+
+def load_best_hyperparameters(path):
+  """ The best completed trial's PPO arguments from a saved sweep, or {}. """
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    trials = json.load(f)['trials']
+  completed = [t for t in trials if not t['pruned']]
+  return completed[0]['params'] if completed else {}
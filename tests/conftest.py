@@ -0,0 +1,91 @@
+""" Fixtures for a synthetic home, a few days of random hourly power and weather
+in a temporary database, so tests never need Tesla, OpenWeatherMap or a
+collected history.
+"""
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import configparser
+import numpy as np
+import pytest
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+
+from powerwallrl.data.episodes import EpisodeWindowIndex
+from powerwallrl.data.tesla import TeslaPowerwallData
+from powerwallrl.data.version import DataVersion
+from powerwallrl.data.weather import WeatherData
+from powerwallrl.settings import PowerwallRLConfig
+
+# UTC has no daylight savings, so every day is 24 dayhours.
+START = datetime(2023, 3, 1, tzinfo=timezone.utc)
+DAYS = 6
+
+
+def dayhours(start_hour, end_hour):
+  """ Dayhours of the hours from start_hour to end_hour after START. """
+  return [
+    int((START + timedelta(hours=hour)).strftime('%Y%m%d%H'))
+    for hour in range(start_hour, end_hour)
+  ]
+
+
+def write_hours(con, hours, seed=0):
+  """ Random power and weather for each dayhour, recorded as ingestion would.
+  """
+  rng = np.random.default_rng(seed)
+  cur = con.cursor()
+  for dayhour in hours:
+    hour = dayhour % 100
+    solar = max(0.0, 4000 * np.sin((hour - 6) / 12 * np.pi))
+    load = rng.uniform(300, 2500)
+    battery = rng.uniform(-1500, 1500)
+    cur.execute(
+      ''' INSERT OR REPLACE INTO powerwall(dayhour, solar_power, battery_power,
+                                           grid_power)
+          VALUES(?, ?, ?, ?) ''', (dayhour, solar, battery,
+                                   load - solar - battery))
+    cur.execute(
+      ''' INSERT OR REPLACE INTO weather_24(dayhour, temp, uvi, clouds,
+                                            humidity)
+          VALUES(?, ?, ?, ?, ?) ''',
+      (dayhour, rng.uniform(10, 35), solar / 400, int(rng.integers(0, 100)),
+       int(rng.integers(20, 90))))
+  version = DataVersion(con)
+  version.touch('powerwall', min(hours))
+  version.touch('weather_24', min(hours))
+  con.commit()
+
+
+def create_database(path):
+  con = sqlite3.connect(path)
+  # Creating the tables never talks to Tesla or OpenWeatherMap.
+  TeslaPowerwallData(None, con, 'UTC', tesla_api=object(),
+                     battery=object()).setup()
+  WeatherData(None, 0, 0, con, 'UTC').setup()
+  return con
+
+
+@pytest.fixture
+def config(tmp_path):
+  parser = configparser.ConfigParser()
+  parser['powerwall-rl'] = {
+    'latitude': '-31.95',
+    'longitude': '115.86',
+    'local_timezone': 'UTC',
+    'database_location': str(tmp_path / 'powerwall-rl.db'),
+  }
+  return PowerwallRLConfig(config=parser)
+
+
+@pytest.fixture
+def database(config):
+  """ DAYS days of history with an indexed window starting every hour. """
+  con = create_database(config.database_location)
+  write_hours(con, dayhours(0, DAYS * 24))
+  EpisodeWindowIndex(con, 'UTC').update()
+  yield con
+  con.close()
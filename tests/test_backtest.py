@@ -0,0 +1,50 @@
+""" The vectorised backtester must score a day exactly as HomePowerEnv does. """
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import dateutil.tz
+import numpy as np
+import pytest
+
+from powerwallrl.analysis.backtest import Backtester
+from powerwallrl.gym.dataset import load_dataset
+from powerwallrl.gym.powerwall import HomePowerEnv
+
+
+@pytest.mark.parametrize('action_hours', [1, 3])
+def test_backtest_rewards_match_env(config, database, action_hours):
+  plan = config.grid_plan
+  dataset = load_dataset(config, plan, database)
+  days = dataset.daily().windows
+  assert len(days) >= 3
+
+  rng = np.random.default_rng(1)
+  for day in days:
+    actions = rng.uniform(-1, 1, (24 // action_hours, 1))
+    calls = iter(actions)
+    backtester = Backtester(dataset.subset(day, day + 1), plan,
+                            config.battery, dateutil.tz.gettz('UTC'),
+                            action_hours=action_hours)
+    result = backtester.run(lambda obs: next(calls)[None, :])
+
+    # The backtest reward has no backup percent or battery left terms.
+    env = HomePowerEnv(config, plan, debug=False,
+                       randomize_battery_start=False,
+                       reward_backup_percent=False, reward_battery_left=False,
+                       dataset=dataset.subset(day, day + 1),
+                       action_hours=action_hours)
+    env.reset(seed=0)
+    reward = 0.0
+    terminated = False
+    steps = 0
+    while not terminated:
+      _, step_reward, terminated, _, _ = env.step(actions[steps])
+      reward += step_reward
+      steps += 1
+    env.close()
+
+    assert steps == len(actions)
+    assert result.days[0] == day
+    assert reward == pytest.approx(result.reward[0], abs=1e-9)
@@ -0,0 +1,41 @@
+""" The episode window index, updated incrementally as data is ingested. """
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+from conftest import DAYS
+from conftest import dayhours
+from conftest import write_hours
+from powerwallrl.data.episodes import EpisodeWindowIndex
+
+
+def test_windows_need_48_hours_without_gaps(database):
+  windows = EpisodeWindowIndex(database, 'UTC').windows()
+  assert windows == dayhours(0, DAYS * 24 - 47)
+
+  # A missing hour removes every window that covers it.
+  database.execute(''' DELETE FROM weather_24 WHERE dayhour = ? ''',
+                   (dayhours(60, 61)[0],))
+  database.commit()
+  index = EpisodeWindowIndex(database, 'UTC')
+  # The delete wasn't recorded as ingestion, so rebuild from scratch.
+  database.execute(''' DELETE FROM episode_window_version ''')
+  assert index.windows(update=True) == (dayhours(0, 13) +
+                                        dayhours(61, DAYS * 24 - 47))
+
+
+def test_incremental_update_matches_full_rebuild(database):
+  index = EpisodeWindowIndex(database, 'UTC')
+  # Overwrite a day in the middle and append two more with a gap before them.
+  write_hours(database, dayhours(50, 74), seed=1)
+  write_hours(database, dayhours(DAYS * 24 + 5, (DAYS + 2) * 24), seed=2)
+  incremental = list(index.windows(update=True))
+
+  database.execute(''' DELETE FROM episode_window_version ''')
+  database.commit()
+  full = EpisodeWindowIndex(database, 'UTC').windows(update=True)
+
+  assert incremental == full
+  assert incremental == (dayhours(0, DAYS * 24 - 47) +
+                         dayhours(DAYS * 24 + 5, (DAYS + 2) * 24 - 47))
@@ -0,0 +1,51 @@
+""" Snapshotting and restoring a HomePowerEnv episode. """
+
+# Author: Daniel Williams
+
+__version__ = '0.0.1'
+
+import numpy as np
+import pytest
+
+from powerwallrl.gym.dataset import load_dataset
+from powerwallrl.gym.powerwall import HomePowerEnv
+
+
+def play(env, actions):
+  """ Each step's (observation, reward) until the episode ends. """
+  steps = []
+  for action in actions:
+    observation, reward, terminated, _, _ = env.step(action)
+    steps.append((observation, reward))
+    if terminated:
+      break
+  return steps
+
+
+@pytest.mark.parametrize('action_hours', [1, 3])
+def test_set_state_replays_identically(config, database, action_hours):
+  env = HomePowerEnv(config, config.grid_plan, debug=False,
+                     dataset=load_dataset(config, config.grid_plan, database),
+                     action_hours=action_hours)
+  with pytest.raises(Exception, match='reset'):
+    env.get_state()
+
+  env.reset(seed=3)
+  actions = np.random.default_rng(3).uniform(-1, 1, (24, 1))
+  play(env, actions[:2])
+  state = env.get_state()
+  first = play(env, actions[2:])
+
+  # Branch off somewhere else, then come back.
+  env.set_state(state)
+  play(env, -actions[2:])
+  observation = env.set_state(state)
+  second = play(env, actions[2:])
+  env.close()
+
+  assert observation.keys() == first[0][0].keys()
+  assert len(first) == len(second) == 24 // action_hours - 2
+  for (obs_a, reward_a), (obs_b, reward_b) in zip(first, second):
+    assert reward_a == reward_b
+    for key in obs_a:
+      np.testing.assert_array_equal(obs_a[key], obs_b[key])